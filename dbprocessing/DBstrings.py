@@ -9,6 +9,7 @@ dbprocessing: parsing, formatting, etc.
 
 __author__ = 'Jonathan Niehof <jniehof@lanl.gov>'
 
+import re
 import string
 
 
@@ -57,6 +58,9 @@ class DBformatter(string.Formatter):
         'nnnn': ('{nnnn}', '\d\d\d\d'),
     }
 
+    _expanded = {}
+    """Results of L{expand_format}, see there"""
+
     def format(self, format_string, *args, **kwargs):
         """Expand base format to handle datetime and special dbp keywords
 
@@ -72,6 +76,32 @@ class DBformatter(string.Formatter):
         return super(DBformatter, self).format(
             self.expand_format(format_string, kwargs), *args, **kwargs)
 
+    def match_re(self, format_string):
+        """Regular expression matching anything L{format} can make of a format string
+
+        Unlike L{re} the literal text is escaped and no field is left
+        unfilled: fields in L{SPECIAL_FIELDS} (with no format spec or
+        conversion, or the default one) become their regular expression
+        and every other field matches anything.
+
+        :param format_string: the format string to match
+        :type format_string: str
+        :return: regular expression, not anchored
+        :rtype: str
+        """
+        result = []
+        for literal, field, format, conversion in self.parse(format_string):
+            result.append(re.escape(literal))
+            if field is None:
+                continue
+            if field in self.SPECIAL_FIELDS and \
+               ((not format and not conversion) or
+                self.SPECIAL_FIELDS[field][0] == self.assemble('', field, format, conversion)):
+                result.append('(' + self.SPECIAL_FIELDS[field][1] + ')')
+            else:
+                result.append('.*')
+        return ''.join(result)
+
     def expand_datetime(self, kwargs):
         """Expands datetime keyword into special keywords. Helper function!
 
@@ -136,7 +166,25 @@ class DBformatter(string.Formatter):
                  expanded to full format specifiers and replaced by
                  regular expressions, as desired.
         :rtype: str
+
+        .. note:: The result only depends on L{format_string} and which
+           of L{SPECIAL_FIELDS} are in L{kwargs}, so it is kept and
+           handed back on the next call with the same ones.
         """
+        # str and unicode of the same text hash the same, keep them apart
+        key = (type(self), type(format_string), format_string,
+               None if kwargs is None else
+               frozenset(k for k in kwargs if k in self.SPECIAL_FIELDS))
+        try:
+            return self._expanded[key]
+        except KeyError:
+            pass
+        result = self._expand_format(format_string, kwargs)
+        self._expanded[key] = result
+        return result
+
+    def _expand_format(self, format_string, kwargs):
+        """Does the work of L{expand_format}, without keeping the result"""
         result = []
         for literal, field, format, conversion in self.parse(format_string):
             result.append(literal)
@@ -192,3 +240,145 @@ class DBformatter(string.Formatter):
             fs += format
         fs += '}'
         return fs
+
+
+class DBtemplate(object):
+    """A format string parsed once, to format and match many times
+
+    Formatting with L{DBformatter} parses the format string on every
+    call; for the product formats that are filled in for every file
+    the parsing is most of the time. A template does the parsing (and
+    the expansion of L{DBformatter.SPECIAL_FIELDS}) once up front.
+
+    Use L{template} rather than making these directly so each format
+    string is only compiled once.
+
+    :ivar format_string: the format string this is a template for
+    :type format_string: str
+    :ivar prefix: literal text before the first field
+    :type prefix: str
+    :ivar fields: names of all the fields in the format string
+    :type fields: frozenset
+    :ivar regex: compiled, anchored L{DBformatter.match_re} of the format
+                 string, with a named group for each field that can be
+                 a group name (first occurrence only)
+    :type regex: compiled regular expression
+    """
+
+    def __init__(self, format_string, formatter=None):
+        """Parse a format string
+
+        :param format_string: the format string
+        :type format_string: str
+        :param formatter: formatter to use, default a L{DBformatter}
+        :type formatter: L{DBformatter}
+        """
+        self.format_string = format_string
+        self.formatter = DBformatter() if formatter is None else formatter
+        parsed = list(self.formatter.parse(format_string))
+        self.prefix = parsed[0][0] if parsed and parsed[0][0] else ''
+        self.fields = frozenset(field for literal, field, format, conversion
+                                in parsed if field)
+        self._special = self.fields.intersection(self.formatter.SPECIAL_FIELDS)
+        self._expanded = self.formatter.expand_format(format_string)
+        self._pieces = {None: self._compile(self._expanded)}
+        self.regex = re.compile(self._named_re(parsed) + '$')
+
+    def _compile(self, expanded):
+        """Parse an expanded format string into the pieces L{_render} needs
+
+        :return: list of (literal, field, format spec, conversion), or None
+                 if a format spec has fields of its own and so needs the
+                 full formatter
+        """
+        pieces = list(self.formatter.parse(expanded))
+        for literal, field, format, conversion in pieces:
+            if format and '{' in format:
+                return None
+        return pieces
+
+    def _named_re(self, parsed):
+        """Like L{DBformatter.match_re} but with named groups"""
+        special = self.formatter.SPECIAL_FIELDS
+        named = set()
+        result = []
+        for literal, field, format, conversion in parsed:
+            result.append(re.escape(literal))
+            if field is None:
+                continue
+            if field in special and \
+               ((not format and not conversion) or
+                special[field][0] == self.formatter.assemble('', field, format, conversion)):
+                pattern = special[field][1]
+            else:
+                pattern = '.*'
+            if field not in named and re.match(r'[A-Za-z_]\w*$', field):
+                named.add(field)
+                result.append('(?P<' + field + '>' + pattern + ')')
+            else:
+                result.append('(' + pattern + ')')
+        return ''.join(result)
+
+    def _render(self, pieces, expanded, args, kwargs):
+        """Fill in the fields of a parsed format string"""
+        if pieces is None:
+            return super(DBformatter, self.formatter).format(
+                expanded, *args, **kwargs)
+        fmtr = self.formatter
+        result = []
+        for literal, field, format, conversion in pieces:
+            result.append(literal)
+            if field is not None:
+                obj = fmtr.get_field(field, args, kwargs)[0]
+                result.append(fmtr.format_field(
+                    fmtr.convert_field(obj, conversion), format))
+        return ''.join(result)
+
+    def format(self, *args, **kwargs):
+        """Same as L{DBformatter.format} on the format string"""
+        self.formatter.expand_datetime(kwargs)
+        return self._render(self._pieces[None], self._expanded, args, kwargs)
+
+    def re(self, *args, **kwargs):
+        """Same as L{DBformatter.re} on the format string"""
+        self.formatter.expand_datetime(kwargs)
+        key = self._special.intersection(kwargs)
+        expanded = self.formatter.expand_format(self.format_string, kwargs)
+        if key not in self._pieces:
+            self._pieces[key] = self._compile(expanded)
+        return self._render(self._pieces[key], expanded, args, kwargs)
+
+    def match(self, string):
+        """Match a string against the format string
+
+        :param string: the string to match, all of it must match
+        :type string: str
+        :return: the text matching each named field, None if no match
+        :rtype: dict
+        """
+        m = self.regex.match(string)
+        if m is None:
+            return None
+        return m.groupdict()
+
+
+_templates = {}
+"""Templates made by L{template}, keyed by type and format string"""
+
+
+def template(format_string):
+    """Get the L{DBtemplate} of a format string
+
+    Each format string is only parsed once, later calls with the same
+    format string return the same template.
+
+    :param format_string: the format string
+    :type format_string: str
+    :rtype: L{DBtemplate}
+    """
+    key = (type(format_string), format_string)
+    try:
+        return _templates[key]
+    except KeyError:
+        tmpl = _templates[key] = DBtemplate(format_string)
+        return tmpl
@@ -1,7 +1,11 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
+import array
+import bisect
 import datetime
+import functools
+import hashlib
 import pdb
 import glob
 import itertools
@@ -22,8 +26,9 @@ from sqlalchemy.exc import ArgumentError
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.sql import func
 from sqlalchemy import and_
+from sqlalchemy import or_
 
-from .Diskfile import calcDigest, DigestError
+from .Diskfile import calcDigest, calcDigests, DigestCache, DigestError
 from . import DBlogging
 from . import DBstrings
 from . import Version
@@ -57,12 +62,89 @@ class DBNoData(Exception):
     pass
 
 
+def _cachedMetadata(func):
+    """
+    Decorator for the DButils methods that only read the near static tables
+    (:attr:`DButils.STATIC_TABLES`), the answers are kept until one of those
+    tables is written (see :meth:`DButils.clearCache`)
+
+    Lists and dicts are copied on the way out so a caller can change them,
+    ORM rows in the answers must be detached copies (:meth:`DButils._detached`).
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        key = (func.__name__, args, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:  # a list or such came in, just do the query
+            return func(self, *args, **kwargs)
+        if key not in self._cache:
+            self._cache[key] = func(self, *args, **kwargs)
+        ans = self._cache[key]
+        if isinstance(ans, list):
+            return list(ans)
+        elif isinstance(ans, dict):
+            return dict(ans)
+        return ans
+    return wrapper
+
+
+def _filenameHash(filename):
+    """
+    32 bits of the md5 of a filename, this is what the filename index keeps
+    (see :meth:`DButils.fileInDB`)
+    """
+    if isinstance(filename, unicode):
+        filename = filename.encode('utf-8')
+    return int(hashlib.md5(filename).hexdigest()[:8], 16)
+
+
+def newestFileTable(metadata):
+    """
+    Define the newest_file table in metadata, it points at the newest version
+    file of each (product_id, utc_file_date) and is kept up to date by
+    :meth:`DButils.addFile`, :meth:`DButils.addFiles` and
+    :meth:`DButils._purgeFileFromDB`
+
+    :param metadata: metadata that has (or will have) the file and product tables
+    :type metadata: sqlalchemy.MetaData
+    :return: the table
+    :rtype: sqlalchemy.Table
+    """
+    return sqlalchemy.Table('newest_file', metadata,
+                            sqlalchemy.Column('product_id', sqlalchemy.Integer,
+                                              sqlalchemy.ForeignKey('product.product_id'), nullable=False),
+                            sqlalchemy.Column('utc_file_date', sqlalchemy.Date, nullable=False),
+                            sqlalchemy.Column('file_id', sqlalchemy.Integer,
+                                              sqlalchemy.ForeignKey('file.file_id'), nullable=False, unique=True),
+                            sqlalchemy.PrimaryKeyConstraint('product_id', 'utc_file_date'))
+
+
 class DButils(object):
     """
     Utility routines for the DBProcessing class, all of these may be user called but are meant to
     be internal routines for DBProcessing
     """
 
+    STATIC_TABLES = ('Mission', 'Satellite', 'Instrument', 'Instrumentproductlink', 'Product',
+                     'Process', 'Productprocesslink', 'Code', 'Inspector')
+    """Tables that rarely change while processing, lookups on them are cached"""
+
+    INDEXES = (('ix_file_product_date_version', 'file',
+                ('product_id', 'utc_file_date', 'interface_version', 'quality_version', 'revision_version')),
+               ('ix_productprocesslink_input', 'productprocesslink', ('input_product_id', 'process_id')),
+               ('ix_instrumentproductlink_product', 'instrumentproductlink', ('product_id', 'instrument_id')),
+               ('ix_filecodelink_code', 'filecodelink', ('source_code', 'resulting_file')),
+               ('ix_inspector_product', 'inspector', ('product',)),
+               ('ix_file_level_date_product', 'file', ('data_level', 'utc_file_date', 'product_id')),
+               ('ix_file_product_date_version_key', 'file', ('product_id', 'utc_file_date', 'version_key')),
+               ('ix_code_process_version_key', 'code', ('process_id', 'version_key')))
+    """(name, table, columns) of the composite indexes the common queries need
+    beyond the ones on single columns, see :meth:`addIndexes`"""
+
+    VERSION_KEY_TABLES = ('File', 'Code')
+    """Tables with a version_key column, see :meth:`.Version.toKey`"""
+
     def __init__(self, mission='Test', db_var=None, echo=False, engine='sqlite'):
         """
         Initialize the DButils class
@@ -79,6 +161,9 @@ class DButils(object):
         if mission is None:
             raise (DBError("Must input database name to create DButils instance"))
         self.mission = mission
+        self._digestCache = None
+        self._cache = {}
+        self._filenames = None
         # Expose the format/regex routines of DBformatter
         fmtr = DBstrings.DBformatter()
         self.format = fmtr.format
@@ -89,6 +174,12 @@ class DButils(object):
             self._patchProcessQueue()
         except AttributeError:
             raise (AttributeError('{0} is not a valid database'.format(mission)))
+        self._setupCache()
+        self._setupVersionKeys()
+        sqlalchemy.event.listen(self.File, 'after_insert', self._filenameIndexAdd)
+        sqlalchemy.event.listen(self.File, 'after_update', self._filenameIndexAdd)
+        # None in a db made before there was a newest_file table
+        self._newest = self.metadata.tables.get('newest_file')
 
         self.MissionDirectory = self.getMissionDirectory()
         self.CodeDirectory = self.getCodeDirectory()
@@ -118,6 +209,8 @@ class DButils(object):
         self.Processqueue.get = self._processqueueGet
         self.Processqueue.clean = self._processqueueClean
         self.Processqueue.rawadd = self._processqueueRawadd
+        self.Processqueue.popBatch = self._processqueuePopBatch
+        self.Processqueue.drain = self._processqueueDrain
 
         # TODO to do thus cleaner and allow for [] to work on the classes
         # ...info here...
@@ -128,6 +221,65 @@ class DButils(object):
     ###### DB and Tables ###############
     ####################################
 
+    def _setupCache(self):
+        """
+        Clear the metadata cache whenever the session writes to a static table
+        """
+        self._staticClasses = tuple(getattr(self, v) for v in self.STATIC_TABLES if hasattr(self, v))
+        sqlalchemy.event.listen(self.session, 'before_flush', self._cacheBeforeFlush)
+        sqlalchemy.event.listen(self.session, 'after_bulk_update', self._cacheAfterBulk)
+        sqlalchemy.event.listen(self.session, 'after_bulk_delete', self._cacheAfterBulk)
+        sqlalchemy.event.listen(self.session, 'after_rollback', lambda session: self.clearCache())
+
+    def _setupVersionKeys(self):
+        """
+        Fill in version_key whenever a row of :attr:`VERSION_KEY_TABLES` is written,
+        a db made before there was a version_key column is left alone
+        """
+        for name in self.VERSION_KEY_TABLES:
+            cls = getattr(self, name, None)
+            if cls is not None and hasattr(cls, 'version_key'):
+                sqlalchemy.event.listen(cls, 'before_insert', self._setVersionKey)
+                sqlalchemy.event.listen(cls, 'before_update', self._setVersionKey)
+
+    @staticmethod
+    def _setVersionKey(mapper, connection, target):
+        target.version_key = Version.Version.makeKey(target.interface_version, target.quality_version,
+                                                     target.revision_version)
+
+    def _cacheBeforeFlush(self, session, flush_context, instances):
+        for obj in itertools.chain(session.new, session.dirty, session.deleted):
+            if isinstance(obj, self._staticClasses):
+                self.clearCache()
+                return
+
+    def _cacheAfterBulk(self, context):
+        if issubclass(context.mapper.class_, self._staticClasses):
+            self.clearCache()
+
+    def clearCache(self):
+        """
+        Forget all the cached metadata lookups, this is done automatically when
+        this instance writes to one of the :attr:`STATIC_TABLES`. Call it if the
+        database is changed some other way (another process or raw SQL).
+        """
+        if self._cache:
+            DBlogging.dblogger.debug("Metadata cache cleared, {0} entries".format(len(self._cache)))
+        self._cache.clear()
+
+    def _detached(self, obj):
+        """
+        Return a copy of a row that is not in the session, it stays valid when
+        a commit expires everything in the session
+        """
+        if obj is None:
+            return None
+        cls = type(obj)
+        ans = cls()
+        for prop in sqlalchemy.orm.class_mapper(cls).column_attrs:
+            setattr(ans, prop.key, getattr(obj, prop.key))
+        return ans
+
     def openDB(self, engine, db_var=None, verbose=False, echo=False):
         """
         Setup python to talk to the database, this is where it is, name and password.
@@ -388,12 +540,30 @@ class DButils(object):
         # if the input is a file name need to handle that
         if not hasattr(item, '__iter__'):
             item = [item]
-        for ii, v in enumerate(item):
-            item[ii] = self.getFileID(v)
-        sq = self.session.query(self.Processqueue).filter(self.Processqueue.file_id.in_(item))
-        for v in sq:
-            self.session.delete(v)
-        if sq and commit:
+        # the ids and names are looked up a chunk at a time, not one by one
+        ids, names = [], []
+        for v in item:
+            if isinstance(v, self.File):
+                v = v.file_id
+            try:
+                ids.append(long(v))
+            except ValueError:
+                names.append(v)
+        for chunk in Utils.chunker(names, 500):
+            found = [v for v, in self.session.query(self.File.file_id).filter(self.File.filename.in_(chunk))]
+            if len(found) != len(set(chunk)):
+                raise (DBNoData("Not all of the filenames {0} were found in the DB".format(chunk)))
+            ids.extend(found)
+        for chunk in Utils.chunker(ids, 500):
+            found = self.session.query(self.File.file_id).filter(self.File.file_id.in_(chunk)).count()
+            if found != len(set(chunk)):
+                raise (DBNoData("Not all of the file_ids {0} were found in the DB".format(chunk)))
+        n = 0
+        for chunk in Utils.chunker(ids, 500):
+            n += (self.session.query(self.Processqueue)
+                  .filter(self.Processqueue.file_id.in_(chunk))
+                  .delete(synchronize_session=False))
+        if n and commit:
             self.commitDB()
 
     def _processqueueGetAll(self, version_bump=False):
@@ -426,40 +596,26 @@ class DButils(object):
         """
         if not hasattr(fileid, '__iter__'):
             fileid = [fileid]
-        else:
-            # do this in chunks as too many entries breaks things
-            if len(fileid) > MAX_ADD:
-                outval = []
-                for v in Utils.chunker(fileid, MAX_ADD):
-                    outval.extend(self._processqueuePush(v, version_bump=version_bump))
-                return outval
-
-        # first filter() takes care of putting in values that are not in the DB.  It is silent
-        # second filter() takes care of not reading files that are already in the queue
+        pq_table = self.metadata.tables['processqueue']
         subq = self.session.query(self.Processqueue.file_id).subquery()
 
-        fileid = (self.session.query(self.File.file_id)
-                  .filter(self.File.file_id.in_(fileid))
-                  .filter(~self.File.file_id.in_(subq))).all()
-
-        fileid = list(map(itemgetter(0), fileid))  # nested tuples to list
-
-        pq = set(self.Processqueue.getAll())
-        fileid = set(fileid).difference(pq)
-
+        # do this in chunks as too many entries breaks things, it is all one transaction
         outval = []
-        objs = []
-        for f in fileid:
-            pq1 = self.Processqueue()
-            pq1.file_id = f
-            pq1.version_bump = version_bump
-            objs.append(pq1)
-            outval.append(pq1.file_id)
-        DBlogging.dblogger.debug("File added to process queue {0}:{1}".format(fileid, '---'))
-        if fileid:
-            self.session.add_all(objs)
+        for chunk in Utils.chunker(list(fileid), MAX_ADD):
+            # first filter() takes care of putting in values that are not in the DB.  It is silent
+            # second filter() takes care of not reading files that are already in the queue,
+            #   this includes the ones added by the chunks before
+            new = (self.session.query(self.File.file_id)
+                   .filter(self.File.file_id.in_(chunk))
+                   .filter(~self.File.file_id.in_(subq))).all()
+            new = list(map(itemgetter(0), new))  # nested tuples to list
+            if new:
+                self.session.execute(pq_table.insert(),
+                                     [{'file_id': f, 'version_bump': version_bump} for f in new])
+                outval.extend(new)
+        DBlogging.dblogger.debug("File added to process queue {0}:{1}".format(outval, '---'))
+        if outval:
             self.commitDB()
-        #        pqid = self.session.query(self.Processqueue.file_id).all()
         return outval
 
     def _processqueueRawadd(self, fileid, version_bump=None, commit=True):
@@ -479,27 +635,19 @@ class DButils(object):
         num : int
             the number of entries added to the processqueue
         """
-        current_q = set(self._processqueueGetAll())
-
         if not hasattr(fileid, '__iter__'):
             fileid = [fileid]
 
-        fileid = set(fileid)
-        # drop all the values in the current_q from fileid
-        files_to_add = fileid.difference(current_q)
-
-        # are there any left?
-        if len(files_to_add) != 0:
-            for f in files_to_add:
-                pq1 = self.Processqueue()
-                pq1.file_id = f
-                pq1.version_bump = version_bump
-                self.session.add(pq1)
-                DBlogging.dblogger.debug("File added to process queue {0}:{1}".format(fileid, '---'))
-                
-            if commit:
-                self.commitDB()  # commit once for all the adds
-        return len(files_to_add)
+        # the ids already in the queue are skipped by the db
+        pq_table = self.metadata.tables['processqueue']
+        rows = [{'file_id': f, 'version_bump': version_bump} for f in set(fileid)]
+        if not rows:
+            return 0
+        added = self.session.execute(pq_table.insert().prefix_with('OR IGNORE'), rows).rowcount
+        DBlogging.dblogger.debug("Files added to process queue {0}".format(added))
+        if commit:
+            self.commitDB()  # commit once for all the adds
+        return added
 
     def _processqueueLen(self):
         """
@@ -527,6 +675,91 @@ class DButils(object):
         self.commitDB()
         return (val.file_id, val.version_bump)
 
+    def _processqueueHead(self, n=None):
+        """
+        Read up to n entries at the head of the process queue, in the order of
+        :meth:`_processqueueOrdered`, without taking them off
+
+        Other Parameters
+        ================
+        n : int
+            the number of entries to read, None for all of them
+
+        Returns
+        =======
+        entries : list
+            (file_id, version_bump) of each entry
+        """
+        sq = self._processqueueOrdered(self.Processqueue.file_id, self.Processqueue.version_bump)
+        if n is not None:
+            sq = sq.limit(n)
+        ans = [tuple(v) for v in sq]
+        if n is None or len(ans) < n:
+            # entries of files not in the db are not in the order, they come last
+            sq = self.session.query(self.Processqueue.file_id, self.Processqueue.version_bump) \
+                .filter(~sqlalchemy.exists().where(self.File.file_id == self.Processqueue.file_id))
+            if n is not None:
+                sq = sq.limit(n - len(ans))
+            ans.extend(tuple(v) for v in sq)
+        return ans
+
+    def _processqueueDelete(self, entries):
+        """
+        Take entries read by :meth:`_processqueueHead` off the process queue
+        with one commit, anything added since they were read stays
+        """
+        for chunk in Utils.chunker(entries, 500):
+            (self.session.query(self.Processqueue)
+             .filter(self.Processqueue.file_id.in_(list(map(itemgetter(0), chunk))))
+             .delete(synchronize_session=False))
+        if entries:
+            self.commitDB()
+        DBlogging.dblogger.debug("Popped {0} entries from the Processqueue".format(len(entries)))
+
+    def _processqueuePopBatch(self, n=None):
+        """
+        pop up to n files off the process queue (from the left) with one commit,
+        in the order of :meth:`_processqueueOrdered`
+
+        Other Parameters
+        ================
+        n : int
+            the number of files to pop, None for all of them
+
+        Returns
+        =======
+        entries : list
+            (file_id, version_bump) of each file popped from the queue
+        """
+        ans = self._processqueueHead(n)
+        self._processqueueDelete(ans)
+        return ans
+
+    def _processqueueDrain(self, chunk=10000):
+        """
+        take everything off the process queue, chunk files at a time
+
+        A chunk is only taken off the queue (and committed) when the next one
+        is asked for, so if the caller fails on a chunk, or stops before asking
+        for the next one, the entries in it stay on the queue.
+
+        Other Parameters
+        ================
+        chunk : int
+            the number of files taken off (and committed) at once
+
+        Returns
+        =======
+        entries : generator
+            lists of (file_id, version_bump) from the queue until it is empty
+        """
+        while True:
+            ans = self._processqueueHead(chunk)
+            if not ans:
+                return
+            yield ans
+            self._processqueueDelete(ans)
+
     def _processqueueGet(self, index=0, instance=False):
         """
         Get the file at the head of the queue (from the left)
@@ -539,7 +772,9 @@ class DButils(object):
         if index < 0:  # enable the python from the end indexing
             index = self.Processqueue.len() + index
 
-        sq = self.session.query(self.Processqueue).offset(index).first()
+        sq = self._processqueueOrdered(self.Processqueue).offset(index).first()
+        if sq is None:  # only entries whose file is not in the db (or none at all)
+            sq = self.session.query(self.Processqueue).offset(index - self._processqueueOrdered(self.Processqueue).count()).first()
         if instance:
             ans = sq
         else:
@@ -549,90 +784,59 @@ class DButils(object):
     def _processqueueClean(self, dryrun=False):
         """
         go through the process queue and clear out lower versions of the same files
-        this is determined by product and utc_file_date
-        also sorts by level, date
-        """
-
-        # BAL 30 March 2017 Trying a different method here that might be cleaner
-
-        # # TODO this might break with weekly input files
-        # DBlogging.dblogger.debug("Entering _processqueueClean(), there are {0} entries".format(self.Processqueue.len()))
-        # pqdata = self.Processqueue.getAll(version_bump=True)
-        #
-        # file_ids = list(map(itemgetter(0), pqdata))
-        # version_bumps = list(map(itemgetter(1), pqdata))
-        #
-        # # speed this up using a sql in_ call not looping over getEntry for each one
-        # # this gets all the file objects for the processqueue file_ids
-        # subq = self.session.query(self.Processqueue.file_id).subquery()
-        # file_entries = self.session.query(self.File).filter(self.File.file_id.in_(subq)).all()
-        #
-        # file_entries2 = self.file_id_Clean(file_entries)
-        #
-        # # ==============================================================================
-        # #         # sort keep on dates, then sort keep on level
-        # # ==============================================================================
-        # # this should make them in order for each level
-        # file_entries2 = sorted(file_entries2, key=lambda x: x.utc_file_date, reverse=1)
-        # file_entries2 = sorted(file_entries2, key=lambda x: x.data_level)
-        # # apply same sort/filter to version_bumps
-        # version_bumps2 = (version_bumps[file_entries.index(v)] for v in file_entries2)
-        #
-        # file_entries2 = [val.file_id for val in file_entries2]
-        # mixed_entries = itertools.izip(file_entries2, version_bumps2)
-        #
-        # ## now we have a list of just the newest file_id's
-        # if not dryrun:
-        #     self.Processqueue.flush()
-        #     #        self.Processqueue.push(ans)
-        #     if not any(version_bumps2):
-        #         self.Processqueue.push(file_entries2)
-        #     else:
-        #         itertools.starmap(self.Processqueue.push, mixed_entries)
-        #     #                for v in mixed_entries:
-        #     #                    itertools.startmap(self.Processqueue.push, v)
-        # else:
-        #     print(
-        #         '<dryrun> Queue cleaned leaving {0} of {1} entries'.format(len(file_entries2), self.Processqueue.len()))
-        #
-        # DBlogging.dblogger.debug(
-        #     "Done in _processqueueClean(), there are {0} entries left".format(self.Processqueue.len()))
-
-        # # BAL 30 March 2017 new version
-        # # get all the files from the process queue
+        this is determined by product and utc_file_date, entries with a version_bump
+        (or whose file has no utc_file_date) are kept. Entries of files that are
+        no longer in the db are removed too.
+
+        This is one DELETE in the db rather than a check of each entry
+        """
         DBlogging.dblogger.debug("Entering _processqueueClean(), there are {0} entries".format(self.Processqueue.len()))
-        pqdata = self.Processqueue.getAll(version_bump=True)
-        # all we need to do is look at each file and see if it is latest version or not, if it is not drop it
-        entries = []
-        version_bump = False
-        for i, pq in enumerate(pqdata):
-            # print(i, len(pqdata))
-            if pq[1] is not None:
-                entries.append(pq)  # if the version_bump is these it needs to stay in the queue
-                version_bump = True
-            else:
-                if self.fileIsNewest(pq[0]):
-                    entries.append(pq)  # if the file is newest_version than we keep it
+        pq = self.metadata.tables['processqueue']
+        f = self.metadata.tables['file']
+        orphan = ~sqlalchemy.exists().where(f.c.file_id == pq.c.file_id)
+        if self._newest is not None:
+            # files with no utc_file_date have no newest_file row and are never superseded
+            superseded = and_(~pq.c.file_id.in_(sqlalchemy.select([self._newest.c.file_id])),
+                              sqlalchemy.exists().where(and_(f.c.file_id == pq.c.file_id,
+                                                             f.c.utc_file_date != None)))
+        else:
+            # there is a newer file of the same product and date (see _newestOrder)
+            g = f.alias()
+            fkey, gkey = self._fileVersionKey(f), self._fileVersionKey(g)
+            superseded = sqlalchemy.exists().where(and_(
+                f.c.file_id == pq.c.file_id,
+                sqlalchemy.exists().where(and_(
+                    g.c.product_id == f.c.product_id, g.c.utc_file_date == f.c.utc_file_date,
+                    or_(gkey > fkey, and_(gkey == fkey, g.c.file_id > f.c.file_id))))))
+        where = or_(orphan, and_(pq.c.version_bump == None, superseded))
         if not dryrun:
-            self.Processqueue.flush()
-            if not version_bump:
-                self.Processqueue.rawadd(zip(*entries)[0])
-            else:
-                for f in pqdata:
-                    self.Processqueue.add(f)
+            n = self.session.execute(pq.delete().where(where)).rowcount
+            self.commitDB()
+            DBlogging.dblogger.debug(
+                "Done in _processqueueClean(), removed {0}, there are {1} entries left".format(
+                    n, self.Processqueue.len()))
         else:
-            print(
-                '<dryrun> Queue cleaned leaving {0} of {1} entries'.format(len(file_entries2), self.Processqueue.len()))
-        DBlogging.dblogger.debug(
-            "Done in _processqueueClean(), there are {0} entries left".format(self.Processqueue.len()))
+            n = self.session.execute(sqlalchemy.select([func.count()]).select_from(pq).where(where)).scalar()
+            total = self.Processqueue.len()
+            print('<dryrun> Queue cleaned leaving {0} of {1} entries'.format(total - n, total))
 
+    def _processqueueOrdered(self, *entities):
+        """
+        Query of the processqueue in the order it is processed, by data_level,
+        utc_file_date and product_id of the files (ix_file_level_date_product).
+        Entries whose file is not in the db are left out.
+        """
+        return self.session.query(*entities) \
+            .join(self.File, self.File.file_id == self.Processqueue.file_id) \
+            .order_by(self.File.data_level, self.File.utc_file_date, self.File.product_id, self.File.file_id)
 
     def fileIsNewest(self, filename, debug=False):
         """
         quesry the database, is this filename or file_id newest version?
 
         @param filename: filename or file_id
-        @return: Ture is file is lastest_version, False is not
+        @return: Ture is file is lastest_version, False is not (a file with no
+                 utc_file_date is always newest)
         """
         file = self.getEntry('File', filename)
         product_id = file.product_id
@@ -641,6 +845,14 @@ class DButils(object):
         if debug: print('date', date)
         file_id = file.file_id
         if debug: print('file_id', file_id, file.filename)
+        if date is None: # nothing to be newer than, same as _processqueueClean
+            return True
+        if self._newest is not None:
+            nf = self._newest
+            latest_id = self.session.query(nf.c.file_id).filter(
+                and_(nf.c.product_id == product_id, nf.c.utc_file_date == date)).scalar()
+            if debug: print('latest_id', latest_id)
+            return file_id == latest_id
         latest = self.getFilesByProductDate(product_id, [date]*2, newest_version=True)
         if len(latest) > 1:
             raise(DBError("More than one latest for a product date"))
@@ -662,6 +874,7 @@ class DButils(object):
         if not hasattr(filename, '__iter__'):  # if not an iterable make it a iterable
             filename = [filename]
 
+        newest = set()  # (product_id, utc_file_date) whose newest file may be gone
         for ii, f in enumerate(filename):
             if not trust_id:
                 try:
@@ -696,12 +909,15 @@ class DButils(object):
                 pass
 
             try:  ## file
-                self.session.delete(self.getEntry('File', f))
+                entry = self.getEntry('File', f)
+                newest.add((entry.product_id, entry.utc_file_date))
+                self.session.delete(entry)
             except DBNoData:
                 pass
 
             DBlogging.dblogger.info("File removed from db {0}".format(f))
 
+        self._updateNewestFiles(newest)
         if commit:
             self.commitDB()
 
@@ -712,10 +928,9 @@ class DButils(object):
         :return: dictionaries of satellite, mission objects
         :rtype: dict
         """
-        ans = []
         sats = self.session.query(self.Satellite).all()
-        ans = map(lambda x: self.getTraceback('Satellite', x.satellite_id), sats)
-        return ans
+        tbs = self.getTracebacks('Satellite', [x.satellite_id for x in sats])
+        return [tbs[x.satellite_id] for x in sats]
 
     def getAllInstruments(self):
         """
@@ -724,22 +939,20 @@ class DButils(object):
         :return: dictionaries of instrument traceback dictionaries
         :rtype: dict
         """
-        ans = []
         insts = self.session.query(self.Instrument).all()
-        ans = map(lambda x: self.getTraceback('Instrument', x.instrument_id), insts)
-        return ans
+        tbs = self.getTracebacks('Instrument', [x.instrument_id for x in insts])
+        return [tbs[x.instrument_id] for x in insts]
 
     def getAllCodes(self, active=True):
         """
         Return a list of all codes
         """
-        ans = []
         if active:
             codes = self.session.query(self.Code).filter(and_(self.Code.newest_version, self.Code.active_code)).all()
         else:
             codes = self.session.query(self.Code).all()
-        ans = map(lambda x: self.getTraceback('Code', x.code_id), codes)
-        return ans
+        tbs = self.getTracebacks('Code', [x.code_id for x in codes])
+        return [tbs[x.code_id] for x in codes]
 
     def getAllFilenames(self,
                         fullPath=True,
@@ -767,10 +980,8 @@ class DButils(object):
         files = self.getFiles(startDate, endDate, level, product, code, instrument, exists, newest_version, limit)
 
         if fullPath:
-            # Get file_id instead, saves time since getFileFullPath gets the ID anyway
-            names = [d.file_id for d in files]
-            # This is probobly slow, but hopfully not slow enough to be an issue
-            return map(self.getFileFullPath, names)
+            paths = self.getFileFullPaths([d.file_id for d in files])
+            return [paths[d.file_id] for d in files]
         else:
             return [d.filename for d in files]
 
@@ -780,7 +991,8 @@ class DButils(object):
                    incoming_dir,
                    codedir,
                    inspectordir,
-                   errordir):
+                   errordir,
+                   stagingdir=None):
         """
         Add a mission to the database
 
@@ -788,6 +1000,10 @@ class DButils(object):
         :type mission_name: str
         :param rootdir: the root directory of the mission
         :type rootdir: str
+        :keyword stagingdir: where processes write their output (see
+                             :meth:`getStagingPath`), only kept if the db
+                             has the column
+        :type stagingdir: str
 
         """
         mission_name = str(mission_name)
@@ -806,6 +1022,8 @@ class DButils(object):
         if hasattr(m1, 'newest_version'):
             # Old DBs will not have this, new ones will
             m1.errordir = errordir
+        if stagingdir and hasattr(m1, 'stagingdir'):
+            m1.stagingdir = stagingdir.replace('{MISSION}', mission_name)
 
         self.session.add(m1)
         self.commitDB()
@@ -965,7 +1183,8 @@ class DButils(object):
 
     def addFilecodelink(self,
                         resulting_file_id,
-                        source_code):
+                        source_code,
+                        commit=True):
         """
         Add a file code  link to the database
 
@@ -973,12 +1192,15 @@ class DButils(object):
         :type resulting_file_id: int
         :param source_code: id of the code
         :type source_code: int
+        :keyword commit: commit the link, if False it is committed with the next commit
+        :type commit: bool
         """
         fcl1 = self.Filecodelink()
         fcl1.resulting_file = resulting_file_id
         fcl1.source_code = source_code
         self.session.add(fcl1)
-        self.commitDB()
+        if commit:
+            self.commitDB()
         return fcl1.resulting_file, fcl1.source_code
 
     def delInspector(self, i):
@@ -1050,7 +1272,8 @@ class DButils(object):
 
     def addFilefilelink(self,
                         resulting_file_id,
-                        source_file, ):
+                        source_file,
+                        commit=True):
         """
         Add a file file  link to the database
 
@@ -1058,13 +1281,16 @@ class DButils(object):
         :type source_file: int
         :param resulting_file_id: id of the process to link
         :type resulting_file_id: int
+        :keyword commit: commit the link, if False it is committed with the next commit
+        :type commit: bool
 
         """
         ffl1 = self.Filefilelink()
         ffl1.source_file = source_file
         ffl1.resulting_file = resulting_file_id
         self.session.add(ffl1)
-        self.commitDB()
+        if commit:
+            self.commitDB()
         return ffl1.source_file, ffl1.resulting_file
 
     def addInstrumentproductlink(self,
@@ -1376,6 +1602,9 @@ class DButils(object):
             return
         try:
             self.session.close()
+            if self._digestCache is not None:
+                self._digestCache.close()
+                self._digestCache = None
             self.dbIsOpen = False
             DBlogging.dblogger.info("Database connection closed")
         except DBError:
@@ -1400,7 +1629,8 @@ class DButils(object):
                 product_id=None,
                 shasum=None,
                 process_keywords=None,
-                quality_checked=None):
+                quality_checked=None,
+                commit=True):
         """
         Add a datafile to the database
 
@@ -1435,10 +1665,51 @@ class DButils(object):
         :type met_start_time: long
         :keyword met_stop_time: met stop time of the file
         :type met_stop_time: long
+        :keyword commit: commit the file, if False the file is only flushed to
+                         get its file_id and is committed with the next commit
+        :type commit: bool
 
         :return: file_id of the newly inserted file
         :rtype: long
         """
+        d1 = self._fileRow(filename=filename,
+                           data_level=data_level,
+                           version=version,
+                           file_create_date=file_create_date,
+                           exists_on_disk=exists_on_disk,
+                           utc_file_date=utc_file_date,
+                           utc_start_time=utc_start_time,
+                           utc_stop_time=utc_stop_time,
+                           check_date=check_date,
+                           verbose_provenance=verbose_provenance,
+                           quality_comment=quality_comment,
+                           caveats=caveats,
+                           met_start_time=met_start_time,
+                           met_stop_time=met_stop_time,
+                           product_id=product_id,
+                           shasum=shasum,
+                           process_keywords=process_keywords,
+                           quality_checked=quality_checked)
+        self.session.add(d1)
+        try:
+            self.session.flush()
+            self._updateNewestFiles([(d1.product_id, d1.utc_file_date)])
+        except IntegrityError as IE:
+            self.session.rollback()
+            raise (DBError(IE))
+        if commit:
+            self.commitDB()
+        return d1.file_id
+
+    def _fileRow(self, filename=None, data_level=None, version=None,
+                 file_create_date=None, exists_on_disk=None, utc_file_date=None,
+                 utc_start_time=None, utc_stop_time=None, check_date=None,
+                 verbose_provenance=None, quality_comment=None, caveats=None,
+                 met_start_time=None, met_stop_time=None, product_id=None,
+                 shasum=None, process_keywords=None, quality_checked=None):
+        """
+        Make (but do not add) the File row for :meth:`addFile` and :meth:`addFiles`
+        """
         d1 = self.File()
         d1.filename = filename
         d1.utc_file_date = utc_file_date
@@ -1464,10 +1735,162 @@ class DButils(object):
         if hasattr(d1, 'newest_version'):
             # This field is no longer used, but old databases may still have it.
             d1.newest_version = False
+        return d1
 
-        self.session.add(d1)
+    def addFiles(self, files, processqueue=False, links=None):
+        """
+        Add many datafiles to the database in one transaction
+
+        Each file is added as :meth:`addFile` would but there is only one
+        commit for all of them, on SQLite every commit is a sync to disk. If
+        the transaction fails the files are added again one at a time so only
+        the files that are bad are left out.
+
+        :param files: keywords to :meth:`addFile` for each file
+        :type files: list of dict
+        :keyword processqueue: also put each file on the processqueue
+        :type processqueue: bool
+        :keyword links: for each file None or (code_id, input file_ids), the
+                        filecodelink and filefilelinks to add with the file
+        :type links: list
+
+        :return: file_id of each file, None for the files that were not added
+        :rtype: list
+        """
+        files = list(files)
+        if links is None:
+            links = [None] * len(files)
+        if len(files) != len(links):
+            raise (ValueError("There must be links for each file"))
+        if not files:
+            return []
+        try:
+            rows = [self._fileRow(**f) for f in files]
+            self.session.add_all(rows)
+            self.session.flush()
+            self._updateNewestFiles((d1.product_id, d1.utc_file_date) for d1 in rows)
+            for d1, link in zip(rows, links):
+                if processqueue:
+                    pq1 = self.Processqueue()
+                    pq1.file_id = d1.file_id
+                    pq1.version_bump = None
+                    self.session.add(pq1)
+                if link is not None:
+                    code_id, input_files = link
+                    self.addFilecodelink(d1.file_id, code_id, commit=False)
+                    for val in input_files:
+                        self.addFilefilelink(d1.file_id, val, commit=False)
+            self.session.commit()
+        except (IntegrityError, ValueError) as errmsg:
+            self.session.rollback()
+            if len(files) == 1:
+                DBlogging.dblogger.warning("File {0} not added to the db: {1}".format(
+                    files[0].get('filename'), errmsg))
+                return [None]
+            DBlogging.dblogger.info("Adding {0} files in one transaction failed, adding one at a time".format(len(files)))
+            return [self.addFiles([f], processqueue=processqueue, links=[link])[0]
+                    for f, link in zip(files, links)]
+        DBlogging.dblogger.debug("Added {0} files to the db in one transaction".format(len(rows)))
+        return [d1.file_id for d1 in rows]
+
+    def _newestOrder(self, table):
+        """
+        Order by of the files of a (product_id, utc_file_date) newest first,
+        the newest version and of those the last added
+        """
+        if 'version_key' in table.c:
+            return (table.c.version_key.desc(), table.c.file_id.desc())
+        return (table.c.interface_version.desc(), table.c.quality_version.desc(),
+                table.c.revision_version.desc(), table.c.file_id.desc())
+
+    def _updateNewestFiles(self, keys):
+        """
+        Point newest_file at the newest version file of each (product_id, utc_file_date)
+        in keys, in the current transaction (the caller commits)
+
+        Does nothing on a db without a newest_file table.
+        """
+        if self._newest is None:
+            return
+        nf = self._newest
+        file_table = self.metadata.tables['file']
+        self.session.flush()
+        connection = self.session.connection()
+        for product_id, utc_file_date in set((k[0], Utils.datetimeToDate(k[1])) for k in keys):
+            if utc_file_date is None:
+                continue
+            where = and_(nf.c.product_id == product_id, nf.c.utc_file_date == utc_file_date)
+            newest = connection.execute(
+                sqlalchemy.select([file_table.c.file_id])
+                .where(and_(file_table.c.product_id == product_id,
+                            file_table.c.utc_file_date == utc_file_date))
+                .order_by(*self._newestOrder(file_table)).limit(1)).scalar()
+            current = connection.execute(sqlalchemy.select([nf.c.file_id]).where(where)).scalar()
+            if newest == current:
+                continue
+            if current is not None:
+                connection.execute(nf.delete().where(where))
+            if newest is not None:
+                connection.execute(nf.insert(), product_id=product_id,
+                                   utc_file_date=utc_file_date, file_id=newest)
+
+    def _newestFileSelect(self):
+        """
+        select of (product_id, utc_file_date, file_id) of the newest version
+        file for every (product_id, utc_file_date) worked out from the file table
+        """
+        f = self.metadata.tables['file']
+        g = f.alias()
+        newest = sqlalchemy.select([g.c.file_id]) \
+            .where(and_(g.c.product_id == f.c.product_id, g.c.utc_file_date == f.c.utc_file_date)) \
+            .order_by(*self._newestOrder(g)).limit(1).as_scalar()
+        return sqlalchemy.select([f.c.product_id, f.c.utc_file_date, f.c.file_id]) \
+            .where(and_(f.c.utc_file_date != None, f.c.file_id == newest))
+
+    def rebuildNewestFiles(self):
+        """
+        Fill the newest_file table from the file table, making the table first
+        if the db does not have it (the migration for older dbs)
+
+        :return: number of (product_id, utc_file_date) in the table
+        :rtype: int
+        """
+        connection = self.session.connection()
+        if self._newest is None:
+            DBlogging.dblogger.info("Adding table newest_file")
+            self._newest = newestFileTable(self.metadata)
+            self._newest.create(connection)
+        connection.execute(self._newest.delete())
+        connection.execute(self._newest.insert().from_select(['product_id', 'utc_file_date', 'file_id'],
+                                                             self._newestFileSelect()))
         self.commitDB()
-        return d1.file_id
+        n = self.session.query(func.count()).select_from(self._newest).scalar()
+        DBlogging.dblogger.info("Rebuilt newest_file, {0} entries".format(n))
+        return n
+
+    def verifyNewestFiles(self, fix=False):
+        """
+        Check the newest_file table against the file table
+
+        :keyword fix: Correct the entries that are wrong
+        :type fix: bool
+
+        :return: (product_id, utc_file_date, file_id in newest_file, newest file_id)
+                 of each entry that is wrong, None for a missing file_id
+        :rtype: list
+        """
+        if self._newest is None:
+            raise (DBError("The db has no newest_file table, use rebuildNewestFiles"))
+        nf = self._newest
+        should = dict(((v[0], v[1]), v[2]) for v in self.session.execute(self._newestFileSelect()))
+        has = dict(((v[0], v[1]), v[2])
+                   for v in self.session.query(nf.c.product_id, nf.c.utc_file_date, nf.c.file_id))
+        bad = sorted((k[0], k[1], has.get(k), should.get(k))
+                     for k in set(should).union(has) if has.get(k) != should.get(k))
+        if fix and bad:
+            self._updateNewestFiles([v[:2] for v in bad])
+            self.commitDB()
+        return bad
 
     def codeIsActive(self, ec_id, date):
         """
@@ -1505,20 +1928,84 @@ class DButils(object):
         Return the full path to a file Given the name or id
         (name or id is based on type)
 
-        TODO, this is really slow, this query made it a lot faster but I bet it can get better
-
+        For many files use :meth:`getFileFullPaths`
         """
         if isinstance(filename, (str, unicode)):
             filename = self.getFileID(filename)
-        sq = self.session.query(self.File.filename, self.Product.relative_path).filter(
-            self.File.file_id == filename).join((self.Product, self.File.product_id == self.Product.product_id)).one()
-        path = os.path.join(self.MissionDirectory, *sq[::-1])
+        return self.getFileFullPaths([filename])[filename]
+
+    def getFileFullPaths(self, file_ids):
+        """
+        Return the full path to many files with a query per 500 files
+
+        :param file_ids: ids of the files
+        :type file_ids: iterable of int
+
+        :return: full path of each file keyed by file_id
+        :rtype: dict
+        :raises DBNoData: if a file_id is not in the db
+        """
+        file_ids = set(file_ids)
+        ans = dict(self.iterFileFullPaths(file_ids))
+        missing = file_ids.difference(ans)
+        if missing:
+            raise (DBNoData("No file_id {0} found in the DB".format(', '.join(str(v) for v in sorted(missing)))))
+        return ans
+
+    def iterFileFullPaths(self, file_ids=None, chunk=1000):
+        """
+        Generator of (file_id, full path) for files in the db, for scanning
+        the whole archive without making all the paths at once
+
+        The directory of each product is worked out once, only a product whose
+        relative_path has date or version fields has them filled in per file.
+
+        :keyword file_ids: ids of the files, None for every file in the db
+        :type file_ids: iterable of int
+        :keyword chunk: number of rows read from the db at a time
+        :type chunk: int
+        """
+        sq = self.session.query(self.File.file_id, self.File.filename, self.File.product_id,
+                                self.File.utc_file_date, self.File.utc_start_time,
+                                self.File.interface_version, self.File.quality_version,
+                                self.File.revision_version)
+        if file_ids is None:
+            queries = [sq.yield_per(chunk)]
+        else:
+            queries = (sq.filter(self.File.file_id.in_(v))
+                       for v in Utils.chunker(list(file_ids), 500))
+        templates = {}
+        for query in queries:
+            for f_id, filename, product_id, utc_file_date, utc_start_time, iv, qv, rv in query:
+                if product_id not in templates:
+                    templates[product_id] = self._getProductPath(product_id)
+                path = templates[product_id]
+                if '{' in path:
+                    path = Utils.dirSubs(path, filename, utc_file_date, utc_start_time,
+                                         Version.Version(iv, qv, rv))
+                yield f_id, os.path.join(path, filename)
+
+    @_cachedMetadata
+    def _getProductPath(self, product_id):
+        """
+        Return the directory of the files of a product with the substitutions
+        that only depend on the product done, the date and version ones are
+        left for :func:`.Utils.dirSubs`
+        """
+        path = os.path.join(self.MissionDirectory,
+                            self.getEntry('Product', product_id, cached=True).relative_path)
         if '{' in path:
-            file_entry = self.getEntry('File', filename)
-            path = Utils.dirSubs(path, file_entry.filename, file_entry.utc_file_date, file_entry.utc_start_time,
-                                 self.getFileVersion(file_entry.file_id))
+            subs = ('{INSTRUMENT}', '{SATELLITE}', '{SPACECRAFT}', '{MISSION}', '{PRODUCT}')
+            if any(v in path for v in subs):
+                ptb = self.getTraceback('Product', product_id)
+                vals = (ptb['instrument'].instrument_name, ptb['satellite'].satellite_name,
+                        ptb['satellite'].satellite_name, ptb['mission'].mission_name,
+                        ptb['product'].product_name)
+                for sub, val in zip(subs, vals):
+                    path = path.replace(sub, val)
         return path
 
+    @_cachedMetadata
     def getProcessFromInputProduct(self, product):
         """
         Given a product id return all the processes that use that as an input
@@ -1529,6 +2016,7 @@ class DButils(object):
         sq = self.session.query(self.Productprocesslink.process_id).filter_by(input_product_id=product).all()
         return map(itemgetter(0), sq)
 
+    @_cachedMetadata
     def getProcessFromOutputProduct(self, outProd):
         """
         Gets process from the db that have the output product
@@ -1607,6 +2095,63 @@ class DButils(object):
         self.session.add(f)
         self.commitDB()
 
+    def fileInDB(self, filename):
+        """
+        Return the file_id of filename if it is in the db, the check is against
+        an in memory index of the filenames so a name that is not in the db
+        does not need a query (only a name that is, or one with the same hash)
+
+        The index is read from the db the first time it is needed and files
+        added (or renamed) by this instance are added to it, if another process
+        adds files call :meth:`resetFilenameIndex`
+
+        :param filename: filename to look for
+        :type filename: str
+
+        :return: file_id of the file, None if it is not in the db
+        :rtype: long
+        """
+        if self._filenames is None:
+            self._buildFilenameIndex()
+        hashes, new = self._filenames
+        h = _filenameHash(filename)
+        if h not in new:
+            i = bisect.bisect_left(hashes, h)
+            if i == len(hashes) or hashes[i] != h:
+                return None
+        sq = self.session.query(self.File.file_id).filter_by(filename=filename).first()
+        return None if sq is None else sq.file_id
+
+    def resetFilenameIndex(self):
+        """
+        Forget the filename index of :meth:`fileInDB`, it is read again from
+        the db when it is next needed
+        """
+        self._filenames = None
+
+    def _buildFilenameIndex(self):
+        """
+        Read the filenames of the db into the index used by :meth:`fileInDB`, a
+        sorted array of their hashes (4 bytes a file) and a set of the hashes
+        added since
+        """
+        hashes = sorted(_filenameHash(v)
+                        for v, in self.session.query(self.File.filename).yield_per(10000))
+        self._filenames = (array.array('I', hashes), set())
+        DBlogging.dblogger.debug("Filename index built for {0} files".format(len(hashes)))
+
+    def _filenameIndexAdd(self, mapper, connection, target):
+        """
+        Add a file that was just written to the filename index, the added ones
+        are merged into the sorted array once there are many of them
+        """
+        if self._filenames is None:
+            return
+        hashes, new = self._filenames
+        new.add(_filenameHash(target.filename))
+        if len(new) > max(10000, len(hashes) // 8):
+            self._filenames = (array.array('I', sorted(itertools.chain(hashes, new))), set())
+
     def getFileID(self, filename):
         """
         Return the fileID for the input filename
@@ -1683,6 +2228,7 @@ class DButils(object):
                        for v in self.getFilesByProductDate(fe.product_id, [fe.utc_file_date] * 2, newest_version=True))
         return list(newest.intersection(invals))
 
+    @_cachedMetadata
     def getInputProductID(self, process_id, range=False):
         """
         Return the fileID for the input filename
@@ -1740,8 +2286,19 @@ class DButils(object):
             # I.E, they changed atleast one of the date parameters from "all"
             files = files.filter(self.File.utc_file_date.between(startDate, endDate))
 
-        if newest_version:
-            files = files.order_by(self.File.interface_version, self.File.quality_version, self.File.revision_version)
+        if newest_version and self._newest is not None and code is None and exists is None:
+            nf = self._newest
+            files = files.join(nf, nf.c.file_id == self.File.file_id)
+            if product is not None:
+                files = files.filter(nf.c.product_id == product)
+            return files.limit(limit).all()
+        elif newest_version:
+            # in the order of an index on product, date and version so the db need not sort
+            if hasattr(self.File, 'version_key'):
+                files = files.order_by(self.File.product_id, self.File.utc_file_date, self.File.version_key)
+            else:
+                files = files.order_by(self.File.product_id, self.File.utc_file_date, self.File.interface_version,
+                                       self.File.quality_version, self.File.revision_version)
             x = files.limit(limit).all()
             
             # Last item wins. https://stackoverflow.com/questions/39678672/is-a-python-dict-comprehension-always-last-wins-if-there-are-duplicate-keys
@@ -1759,6 +2316,59 @@ class DButils(object):
                              product=product_id,
                              newest_version=newest_version)
 
+    def _fileVersionKey(self, table=None):
+        """
+        SQL expression of the file version as one integer that sorts like the version,
+        interface<<32 | quality<<16 | revision (:meth:`.Version.toKey`), the
+        version_key column if the db has it
+
+        :keyword table: the file table (or an alias of it) to use instead of the File class
+        """
+        cols = self.File if table is None else table.c
+        if hasattr(cols, 'version_key'):
+            return cols.version_key
+        return (cols.interface_version * 4294967296 +
+                cols.quality_version * 65536 +
+                cols.revision_version)
+
+    def getNewestFiles(self, windows):
+        """
+        Return the newest version files for many products and dates at once
+
+        This is the set based version of getFilesByProductDate(..., newest_version=True),
+        the newest version for each date is looked up in the newest_file table (or
+        picked with a GROUP BY in a db without one) instead of loading every version
+        and sorting them in python.
+
+        :param windows: the dates wanted for each product
+        :type windows: dict of product_id: iterable of datetime.date
+
+        :return: the newest file for each (product_id, utc_file_date) that has one
+        :rtype: dict
+        """
+        ans = {}
+        key = self._fileVersionKey()
+        nf = self._newest
+        for product_id in windows:
+            dates = sorted(set(Utils.datetimeToDate(v) for v in windows[product_id]))
+            for chunk in Utils.chunker(dates, 500):
+                if nf is not None:  # point lookups in newest_file
+                    files = self.session.query(self.File).join(nf, nf.c.file_id == self.File.file_id) \
+                        .filter(nf.c.product_id == product_id) \
+                        .filter(nf.c.utc_file_date.in_(chunk))
+                else:
+                    newest = self.session.query(self.File.utc_file_date, func.max(key).label('version_key')) \
+                        .filter(self.File.product_id == product_id) \
+                        .filter(self.File.utc_file_date.in_(chunk)) \
+                        .group_by(self.File.utc_file_date).subquery()
+                    files = self.session.query(self.File) \
+                        .join(newest, and_(self.File.utc_file_date == newest.c.utc_file_date,
+                                           key == newest.c.version_key)) \
+                        .filter(self.File.product_id == product_id)
+                for f in files:
+                    ans[(product_id, f.utc_file_date)] = f
+        return ans
+
     def getFilesByDate(self, daterange, newest_version=False):
         """
         Return the files in the db that have data in the date specified
@@ -1816,6 +2426,7 @@ class DButils(object):
 
         return map(attrgetter('file_id'), files)  # this is faster than a list comprehension
 
+    @_cachedMetadata
     def getActiveInspectors(self):
         """
         Query the db and return a list of all the active inspector file names [(filename, description, arguments, product), ...]
@@ -1835,6 +2446,7 @@ class DButils(object):
         # get all the process ids that have this product as an input
         return self.getProcessFromInputProduct(product_id)
 
+    @_cachedMetadata
     def getProductID(self, product_name):
         """
         Return the product ID for an input product name
@@ -1886,7 +2498,7 @@ class DButils(object):
         """
         Given a code_id list return the full name (path and all) of the code
         """
-        code = self.getEntry('Code', code_id)
+        code = self.getEntry('Code', code_id, cached=True)
         if not code.active_code:  # not an active code
             return None
         return os.path.join(self.CodeDirectory, code.relative_path, code.filename)
@@ -1895,7 +2507,7 @@ class DButils(object):
         """
         Given a code_id the code version
         """
-        code = self.getEntry('Code', code_id)
+        code = self.getEntry('Code', code_id, cached=True)
         return Version.Version(code.interface_version, code.quality_version, code.revision_version)
 
     def getAllCodesFromProcess(self, proc_id):
@@ -1925,16 +2537,27 @@ class DButils(object):
         """
         DBlogging.dblogger.debug("Entered getCodeFromProcess: {0}".format(proc_id))
         # will have as many values as there are codes for a process
-        sq = (self.session.query(self.Code.code_id).filter_by(process_id=proc_id)
-              .filter_by(newest_version=True)
-              .filter_by(active_code=True).filter(self.Code.code_start_date <= utc_file_date)
-              .filter(self.Code.code_stop_date >= utc_file_date))
-        if sq.count() == 0:
+        utc_file_date = Utils.datetimeToDate(utc_file_date)
+        ans = [code_id for code_id, start, stop in self._getActiveCodes(proc_id)
+               if start <= utc_file_date <= stop]
+        if len(ans) == 0:
             return None
-        elif sq.count() > 1:
+        elif len(ans) > 1:
             raise (DBError('More than one code active for a Given day'))
-        return sq[0].code_id
+        return ans[0]
+
+    @_cachedMetadata
+    def _getActiveCodes(self, proc_id):
+        """
+        Return (code_id, code_start_date, code_stop_date) of the active newest codes of a process
+        """
+        sq = (self.session.query(self.Code.code_id, self.Code.code_start_date, self.Code.code_stop_date)
+              .filter_by(process_id=proc_id)
+              .filter_by(newest_version=True)
+              .filter_by(active_code=True))
+        return [tuple(v) for v in sq]
 
+    @_cachedMetadata
     def getMissionDirectory(self):
         """
         Return the base directory for the current mission
@@ -1993,6 +2616,19 @@ class DButils(object):
         #print(os.path.join(self.getCodeDirectory(),'errors'))
         return self.getDirectory('errordir', default=os.path.join(self.CodeDirectory, 'errors'))
 
+    def getStagingPath(self):
+        """
+        Return the staging path for the current mission, processes write their
+        output there. It should be on the same filesystem as the data so an
+        output is put in place with a rename and not a copy.
+
+        :return: the staging path, None (use the system temp dir) if the db
+                 has no stagingdir or it is not set
+        :rtype: str
+        """
+        return self.getDirectory('stagingdir')
+
+    @_cachedMetadata
     def getDirectory(self, column, default=None):
         """
         Generic directory lookup function, gives directory for the specified
@@ -2073,12 +2709,13 @@ class DButils(object):
         """
         sq = self.session.query(self.Release.file_id).filter_by(release_num=rel_num).all()
         sq = map(itemgetter(0), sq)
-        for i, v in enumerate(sq):
-            if fullpath:
-                sq[i] = self.getFileFullPath(v)
-            else:
-                sq[i] = self.getEntry('File', v).filename
-        return sq
+        if fullpath:
+            paths = self.getFileFullPaths(sq)
+        else:
+            paths = dict(self.session.query(self.File.file_id, self.File.filename)
+                         .join((self.Release, self.Release.file_id == self.File.file_id))
+                         .filter(self.Release.release_num == rel_num))
+        return [paths[v] for v in sq]
 
     def checkFileSHA(self, file_id):
         """
@@ -2089,23 +2726,233 @@ class DButils(object):
 
         return disk_sha == db_sha
 
-    def checkFiles(self, limit=None):
+    def getDigestCache(self):
+        """
+        Return the :class:`.DigestCache` of this database, it is kept in
+        <database>_digest.sqlite next to the database file
+
+        :return: The digest cache
+        :rtype: :class:`.Diskfile.DigestCache`
+        """
+        if self._digestCache is None:
+            self._digestCache = DigestCache(os.path.splitext(self.mission)[0] + '_digest.sqlite')
+        return self._digestCache
+
+    def checkFiles(self, limit=None, threads=4, verify=False):
         """
         Check files in the DB, return inconsistent files and why
 
+        The checksums are calculated threads files at a time, see :func:`.Diskfile.calcDigests`,
+        files that did not change since they were last hashed are taken from the
+        digest cache (:meth:`getDigestCache`) unless verify is set. A check of
+        all the files (no limit) also drops the files that are gone from the cache.
+
+        :keyword verify: Hash every file even if it is in the digest cache
+        :type verify: bool
+
         :return: A list of tuple with the results. 1 is a bad checksum, 2 is not found
         """
-        files = self.getAllFilenames(fullPath=False, limit=limit)
+        files = self.getFiles(limit=limit)
+        paths = self.getFileFullPaths([f.file_id for f in files])
+        paths = [paths[f.file_id] for f in files]
+        cache = self.getDigestCache()
+        disk_sha = cache.digests(paths, verify=verify, threads=threads)
+        if limit is None:
+            cache.prune()
         ## check of existence and checksum
         bad_list = []
-        for f in files:
-            try:
-                if not self.checkFileSHA(f):
-                    bad_list.append((f, 1))
-            except DigestError:
-                bad_list.append((f, 2))
+        for f, path in zip(files, paths):
+            if disk_sha[path] is None:
+                bad_list.append((f.filename, 2))
+            elif disk_sha[path] != f.shasum:
+                bad_list.append((f.filename, 1))
         return bad_list
 
+    def addIndexes(self, analyze=False):
+        """
+        Add any of :attr:`INDEXES` the db does not have, this is the migration
+        for a db made before they were part of CreateDB
+
+        :keyword analyze: Run ANALYZE after so the query planner has statistics
+        :type analyze: bool
+
+        :return: The names of the indexes that were added
+        :rtype: list
+        """
+        # on the session's connection so the session sees the new indexes
+        connection = self.session.connection()
+        inspector = sqlalchemy.inspect(connection)
+        existing = set()
+        for table in set(v[1] for v in self.INDEXES):
+            existing.update(ix['name'] for ix in inspector.get_indexes(table))
+        added = []
+        for name, table, columns in self.INDEXES:
+            if name in existing:
+                continue
+            # as it is in the db now, it may have changed since it was loaded
+            table = sqlalchemy.Table(table, sqlalchemy.MetaData(), autoload_with=connection)
+            if not set(columns).issubset(table.c.keys()):
+                DBlogging.dblogger.info("Not adding index {0}, {1} does not have the columns".format(name, table.name))
+                continue
+            DBlogging.dblogger.info("Adding index {0} on {1}({2})".format(name, table.name, ', '.join(columns)))
+            sqlalchemy.Index(name, *[table.c[v] for v in columns]).create(connection)
+            added.append(name)
+        if analyze:
+            connection.execute('ANALYZE')
+        self.commitDB()
+        return added
+
+    def addVersionKeys(self):
+        """
+        Add the version_key column to the tables of :attr:`VERSION_KEY_TABLES`
+        that do not have it and fill it in where it is not set, this is the
+        migration for a db made before there was a version_key
+
+        The column is only used once the db is opened again.
+
+        :return: The tables that the column was added to
+        :rtype: list
+        """
+        connection = self.session.connection()
+        inspector = sqlalchemy.inspect(connection)
+        added = []
+        for name in self.VERSION_KEY_TABLES:
+            table = self.metadata.tables[name.lower()]
+            if 'version_key' not in [v['name'] for v in inspector.get_columns(table.name)]:
+                DBlogging.dblogger.info("Adding column version_key to {0}".format(table.name))
+                connection.execute('ALTER TABLE {0} ADD COLUMN version_key BIGINT'.format(table.name))
+                added.append(table.name)
+            n = connection.execute(
+                'UPDATE {0} SET version_key = interface_version * 4294967296 + quality_version * 65536 + '
+                'revision_version WHERE version_key IS NULL'.format(table.name)).rowcount
+            DBlogging.dblogger.info("Filled in version_key of {0} {1} rows".format(n, table.name))
+        self.commitDB()
+        return added
+
+    def addStagingDir(self, stagingdir=None):
+        """
+        Add the stagingdir column to the mission table if it does not have
+        it, this is the migration for a db made before there was a stagingdir
+
+        The column is only used once the db is opened again.
+
+        :keyword stagingdir: set stagingdir of the mission to this (see
+                             :meth:`getStagingPath`), otherwise it is left as is
+        :type stagingdir: str
+
+        :return: True if the column was added
+        :rtype: bool
+        """
+        connection = self.session.connection()
+        inspector = sqlalchemy.inspect(connection)
+        added = 'stagingdir' not in [v['name'] for v in inspector.get_columns('mission')]
+        if added:
+            DBlogging.dblogger.info("Adding column stagingdir to mission")
+            connection.execute('ALTER TABLE mission ADD COLUMN stagingdir VARCHAR(50)')
+        if stagingdir is not None:
+            connection.execute(sqlalchemy.text('UPDATE mission SET stagingdir = :stagingdir'),
+                               stagingdir=stagingdir)
+            DBlogging.dblogger.info("Set the mission stagingdir to {0}".format(stagingdir))
+        self.commitDB()
+        self.clearCache()
+        return added
+
+    def explainQueries(self):
+        """
+        Run EXPLAIN QUERY PLAN on the queries made by the busiest DButils calls
+        and find the ones that read a whole table or sort without an index
+
+        The calls are made for real (on the first product/file/code in the db)
+        and their SQL recorded so it is exactly what the code runs. Scans of
+        the small tables in :attr:`STATIC_TABLES` are not counted. Only sqlite
+        is supported.
+
+        :return: (call, SQL, plan, problems) for each query, plan and problems
+                 are lists of the lines of the plan
+        :rtype: list
+        """
+        if self.engine.dialect.name != 'sqlite':
+            raise (DBError("explainQueries only supports sqlite"))
+        product_id = self.session.query(func.min(self.Product.product_id)).scalar() or 1
+        file_id = self.session.query(func.min(self.File.file_id)).scalar() or 1
+        code_id = self.session.query(func.min(self.Code.code_id)).scalar() or 1
+        day = self.session.query(self.File.utc_file_date).filter_by(file_id=file_id).scalar() \
+              or datetime.date.today()
+        calls = (('getFilesByProductDate', lambda: self.getFilesByProductDate(product_id, [day, day])),
+                 ('getFilesByProductDate(newest_version=True)',
+                  lambda: self.getFilesByProductDate(product_id, [day, day], newest_version=True)),
+                 ('getNewestFiles', lambda: self.getNewestFiles({product_id: [day]})),
+                 ('getFilesByCode', lambda: self.getFilesByCode(code_id)),
+                 ('getFileParents', lambda: self.getFileParents(file_id)),
+                 ('getFilecodelink_byfile', lambda: self.getFilecodelink_byfile(file_id)),
+                 ('getChildrenProcesses', lambda: self.getChildrenProcesses(file_id)),
+                 ('getActiveInspectors', self.getActiveInspectors),
+                 ('getFileFullPath', lambda: self.getFileFullPath(file_id)),
+                 )
+        static = set(v.lower() for v in self.STATIC_TABLES)
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append((statement, parameters))
+
+        cursor = self.session.connection().connection.cursor()
+        ans = []
+        for name, call in calls:
+            self.clearCache()  # the cached calls have to go to the db
+            del statements[:]
+            sqlalchemy.event.listen(self.engine, 'before_cursor_execute', record)
+            try:
+                call()
+            except (DBError, DBNoData):
+                pass
+            finally:
+                sqlalchemy.event.remove(self.engine, 'before_cursor_execute', record)
+            for statement, parameters in statements:
+                if not statement.lstrip().upper().startswith('SELECT'):
+                    continue
+                cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+                plan = [row[-1] for row in cursor.fetchall()]
+                problems = []
+                for line in plan:
+                    words = line.replace(' TABLE ', ' ').split()
+                    if words[0] == 'SCAN' and words[1].lower() not in static and words[1].isalnum() \
+                       or 'TEMP B-TREE' in line:
+                        problems.append(line)
+                ans.append((name, statement, plan, problems))
+        cursor.close()
+        return ans
+
+    @_cachedMetadata
+    def _getProductTraceback(self, in_id):
+        """
+        getTraceback('Product', in_id), the rows are detached copies so they can be cached
+        """
+        retval = { }
+        vars = ['product', 'inspector', 'instrument',
+                'instrumentproductlink', 'satellite', 'mission']
+
+        in_id = self.getProductID(in_id)
+
+        sq = (self.session.query(self.Product,
+                                 self.Inspector, self.Instrument,
+                                 self.Instrumentproductlink, self.Satellite,
+                                 self.Mission)
+              .filter_by(product_id=in_id)
+              .join((self.Inspector, self.Product.product_id == self.Inspector.product))
+              .join((self.Instrumentproductlink, self.Product.product_id == self.Instrumentproductlink.product_id))
+              .join((self.Instrument, self.Instrumentproductlink.instrument_id == self.Instrument.instrument_id))
+              .join((self.Satellite, self.Instrument.satellite_id == self.Satellite.satellite_id))
+              .join((self.Mission, self.Satellite.mission_id == self.Mission.mission_id)).all())
+
+        if not sq:  # did not find a match this is a dberror
+            raise (DBError("product {0} did not have a traceback, this is a problem, fix it".format(in_id)))
+
+        if len(sq) > 1:
+            raise (DBError("Found multiple tracebacks for product {0}".format(in_id)))
+        for ii, v in enumerate(vars):
+            retval[v] = self._detached(sq[0][ii])
+        return retval
+
     def getTraceback(self, table, in_id, in_id2=None):
         """
         Master routine for all the getXXXTraceback functions, this will make for less code
@@ -2182,29 +3029,7 @@ class DButils(object):
             retval = dict(retval.items() + tmp.items())
 
         elif table.capitalize() == 'Product':
-            vars = ['product', 'inspector', 'instrument',
-                    'instrumentproductlink', 'satellite', 'mission']
-
-            in_id = self.getProductID(in_id)
-
-            sq = (self.session.query(self.Product,
-                                     self.Inspector, self.Instrument,
-                                     self.Instrumentproductlink, self.Satellite,
-                                     self.Mission)
-                  .filter_by(product_id=in_id)
-                  .join((self.Inspector, self.Product.product_id == self.Inspector.product))
-                  .join((self.Instrumentproductlink, self.Product.product_id == self.Instrumentproductlink.product_id))
-                  .join((self.Instrument, self.Instrumentproductlink.instrument_id == self.Instrument.instrument_id))
-                  .join((self.Satellite, self.Instrument.satellite_id == self.Satellite.satellite_id))
-                  .join((self.Mission, self.Satellite.mission_id == self.Mission.mission_id)).all())
-
-            if not sq:  # did not find a match this is a dberror
-                raise (DBError("product {0} did not have a traceback, this is a problem, fix it".format(in_id)))
-
-            if len(sq) > 1:
-                raise (DBError("Found multiple tracebacks for product {0}".format(in_id)))
-            for ii, v in enumerate(vars):
-                retval[v] = sq[0][ii]
+            retval = self._getProductTraceback(in_id)
 
         elif table.capitalize() == 'Process':
 
@@ -2269,6 +3094,92 @@ class DButils(object):
 
         return retval
 
+    def getTracebacks(self, table, ids):
+        """
+        :meth:`getTraceback` for many ids at once, each table is one joined
+        query (a few for Code and Inspector) instead of one per id. Process
+        tracebacks are not a single join and are still done one at a time.
+
+        :param table: table name as for :meth:`getTraceback`
+        :type table: str
+        :param ids: primary keys of the rows to traceback
+        :type ids: iterable
+
+        :return: the traceback dict of each id, keyed by id
+        :rtype: dict
+        :raises DBError: if an id has no traceback or more than one
+        """
+        table = table.capitalize()
+        ids = set(ids)
+        if not ids:
+            return {}
+        product_joins = [(self.Inspector, self.Product.product_id == self.Inspector.product),
+                         (self.Instrumentproductlink, self.Product.product_id == self.Instrumentproductlink.product_id),
+                         (self.Instrument, self.Instrumentproductlink.instrument_id == self.Instrument.instrument_id),
+                         (self.Satellite, self.Instrument.satellite_id == self.Satellite.satellite_id),
+                         (self.Mission, self.Satellite.mission_id == self.Mission.mission_id)]
+        product_vars = ['product', 'inspector', 'instrument',
+                        'instrumentproductlink', 'satellite', 'mission']
+        if table == 'File':
+            return self._tracebackJoin('file', ['file'] + product_vars, self.File.file_id,
+                                       [(self.Product, self.File.product_id == self.Product.product_id)] + product_joins,
+                                       ids)
+        elif table == 'Product':
+            return self._tracebackJoin('product', product_vars, self.Product.product_id, product_joins, ids)
+        elif table == 'Code':
+            # symplified version for plots (where there is no output product)
+            retval = self._tracebackJoin('code', ['code', 'process'], self.Code.code_id,
+                                         [(self.Process, self.Code.process_id == self.Process.process_id)], ids)
+            full = [k for k in retval if retval[k]['process'].output_timebase != 'RUN']
+            if full:
+                vars = ['code', 'process', 'product', 'instrument',
+                        'instrumentproductlink', 'satellite', 'mission']
+                joins = [(self.Process, self.Code.process_id == self.Process.process_id),
+                         (self.Product, self.Product.product_id == self.Process.output_product)] + product_joins
+                retval.update(self._tracebackJoin('code', vars, self.Code.code_id, joins, full))
+            return retval
+        elif table == 'Inspector':
+            insps = self._tracebackJoin('inspector', ['inspector'], self.Inspector.inspector_id, [], ids)
+            ptbs = self.getTracebacks('Product', [v['inspector'].product for v in insps.values()])
+            return dict((k, dict(v.items() + ptbs[v['inspector'].product].items()))
+                        for k, v in insps.items())
+        elif table == 'Process':
+            return dict((v, self.getTraceback(table, v)) for v in ids)
+        elif table == 'Instrument':
+            return self._tracebackJoin('instrument', ['instrument', 'satellite', 'mission'],
+                                       self.Instrument.instrument_id, product_joins[-2:], ids)
+        elif table == 'Satellite':
+            return self._tracebackJoin('satellite', ['satellite', 'mission'],
+                                       self.Satellite.satellite_id, product_joins[-1:], ids)
+        elif table == 'Mission':
+            return self._tracebackJoin('mission', ['mission'], self.Mission.mission_id, [], ids)
+        else:
+            raise (NotImplementedError('The traceback or {0} is not implemented'.format(table)))
+
+    def _tracebackJoin(self, name, vars, key, joins, ids):
+        """
+        Run the traceback join for ids 500 at a time, the tables in vars are
+        queried joined by joins and the answers are keyed by the key column
+        """
+        classes = [getattr(self, v.title()) for v in vars]
+        retval = {}
+        for chunk in Utils.chunker(list(ids), 500):
+            sq = self.session.query(*classes).filter(key.in_(chunk))
+            for join in joins:
+                sq = sq.join(join)
+            for row in sq:
+                if len(classes) == 1:  # a query of one table does not give tuples
+                    row = (row,)
+                k = getattr(row[0], key.key)
+                if k in retval:
+                    raise (DBError("Found multiple tracebacks for {0} {1}".format(name, k)))
+                retval[k] = dict(zip(vars, row))
+        missing = set(ids).difference(retval)
+        if missing:
+            raise (DBError("{0} {1} did not have a traceback, this is a problem, fix it".format(
+                name, ', '.join(str(v) for v in sorted(missing)))))
+        return retval
+
         ######################
         # add in some helpers to match what we had
         # TODO figure ou how to do this!!
@@ -2318,7 +3229,7 @@ class DButils(object):
         """
         Return the timebase for a product
         """
-        return self.getEntry('Process', process_id).output_timebase
+        return self.getEntry('Process', process_id, cached=True).output_timebase
 
     def getAllProducts(self, id_only=False):
         """
@@ -2329,10 +3240,22 @@ class DButils(object):
             prods = map(attrgetter('product_id'), prods)
         return prods
 
-    def getEntry(self, table, args):
+    def getEntry(self, table, args, cached=False):
         """
         Master method to return a entry instance from any table in the db
-        """
+
+        :keyword cached: for the :attr:`STATIC_TABLES` return a cached copy of
+                         the entry that is not in the session, only for reading
+        :type cached: bool
+        """
+        if cached and table in self.STATIC_TABLES:
+            key = ('getEntry', table, tuple(args) if isinstance(args, list) else args)
+            if key not in self._cache:
+                retval = self._detached(self.getEntry(table, args))
+                if retval is None:
+                    return None
+                self._cache[key] = retval
+            return self._cache[key]
         # just try and get the entry
         retval = self.session.query(getattr(self, table)).get(args)
         if retval is None:  # either this was not a valid pk or not a pk that is in the db
@@ -2373,7 +3296,7 @@ class DButils(object):
         Given an input product return a list of its output product ids
         """
         out_proc = self.getProcessFromInputProduct(inprod)
-        return [self.getEntry('Process', op).output_product for op in out_proc]
+        return [self.getEntry('Process', op, cached=True).output_product for op in out_proc]
 
     def getProductParentTree(self):
         """
@@ -5,7 +5,10 @@ from __future__ import print_function
 
 import glob
 import hashlib
+import io
+import multiprocessing.pool
 import os
+import sqlite3
 
 from . import DBlogging
 
@@ -134,23 +137,239 @@ class Diskfile(object):
 #        DBlogging.dblogger.debug("{0} Access Checked out OK".format(self.infile))
 
 
-def calcDigest(infile):
+DIGEST_BUFSIZE = 1024 * 1024
+"""Size of the pieces (bytes) files are read in to calculate their digest"""
+
+def calcDigest(infile, bufsize=DIGEST_BUFSIZE):
     """Calculate the SHA1 digest from a file.
 
+    The file is read bufsize bytes at a time into one reused buffer, so
+    the memory used does not grow with the size of the file.
+
     :param infile: Path to the file
     :type infile: str
+    :param bufsize: Size of the reads from the file (bytes)
+    :type bufsize: int
 
     :return: Hex digits of the file, SHA1 (40 bytes)
     :rtype: str
-
     """
     m = hashlib.sha1()
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
     try:
-        with open(infile, 'rb') as f:
-            m.update(f.read())
+        with io.open(infile, 'rb', buffering=0) as f:
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                m.update(view[:n])
     except IOError:
         raise(DigestError("File not found: {0}".format(infile)))
-        
+
     DBlogging.dblogger.debug("digest calculated: {0}, file: {1} ".format(m.hexdigest(), infile))
 
     return m.hexdigest()
+
+
+def calcDigests(infiles, threads=4, bufsize=DIGEST_BUFSIZE):
+    """Calculate the SHA1 digest of many files in a pool of threads.
+
+    hashlib lets go of the GIL while it hashes so the threads really do
+    run at the same time.
+
+    :param infiles: Paths to the files
+    :type infiles: iterable of str
+    :param threads: Number of files to hash at once
+    :type threads: int
+    :param bufsize: Size of the reads from the files (bytes)
+    :type bufsize: int
+
+    :return: Hex digits of each file, None for the files that could not be read
+    :rtype: dict
+    """
+    def _digest(infile):
+        try:
+            return infile, calcDigest(infile, bufsize)
+        except DigestError:
+            return infile, None
+
+    pool = multiprocessing.pool.ThreadPool(threads)
+    try:
+        return dict(pool.imap_unordered(_digest, infiles))
+    finally:
+        pool.close()
+        pool.join()
+
+
+class DigestCache(object):
+    """
+    Keep the digests of files in a small sqlite file so that files that have
+    not changed are not hashed again.
+
+    A stored digest is only used while the file still has the same size,
+    modification time (ns) and inode it had when it was hashed, anything
+    else and the file is hashed again. Problems with the cache file are
+    logged and the digest is calculated as if there was no cache.
+
+    Rows of files that are gone (removed from the db, outputs in a deleted
+    tempdir) are only dropped by :meth:`prune`.
+    """
+
+    def __init__(self, filename):
+        """
+        Open (creating if needed) the cache file
+
+        :param filename: Path to the sqlite file of the cache
+        :type filename: str
+        """
+        self.filename = filename
+        self.conn = None # no cache, everything is hashed
+        try:
+            conn = sqlite3.connect(filename, timeout=30)
+        except sqlite3.Error as msg:
+            DBlogging.dblogger.warning("Digest cache {0} not usable: {1}".format(filename, msg))
+            return
+        try:
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.execute('CREATE TABLE IF NOT EXISTS digest ('
+                         'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, '
+                         'inode INTEGER, shasum TEXT)')
+            conn.commit()
+        except sqlite3.Error as msg:
+            DBlogging.dblogger.warning("Digest cache {0} not usable: {1}".format(filename, msg))
+            conn.close()
+            return
+        self.conn = conn
+
+    def __repr__(self):
+        return "<Diskfile.DigestCache object: {0}>".format(self.filename)
+
+    def close(self):
+        """
+        Close the cache file
+        """
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def prune(self):
+        """
+        Drop the digests of the files that no longer exist
+
+        :return: Number of digests dropped
+        :rtype: int
+        """
+        if self.conn is None:
+            return 0
+        try:
+            gone = [(v[0],) for v in self.conn.execute('SELECT path FROM digest')
+                    if not os.path.exists(v[0])]
+            self.conn.executemany('DELETE FROM digest WHERE path = ?', gone)
+            self.conn.commit()
+        except sqlite3.Error as msg:
+            DBlogging.dblogger.warning("Digest cache {0} not pruned: {1}".format(self.filename, msg))
+            return 0
+        DBlogging.dblogger.debug("Digest cache: dropped {0} files that are gone".format(len(gone)))
+        return len(gone)
+
+    @staticmethod
+    def _stamp(path):
+        """
+        Return what has to match for a stored digest to be used, (size, mtime_ns, inode)
+        """
+        st = os.stat(path)
+        mtime_ns = getattr(st, 'st_mtime_ns', None)
+        if mtime_ns is None:
+            mtime_ns = int(st.st_mtime * 1e9)
+        return (st.st_size, mtime_ns, st.st_ino)
+
+    def _lookup(self, path, stamp):
+        """
+        Return the stored digest of path if stamp still matches it, otherwise None
+        """
+        if self.conn is None:
+            return None
+        try:
+            row = self.conn.execute('SELECT size, mtime_ns, inode, shasum FROM digest WHERE path = ?',
+                                    (path,)).fetchone()
+        except sqlite3.Error as msg:
+            DBlogging.dblogger.warning("Digest cache {0} lookup failed: {1}".format(self.filename, msg))
+            return None
+        if row is None or tuple(row[:3]) != stamp:
+            return None
+        return row[3]
+
+    def _store(self, rows):
+        """
+        Store rows of (path, size, mtime_ns, inode, shasum)
+        """
+        if not rows or self.conn is None:
+            return
+        try:
+            self.conn.executemany('INSERT OR REPLACE INTO digest VALUES (?, ?, ?, ?, ?)', rows)
+            self.conn.commit()
+        except sqlite3.Error as msg:
+            DBlogging.dblogger.warning("Digest cache {0} not updated: {1}".format(self.filename, msg))
+
+    def digest(self, infile, verify=False):
+        """
+        Return the SHA1 digest of a file, from the cache if the file did not change
+
+        :param infile: Path to the file
+        :type infile: str
+        :keyword verify: Calculate the digest even if it is in the cache
+        :type verify: bool
+
+        :return: Hex digits of the file, SHA1 (40 bytes)
+        :rtype: str
+        """
+        path = os.path.abspath(infile)
+        try:
+            stamp = self._stamp(path)
+        except OSError:
+            raise(DigestError("File not found: {0}".format(infile)))
+        if not verify:
+            shasum = self._lookup(path, stamp)
+            if shasum is not None:
+                return shasum
+        shasum = calcDigest(path)
+        self._store([(path,) + stamp + (shasum,)])
+        return shasum
+
+    def digests(self, infiles, verify=False, threads=4):
+        """
+        Return the SHA1 digest of many files, only the files not in the
+        cache (or all with verify) are hashed, threads at a time
+
+        :param infiles: Paths to the files
+        :type infiles: iterable of str
+        :keyword verify: Calculate the digests even if they are in the cache
+        :type verify: bool
+        :keyword threads: Number of files to hash at once
+        :type threads: int
+
+        :return: Hex digits of each file, None for the files that could not be read
+        :rtype: dict
+        """
+        ans = {}
+        stamps = {}
+        for infile in infiles:
+            path = os.path.abspath(infile)
+            try:
+                stamps[infile] = self._stamp(path)
+            except OSError:
+                ans[infile] = None
+                continue
+            if not verify:
+                shasum = self._lookup(path, stamps[infile])
+                if shasum is not None:
+                    ans[infile] = shasum
+        todo = [infile for infile in stamps if infile not in ans]
+        if todo:
+            DBlogging.dblogger.debug("Digest cache: {0} of {1} files to hash".format(len(todo), len(ans) + len(todo)))
+            new = calcDigests(todo, threads=threads)
+            self._store([(os.path.abspath(infile),) + stamps[infile] + (new[infile],)
+                         for infile in todo if new[infile] is not None])
+            ans.update(new)
+        return ans
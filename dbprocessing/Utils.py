@@ -303,46 +303,61 @@ def dirSubs(path, filename, utc_file_date, utc_start_time, version, dbu=None):
     :param dbu: Pass in the current :class:`.DButils` session so that a new connection is not made
     :type dbu: :class:`.DButils`
     """
-    if '{INSTRUMENT}' in path or '{SATELLITE}' in path or '{SPACECRAFT}' in path or '{MISSION}' in path or '{PRODUCT}' in path:
+    pieces = _dirSubsPieces(path)
+    if len(pieces) == 1:  # nothing to substitute
+        return path
+    fields = set(pieces[1::2])
+    values = { }
+    if not fields.isdisjoint(('INSTRUMENT', 'SATELLITE', 'SPACECRAFT', 'MISSION', 'PRODUCT')):
         ftb = dbu.getTraceback('File', filename)
-        if '{INSTRUMENT}' in path:  # need to replace with the instrument name
-            path = path.replace('{INSTRUMENT}', ftb['instrument'].instrument_name)
-        if '{SATELLITE}' in path:  # need to replace with the instrument name
-            path = path.replace('{SATELLITE}', ftb['satellite'].satellite_name)
-        if '{SPACECRAFT}' in path:  # need to replace with the instrument name
-            path = path.replace('{SPACECRAFT}', ftb['satellite'].satellite_name)
-        if '{MISSION}' in path:
-            path = path.replace('{MISSION}', ftb['mission'].mission_name)
-        if '{PRODUCT}' in path:
-            path = path.replace('{PRODUCT}', ftb['product'].product_name)
-
-    if '{Y}' in path:
-        path = path.replace('{Y}', utc_file_date.strftime('%Y'))
-    if '{m}' in path:
-        path = path.replace('{m}', utc_file_date.strftime('%m'))
-    if '{d}' in path:
-        path = path.replace('{d}', utc_file_date.strftime('%d'))
-    if '{b}' in path:
-        months = { 1: 'Jan', 2: 'Feb', 3: 'Mar', 4: 'Apr', 5: 'May', 6: 'Jun', 7: 'Jul', 8: 'Aug', 9: 'Sep', 10: 'Oct',
-                   11: 'Nov', 12: 'Dec' }
-        path = path.replace('{b}', months[utc_file_date.month])
-    if '{y}' in path:
-        path = path.replace('{y}', utc_file_date.strftime('%y'))
-    if '{j}' in path:
-        path = path.replace('{j}', utc_file_date.strftime('%j'))
-    if '{H}' in path:
-        path = path.replace('{H}', utc_start_time.strftime('%H'))
-    if '{M}' in path:
-        path = path.replace('{M}', utc_start_time.strftime('%M'))
-    if '{S}' in path:
-        path = path.replace('{S}', utc_start_time.strftime('%S'))
-    if '{VERSION}' in path:
-        if isinstance(version, (unicode, str)):
-            version = Version.Version.fromString(version)
-        path = path.replace('{VERSION}', '{0}'.format(str(version)))
-    if '{DATE}' in path:
-        path = path.replace('{DATE}', utc_file_date.strftime('%Y%m%d'))
-    return path
+        values['INSTRUMENT'] = ftb['instrument'].instrument_name
+        values['SATELLITE'] = values['SPACECRAFT'] = ftb['satellite'].satellite_name
+        values['MISSION'] = ftb['mission'].mission_name
+        values['PRODUCT'] = ftb['product'].product_name
+    for field in fields:
+        if field not in values:
+            values[field] = _DIRSUBS_VALUES[field](utc_file_date, utc_start_time, version)
+    pieces = list(pieces)
+    pieces[1::2] = [values[v] for v in pieces[1::2]]
+    return ''.join(pieces)
+
+
+_DIRSUBS_RE = re.compile(r'\{(INSTRUMENT|SATELLITE|SPACECRAFT|MISSION|PRODUCT|'
+                         r'Y|m|d|b|y|j|H|M|S|VERSION|DATE)\}')
+"""The fields :func:`dirSubs` fills in"""
+
+_MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+_DIRSUBS_VALUES = {
+    'Y': lambda fd, st, v: '{0:04d}'.format(fd.year),
+    'm': lambda fd, st, v: '{0:02d}'.format(fd.month),
+    'd': lambda fd, st, v: '{0:02d}'.format(fd.day),
+    'b': lambda fd, st, v: _MONTHS[fd.month - 1],
+    'y': lambda fd, st, v: '{0:02d}'.format(fd.year % 100),
+    'j': lambda fd, st, v: '{0:03d}'.format(fd.timetuple().tm_yday),
+    'H': lambda fd, st, v: '{0:02d}'.format(st.hour),
+    'M': lambda fd, st, v: '{0:02d}'.format(st.minute),
+    'S': lambda fd, st, v: '{0:02d}'.format(st.second),
+    'VERSION': lambda fd, st, v: str(Version.Version.fromString(v)
+                                     if isinstance(v, (unicode, str)) else v),
+    'DATE': lambda fd, st, v: '{0:04d}{1:02d}{2:02d}'.format(fd.year, fd.month, fd.day),
+}
+"""How to make the value of each :func:`dirSubs` field from
+(utc_file_date, utc_start_time, version)"""
+
+_dirSubsCache = { }
+
+
+def _dirSubsPieces(path):
+    """
+    Split a path for :func:`dirSubs` into literal text and field names
+    (alternating, starting with the text), each path is only split once
+    """
+    try:
+        return _dirSubsCache[path]
+    except KeyError:
+        pieces = _dirSubsCache[path] = tuple(_DIRSUBS_RE.split(path))
+        return pieces
 
 
 def split_code_args(args):
@@ -388,6 +403,27 @@ def processRunning(pid):
         return True
 
 
+def fsyncFiles(paths):
+    """
+    fsync files and then each directory they are in once, so that a rename
+    into the directory is on disk too
+
+    :param paths: full paths of the files
+    :type paths: iterable
+    """
+    dirs = set()
+    for path in paths:
+        for name in (path, os.path.dirname(path)):
+            if name in dirs:
+                continue
+            fd = os.open(name, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        dirs.add(os.path.dirname(path))
+
+
 def readconfig(config_filepath):
     """
     Create a ConfigParser object, to read the config file
@@ -78,6 +78,43 @@ class Version(object):
         """
         return Version(*inval.split('.'))
 
+    @staticmethod
+    def fromKey(key):
+        """
+        Given a version key (see :meth:`toKey`) return a Version object
+
+        :param key: version key
+        :type key: int
+        :return: Version instance of the key
+        :rtype: :class:`Version`
+        """
+        key = int(key)
+        return Version(key >> 32, (key >> 16) & 0xFFFF, key & 0xFFFF)
+
+    @staticmethod
+    def makeKey(interface_version, quality_version, revision_version):
+        """
+        The version key of a version given as its three numbers, without
+        making a Version object, see :meth:`toKey`
+
+        :return: version key
+        :rtype: int
+        """
+        if not 0 <= quality_version <= 0xFFFF or not 0 <= revision_version <= 0xFFFF:
+            raise (VersionError("quality and revision versions must fit in 16 bits for a key"))
+        return (int(interface_version) << 32) | (int(quality_version) << 16) | int(revision_version)
+
+    def toKey(self):
+        """
+        Return the version as one integer that sorts the same as the version,
+        interface<<32 | quality<<16 | revision. This is what is in the
+        version_key column of the file and code tables.
+
+        :return: version key
+        :rtype: int
+        """
+        return Version.makeKey(self.interface, self.quality, self.revision)
+
     def _checkVersion(self):
         """
         Check a version to make sure it is valid, works on current object
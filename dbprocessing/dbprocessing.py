@@ -3,7 +3,9 @@ from __future__ import absolute_import
 from __future__ import print_function
 
 import datetime
+import hashlib
 import imp
+import multiprocessing
 import os
 import shutil
 import sys
@@ -15,12 +17,13 @@ from operator import itemgetter
 from . import DBfile
 from . import DBlogging
 from . import DBqueue
+from . import Diskfile
+from . import DBstrings
 from . import DButils
 from . import Utils
 from . import runMe
 from .Utils import strargs_to_args
 
-from sqlalchemy.exc import IntegrityError
 
 
 class ProcessQueue(object):
@@ -49,6 +52,10 @@ class ProcessQueue(object):
         self.depends = DBqueue.DBqueue()
         self.queue = DBqueue.DBqueue()
         self.findChildren = DBqueue.DBqueue()
+        self.inspectors = None # active inspectors, read from the db once per run
+        self.inspectorModules = {} # path -> ((mtime, size), module)
+        self.inspectorIndex = None # literal filename prefix -> [(regex, position, inspector)]
+        self._prefixLengths = [] # lengths of the prefixes in inspectorIndex
         DBlogging.dblogger.debug("Entering ProcessQueue")
 
     def __del__(self):
@@ -136,55 +143,69 @@ class ProcessQueue(object):
             else:
                 DBlogging.dblogger.info("moveToError {0} moved to {1}".format(fname, path))
 
-    def diskfileToDB(self, df):
+    def diskfileToDB(self, df, links=None):
         """
         given a diskfile go through and do all the steps to add it into the db
+
+        :keyword links: (code_id, input file_ids) of the file, see :meth:`.DButils.addFiles`
         """
-        if df is None:
-            DBlogging.dblogger.info("Found no product moving to error, {0}".format(self.basename))
-            if not self.dryrun:
-                self.moveToError(self.filename)
-            else:
-                print('<dryrun> Found no product moving to error, {0}'.format(self.basename))
-            return None
+        return self.diskfilesToDB([df], None if links is None else [links])[0]
 
-        # create the DBfile
-        dbf = DBfile.DBfile(df, self.dbu)
-        try:
-            if not self.dryrun:
-                f_id = dbf.addFileToDB()
-                DBlogging.dblogger.info("File {0} entered in DB, f_id={1}".format(df.filename, f_id))
-            else:
-                print('<dryrun> File {0} entered in DB'.format(df.filename))
-        except (ValueError, DButils.DBError) as errmsg:
-            if not self.dryrun:
-                DBlogging.dblogger.warning("Except adding file to db so" + \
-                                           " moving to error: %s" % (errmsg))
-                self.moveToError(os.path.join(df.path, df.filename))
-            else:
-                print('<dryrun> Except adding file to db so' +
-                      ' moving to error: %s' % (errmsg))
-            return None
+    def diskfilesToDB(self, dfs, links=None):
+        """
+        :meth:`diskfileToDB` for many diskfiles, the files and their
+        processqueue entries go into the db in one transaction (see
+        :meth:`.DButils.addFiles`) and then the files are moved
 
-        # move the file to the its correct home
-        if not self.dryrun:
-            dbf.move()
+        :param dfs: diskfiles to add, None for a file no inspector claimed
+        :type dfs: list
+        :keyword links: for each diskfile None or (code_id, input file_ids)
+        :type links: list
 
-        if not self.dryrun:
-            try:
-                self.dbu.session.commit()
-            except IntegrityError as IE:
-                self.session.rollback()
-                raise (DButils.DBError(IE))
-            # add to processqueue for later processing
-            self.dbu.Processqueue.push(f_id)
-            return f_id
-        else:
-            return None
+        :return: file_id for each diskfile, None if it did not go in the db
+        :rtype: list
+        """
+        if links is None:
+            links = [None] * len(dfs)
+        ans = [None] * len(dfs)
+        todo = []
+        for ii, df in enumerate(dfs):
+            if df is None:
+                DBlogging.dblogger.info("Found no product moving to error, {0}".format(self.basename))
+                if not self.dryrun:
+                    self.moveToError(self.filename)
+                else:
+                    print('<dryrun> Found no product moving to error, {0}'.format(self.basename))
+            elif self.dryrun:
+                print('<dryrun> File {0} entered in DB'.format(df.filename))
+            else:
+                todo.append(ii)
+        if not todo:
+            return ans
+
+        f_ids = self.dbu.addFiles([dfs[ii].params for ii in todo], processqueue=True,
+                                  links=[links[ii] for ii in todo])
+        for ii, f_id in zip(todo, f_ids):
+            df = dfs[ii]
+            if f_id is None:
+                DBlogging.dblogger.warning("Except adding file to db so moving to error: {0}".format(df.filename))
+                self.moveToError(os.path.join(df.path, df.filename))
+                continue
+            DBlogging.dblogger.info("File {0} entered in DB, f_id={1}".format(df.filename, f_id))
+            # move the file to the its correct home
+            DBfile.DBfile(df, self.dbu).move()
+            ans[ii] = f_id
+        return ans
 
-    def importFromIncoming(self):
+    def importFromIncoming(self, workers=1, batch=100):
         """
         Import a file from incoming into the database
+
+        :param int workers: number of processes to inspect (and checksum) the
+                            files in, the results are still added to the db
+                            from this process. Ignored for a dryrun.
+        :param int batch: number of files added to the db in each transaction,
+                          see :meth:`diskfilesToDB`
         """
         DBlogging.dblogger.debug("Entering importFromIncoming, {0} to import".format(len(self.queue)))
 
@@ -193,13 +214,17 @@ class ProcessQueue(object):
         else:
             vals = self.queue
 
+        if workers > 1 and not self.dryrun:
+            return self._importFromIncomingPool(vals, workers, batch)
+
         T0 = time.time()
+        pending = []
         for ii, val in enumerate(vals, 1):
             self.set_filename(val)
             DBlogging.dblogger.debug("popped '{0}' from the queue: {1} left".format(self.basename, len(self.queue)))
             # see if the file is in the db, if so then don't call the inspectors
-            try:
-                id = self.dbu.getFileID(self.basename)
+            id = self.dbu.fileInDB(self.basename)
+            if id is not None:
                 DBlogging.dblogger.info(
                     'File {0}:{1} was already in DB, not inspecting'.format(id, self.basename))
                 self.moveToError(self.filename)
@@ -207,26 +232,173 @@ class ProcessQueue(object):
                 print('{1}:{2} Removed from incoming: {0} - already present  {3:.2f}s'.format(self.basename, ii, len(self.queue), T1))
                 T0 = time.time()
                 continue
-            except DButils.DBNoData:
-                DBlogging.dblogger.info('File {0} was not in DB, inspecting'.format(self.basename))
+            DBlogging.dblogger.info('File {0} was not in DB, inspecting'.format(self.basename))
             df = self.figureProduct()
-            if df != []:
+            if df is None:
                 self.diskfileToDB(df)
-                T1 = time.time() - T0
-                print('{1}:{2} Removed from incoming: {0} - ingested   {3:.2f}s'.format(self.basename, ii, len(self.queue), T1))
-                T0 = time.time()
+            pending.append((df, self.basename, ii, len(self.queue), time.time() - T0))
+            T0 = time.time()
+            if len(pending) >= batch:
+                self._ingestPending(pending)
+        self._ingestPending(pending)
+
+    def _ingestPending(self, pending):
+        """
+        Add the inspected files in pending to the db in one transaction and
+        empty it, pending is (diskfile, name, number, number left, seconds)
+        for each file
+        """
+        self.diskfilesToDB([v[0] for v in pending if v[0] is not None])
+        for df, name, ii, left, T1 in pending:
+            print('{1}:{2} Removed from incoming: {0} - ingested   {3:.2f}s'.format(name, ii, left, T1))
+        del pending[:]
 
-    def figureProduct(self, filename=None):
+    def getInspectors(self):
+        """
+        Return the active inspectors, they are read from the db the first time
+        and kept for the rest of the run (see :meth:`resetInspectors`)
+        """
+        if self.inspectors is None:
+            self.inspectors = self.dbu.getActiveInspectors()
+            self.inspectorIndex = None
+        return self.inspectors
+
+    def _buildInspectorIndex(self):
+        """
+        Index the active inspectors on their product's filename format
+
+        Each format is made into a regex (:attr:`.DBtemplate.regex`) and
+        filed under the literal text it starts with so a filename only has to
+        be checked against the formats whose prefix it has.
+        """
+        formats = {}
+        inspectors = self.getInspectors()
+        self.inspectorIndex = {}
+        for ii, insp in enumerate(inspectors):
+            if insp.product_id not in formats:
+                tmpl = DBstrings.template(self.dbu.getEntry('Product', insp.product_id).format)
+                formats[insp.product_id] = (tmpl.prefix, tmpl.regex)
+            prefix, regex = formats[insp.product_id]
+            self.inspectorIndex.setdefault(prefix, []).append((regex, ii, insp))
+        self._prefixLengths = sorted(set(len(v) for v in self.inspectorIndex))
+        DBlogging.dblogger.debug("Built inspector index: {0} inspectors, {1} prefixes".format(
+            len(inspectors), len(self.inspectorIndex)))
+
+    def candidateInspectors(self, filename):
+        """
+        Return the active inspectors whose product format can match filename
+
+        If no format matches all the inspectors are returned, so an inspector
+        that claims files its format does not describe still gets them.
+        Inspectors are in the same order as :meth:`getInspectors`.
+        """
+        if self.inspectors is None or self.inspectorIndex is None:
+            self._buildInspectorIndex()
+        basename = os.path.basename(filename)
+        found = []
+        for length in self._prefixLengths:
+            for regex, ii, insp in self.inspectorIndex.get(basename[:length], []):
+                if regex.match(basename):
+                    found.append((ii, insp))
+        if not found:
+            DBlogging.dblogger.debug("No product format matches {0}, trying all inspectors".format(basename))
+            return self.getInspectors()
+        return [insp for ii, insp in sorted(found)]
+
+    def resetInspectors(self):
+        """
+        Forget the active inspectors so they are read from the db again, the
+        loaded modules are kept and only reloaded if their file changed
+        """
+        self.inspectors = None
+        self.inspectorIndex = None
+
+    def loadInspector(self, code):
+        """
+        Return the module for the inspector file code
+
+        Each inspector is loaded once and then reused, it is only loaded again
+        if the mtime or size of the file changes. Every file gets its own
+        module name so they do not replace each other.
+
+        :param code: full path to the inspector
+        :type code: str
+        :raises IOError: if the inspector does not exist
+        """
+        try:
+            st = os.stat(code)
+        except OSError as msg:
+            raise (IOError(msg))
+        stamp = (st.st_mtime, st.st_size)
+        if code in self.inspectorModules and self.inspectorModules[code][0] == stamp:
+            return self.inspectorModules[code][1]
+        name = 'dbprocessing_inspector_{0}'.format(hashlib.sha1(code.encode('utf-8')).hexdigest())
+        module = imp.load_source(name, code)
+        DBlogging.dblogger.debug("Loaded inspector {0} as {1}".format(code, name))
+        self.inspectorModules[code] = (stamp, module)
+        return module
+
+    def _importFromIncomingPool(self, vals, workers, batch=100):
+        """
+        importFromIncoming with the inspecting done in a pool of worker
+        processes, this process is the only one that writes to the db
+        """
+        # files already in the db are not worth sending to a worker
+        todo = []
+        for val in vals:
+            self.set_filename(val)
+            id = self.dbu.fileInDB(self.basename)
+            if id is None:
+                todo.append(val)
+                continue
+            DBlogging.dblogger.info(
+                'File {0}:{1} was already in DB, not inspecting'.format(id, self.basename))
+            self.moveToError(self.filename)
+            print('Removed from incoming: {0} - already present'.format(self.basename))
+        DBlogging.dblogger.info("Inspecting {0} files with {1} workers".format(len(todo), workers))
+
+        pool = multiprocessing.Pool(workers, _inspectorWorkerInit, (self.mission,))
+        try:
+            T0 = time.time()
+            pending = []
+            for ii, (filename, params) in enumerate(pool.imap_unordered(_inspectorWorker, todo), 1):
+                self.set_filename(filename)
+                if params is None:
+                    df = None
+                    self.diskfileToDB(df)
+                else:
+                    df = Diskfile.Diskfile(filename, self.dbu)
+                    df.params.update(params)
+                pending.append((df, self.basename, ii, len(todo) - ii, time.time() - T0))
+                T0 = time.time()
+                if len(pending) >= batch:
+                    self._ingestPending(pending)
+            self._ingestPending(pending)
+        finally:
+            pool.close()
+            pool.join()
+
+    def figureProduct(self, filename=None, inspectors=None):
         """
         This function imports the inspectors and figures out which inspectors claim the file
+
+        :keyword inspectors: only try these (from :meth:`getInspectors`), by
+                             default the ones of :meth:`candidateInspectors`
+                             first and then the rest
         """
         if filename is None:
             filename = self.filename
-        act_insp = self.dbu.getActiveInspectors()
+        if inspectors is None:
+            act_insp = self.candidateInspectors(filename)
+            # an inspector can decline a file its format matches, the others
+            #   are then tried in order the same as without the prefilter
+            act_insp = act_insp + [v for v in self.getInspectors() if v not in act_insp]
+        else:
+            act_insp = inspectors
         claimed = []
         for code, desc, arg, product in act_insp:
             try:
-                inspect = imp.load_source('inspect', code)
+                inspect = self.loadInspector(code)
             except IOError as msg:
                 DBlogging.dblogger.error('Inspector: "{0}" not found: {1}'.format(code, msg))
                 if os.path.isfile(code + ' '):
@@ -264,77 +436,6 @@ class ProcessQueue(object):
 
         return claimed[0]  # return the diskfile
 
-    def _getRequiredProducts(self, process_id, file_id, utc_file_date, debug=False):
-        #####################################################
-        ## get all the input products for that process, and if they are optional
-        T0 = time.time()
-        input_product_id = self.dbu.getInputProductID(process_id, True)  # this is a list of tuples (id, optional, yesterday, tommorow)
-        if debug: print("21:    {0}: self.dbu.getInputProductID: {1}".format(time.time() - T0, input_product_id))
-        T0 = time.time()
-
-        DBlogging.dblogger.debug(
-            "Finding input files for file_id:{0} process_id:{1} date:{2}".format(file_id, process_id, utc_file_date))
-
-        ## here decide how we build output and do it.
-
-        timebase = self.dbu.getProcessTimebase(process_id)
-        if debug: print("22:    {0}: self.dbu.getProcessTimebase: {1}".format(time.time() - T0, timebase))
-        T0 = time.time()
-
-
-        DBlogging.dblogger.debug("Doing {0} based processing".format(timebase))
-        if timebase in ['FILE', 'DAILY', 'RUN']:  # taking one file to the next file
-            # for file based processing we are going to look to the "process_keywords" and cull the
-            #   returned files based on making sure they are all the same
-            #   If process_keywords is none it will fall back to current behavior (since they will all be the same)
-            files = []
-            # get all the possible files based on dates that we might want to put into the process now
-
-            for iprod_id, opt, y, t in input_product_id:
-                # accept a datetime.datetime or datetime.date
-                dt = Utils.datetimeToDate(utc_file_date)
-                start = dt - datetime.timedelta(days=y)
-                end = dt + datetime.timedelta(days=t)
-
-                tmp_files = self.dbu.getFilesByProductDate(iprod_id, [start, end], newest_version=True)
-                if debug: print("23:    {0}: self.dbu.getFilesByProductDate, {1} {2} {3}".format(time.time() - T0, iprod_id, dt, tmp_files))
-                T0 = time.time()
-
-
-                if not tmp_files and not opt:
-                    return None, input_product_id
-                else:
-                    files.extend(tmp_files)
-
-            DBlogging.dblogger.debug("buildChildren files: ".format(str(files)))
-
-            ###############
-            # BAL 30 March 2017, dropping this clean step as they should all be newest version per above
-            # remove all the files that are not the newest version, they all should be
-            # files = self.dbu.file_id_Clean(files)
-            ###############
-
-            if timebase == 'FILE':  # taking one file to the next file
-                files_out = []
-                # grab the process_keywords column for the file_id and all the possible other files
-                #   they have to match in order for the file to be the same
-                infile_process_keywords = self.dbu.getEntry('File', file_id).process_keywords
-                try:
-                    files_process_keywords = [v.process_keywords for v in files]
-                except AttributeError:
-                    files_process_keywords = []
-                # now if the process_keywords in files_process_keywords does not match that in infile_process_keywords
-                #   drop it
-                for ii, v in enumerate(files_process_keywords):
-                    if v == infile_process_keywords:
-                        files_out.append(files[ii])
-                # and give it the right name
-                files = files_out
-        else:
-            raise (NotImplementedError('Not implemented yet: {0} based processing'.format(timebase)))
-            raise (ValueError('Bad timebase for product: {0}'.format(process_id)))
-        return files, input_product_id
-
     def buildChildren(self, file_id, debug=False, skip_run=False, run_procs=None):
         """
         go through and all the runMe's and add to the runme_list variable
@@ -346,63 +447,73 @@ class ProcessQueue(object):
                               or process names to run; other processes are
                               ignored. (Default: all possible processes).
         """
+        DBlogging.dblogger.debug("Entered buildChildren: file_id={0}".format(file_id))
+        if debug: print("Entered buildChildren: file_id={0}".format(file_id))
+        self.buildChildrenBatch([file_id], skip_run=skip_run, run_procs=run_procs)
+
+    def buildChildrenBatch(self, file_ids, skip_run=False, run_procs=None):
+        """
+        Build the children of many processqueue entries at once and add the
+        runMe's to the runme_list variable
+
+        This does what buildChildren does for each entry, but the (product, date)
+        windows every child process needs are worked out first and the newest
+        files for all of them are found with a few set based queries
+        (:meth:`.DButils.getNewestFiles`), the runMe's are then built from those.
 
+        :param list file_ids: (file_id, version_bump) for each entry, as given by
+                              Processqueue.popBatch() or Processqueue.drain()
+        :param bool skip_run: Skip RUN timebase processes if True
+                              (default False)
+        :param str run_procs: If provided, comma-separated list of process IDs
+                              or process names to run; other processes are
+                              ignored. (Default: all possible processes).
+        """
         # if processes to run specified, turn into list of IDs
         # getProcessID accepts either ID or name and returns ID
         if run_procs is not None:
             run_procs = [self.dbu.getProcessID(rp)
                          for rp in run_procs.split(',')]
 
-        T0 = time.time()
-        DBlogging.dblogger.debug("Entered buildChildren: file_id={0}".format(file_id))
-        if debug: print("Entered buildChildren: file_id={0}".format(file_id))
-        # if this file is not a newest_version we do not ant to run
-        #print("{1}: Entered buildChildren: file_id={0}".format(file_id, time.time()-T0))
-        T0 = time.time()
-        if not self.dbu.fileIsNewest(file_id[0]):
-            DBlogging.dblogger.debug("Was not newest version in buildChildren: file_id={0}".format(file_id))
-            print("    Was not newest version in buildChildren: file_id={0}".format(file_id))
-            return  # do nothing
-            if debug: print("    {1}: was newest moving on in buildChildren: file_id={0}".format(file_id, time.time()-T0))
-        T0 = time.time()
-
-        children = self.dbu.getChildrenProcesses(file_id[0])  # returns process
-        if debug: print("11:   {1}: done self.dbu.getChildrenProcesses buildChildren: file_id={0} : {2}".format(file_id, time.time()-T0, children))
-        T0 = time.time()
-        daterange = self.dbu.getFileDates(file_id[0])  # this is the dates that this file spans
-        if debug: print("12:   {1}: done self.dbu.getFileDates  buildChildren: file_id={0} : {2}".format(file_id, time.time()-T0, daterange))
-        T0 = time.time()
-
-        if debug: print("children: {0}".format(children))
-        for child_process in children:
-
-            # iterate over all the days between the start and stop date from above (including stop date)
-            for utc_file_date in Utils.expandDates(*daterange):
-                if debug: print("    utc_file_date: {0}".format(utc_file_date))
-                files, input_product_id = self._getRequiredProducts(child_process, file_id[0], utc_file_date)
-                if debug: print("13:   {0}: self._getRequiredProducts   {1} {2}".format(time.time()-T0, files, input_product_id))
-                T0 = time.time()
-                if not files:
-                    # figure out the missing products
-                    DBlogging.dblogger.debug("For file: {0} date: {1} required files not present {2}"
-                                             .format(file_id[0], utc_file_date, input_product_id))
-                    continue  # go on to the next file
-
-                    # ==============================================================================
-                    # do we have the required files to do the build?
-                    # ==============================================================================
-                    ##             if not self._requiredFilesPresent(files, input_product_id, process_id):
-                    ##                 DBlogging.dblogger.debug("For file: {0} date: {1} required files not present".format(file_id[0], utc_file_date))
-                    ##                 continue # go on to the next file
-
-                try:
-                    input_files = [v.file_id for v in files]
-                except AttributeError:
-                    continue
-                DBlogging.dblogger.debug("Input files found, {0}".format(input_files))
-
-                if skip_run \
-                   and self.dbu.getProcessTimebase(child_process) == 'RUN':
+        DBlogging.dblogger.debug("Entered buildChildrenBatch: {0} entries".format(len(file_ids)))
+        files = {}
+        for chunk in Utils.chunker(list(set(v[0] for v in file_ids)), 500):
+            for f in self.dbu.session.query(self.dbu.File).filter(self.dbu.File.file_id.in_(chunk)):
+                files[f.file_id] = f
+
+        # if a file is not a newest_version we do not want to run, a file with
+        #   no utc_file_date is always newest (same as fileIsNewest)
+        windows = {}
+        for f in files.values():
+            if f.utc_file_date is not None:
+                windows.setdefault(f.product_id, set()).add(f.utc_file_date)
+        newest = self.dbu.getNewestFiles(windows)
+
+        children = {} # product_id -> processes that take it as input
+        inputs = {} # process_id -> [(input_product_id, optional, yesterday, tomorrow)]
+        timebase = {} # process_id -> output_timebase
+        candidates = [] # (process_id, utc_file_date, file, version_bump)
+        seen = set()
+        windows = {}
+        for file_id, version_bump in file_ids:
+            f = files.get(file_id)
+            if f is None:
+                DBlogging.dblogger.error("file_id={0} in the processqueue is not in the DB".format(file_id))
+                continue
+            if f.utc_file_date is not None and \
+                    getattr(newest.get((f.product_id, f.utc_file_date)), 'file_id', None) != f.file_id:
+                DBlogging.dblogger.debug("Was not newest version in buildChildren: file_id={0}".format(file_id))
+                print("    Was not newest version in buildChildren: file_id={0}".format(file_id))
+                continue
+            if f.product_id not in children:
+                children[f.product_id] = self.dbu.getProcessFromInputProduct(f.product_id)
+            for child_process in children[f.product_id]:
+                if child_process not in timebase:
+                    timebase[child_process] = self.dbu.getProcessTimebase(child_process)
+                    inputs[child_process] = self.dbu.getInputProductID(child_process, True)
+                if timebase[child_process] not in ['FILE', 'DAILY', 'RUN']:
+                    raise (NotImplementedError('Not implemented yet: {0} based processing'.format(timebase[child_process])))
+                if skip_run and timebase[child_process] == 'RUN':
                     DBlogging.dblogger.info(
                         "Process: {} skipping because RUN timebase"
                         .format(self.dbu.getEntry('Process', child_process)
@@ -414,13 +525,72 @@ class ProcessQueue(object):
                         .format(self.dbu.getEntry('Process', child_process)
                                 .process_name))
                     continue
-                runme = runMe.runMe(self.dbu, utc_file_date, child_process, input_files, self, file_id[1])
-                #print("{0}:  runMe.runMe".format(time.time()-T0))
-                #T0 = time.time()
-                # only add to runme list if it can be run
-                if runme.ableToRun and (runme not in self.runme_list):
-                    self.runme_list.append(runme)
-                    DBlogging.dblogger.info("Filename: {0} is not in the DB, can process".format(runme.filename))
+                # iterate over all the days between the start and stop date of the file (including stop date)
+                for utc_file_date in Utils.expandDates(f.utc_start_time.date(), f.utc_stop_time.date()):
+                    utc_file_date = utc_file_date.date()
+                    # for FILE the process_keywords of the file pick the inputs so they are part of what is unique
+                    key = (child_process, utc_file_date, version_bump,
+                           f.process_keywords if timebase[child_process] == 'FILE' else None)
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    candidates.append((child_process, utc_file_date, f, version_bump))
+                    for iprod_id, opt, y, t in inputs[child_process]:
+                        windows.setdefault(iprod_id, set()).update(
+                            utc_file_date + datetime.timedelta(days=d) for d in range(-y, t + 1))
+
+        # one pass over the DB for all the inputs of all the candidates
+        newest = self.dbu.getNewestFiles(windows)
+        DBlogging.dblogger.debug("buildChildrenBatch: {0} candidate runs".format(len(candidates)))
+        # what is in runme_list now, it can have been changed since the last call
+        #   (runner() empties it) so this is made again each time
+        planned = set(v.key for v in self.runme_list)
+
+        for child_process, utc_file_date, f, version_bump in candidates:
+            input_files = []
+            for iprod_id, opt, y, t in inputs[child_process]:
+                tmp_files = [newest[(iprod_id, utc_file_date + datetime.timedelta(days=d))]
+                             for d in range(-y, t + 1)
+                             if (iprod_id, utc_file_date + datetime.timedelta(days=d)) in newest]
+                if not tmp_files and not opt:
+                    input_files = None
+                    break
+                input_files.extend(tmp_files)
+            if input_files and timebase[child_process] == 'FILE':
+                # the process_keywords of all the inputs have to match those of the file
+                input_files = [v for v in input_files if v.process_keywords == f.process_keywords]
+            if not input_files:
+                # figure out the missing products
+                DBlogging.dblogger.debug("For file: {0} date: {1} required files not present {2}"
+                                         .format(f.file_id, utc_file_date, inputs[child_process]))
+                continue  # go on to the next file
+            input_files = [v.file_id for v in input_files]
+            DBlogging.dblogger.debug("Input files found, {0}".format(input_files))
+
+            runme = runMe.runMe(self.dbu, utc_file_date, child_process, input_files, self, version_bump)
+            # only add to runme list if it can be run
+            if runme.ableToRun and (runme.key not in planned):
+                planned.add(runme.key)
+                self.runme_list.append(runme)
+                DBlogging.dblogger.info("Filename: {0} is not in the DB, can process".format(runme.filename))
+
+    def planChildren(self, file_ids, skip_run=False, run_procs=None):
+        """
+        :meth:`buildChildrenBatch` for files made in this run, the runMe's
+        are returned and not put in runme_list (see :func:`.runMe.runner`)
+
+        :param list file_ids: file_id of the files
+        :return: the runMe's for the children of the files
+        :rtype: list
+        """
+        runme_list = self.runme_list
+        self.runme_list = []
+        try:
+            self.buildChildrenBatch([(f, None) for f in file_ids], skip_run=skip_run,
+                                    run_procs=run_procs)
+            return self.runme_list
+        finally:
+            self.runme_list = runme_list
 
     def onStartup(self):
         """
@@ -494,3 +664,26 @@ class ProcessQueue(object):
         except DButils.DBNoData:
             DBlogging.dblogger.error('No inst_id {0} found in the DB'.format(id_in))
 
+
+_worker_pq = None
+"""ProcessQueue of an ingest worker process, see _inspectorWorkerInit"""
+
+def _inspectorWorkerInit(mission):
+    """
+    Start an ingest worker process, each one has its own ProcessQueue
+    (and so db connection and inspector cache)
+    """
+    global _worker_pq
+    _worker_pq = ProcessQueue(mission)
+
+def _inspectorWorker(filename):
+    """
+    Inspect (and checksum) a file in an ingest worker process
+
+    :return: the filename and the params of its Diskfile, None if no inspector claimed it
+    :rtype: tuple
+    """
+    df = _worker_pq.figureProduct(filename)
+    if df is None:
+        return filename, None
+    return filename, df.params
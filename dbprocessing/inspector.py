@@ -67,9 +67,8 @@ class inspector(object):
         self.basename = os.path.basename(self.filename)
         self.dirname = os.path.dirname(self.filename)
         self.product = product
-        self.filenameformat = self.dbu.getEntry('Product', self.product).format
-        DBformatter = DBstrings.DBformatter() #must instantiate class
-        self.filenameregex = DBformatter.re(self.filenameformat)
+        self.filenameformat = self.dbu.getEntry('Product', self.product, cached=True).format
+        self.filenameregex = DBstrings.template(self.filenameformat).re()
         self.diskfile = Diskfile.Diskfile(self.filename, self.dbu)
         insp = self.inspect(kwargs)
         if insp is None:
@@ -93,12 +92,12 @@ class inspector(object):
         self.diskfile.mission = ptb['mission'].mission_name
         self.diskfile.params['file_create_date'] = datetime.datetime.fromtimestamp(os.path.getmtime(self.diskfile.infile))
         self.diskfile.params['exists_on_disk'] = True  # we are parsing it so it exists_on_disk
-        self.diskfile.params['shasum'] = Diskfile.calcDigest(self.diskfile.infile)
+        self.diskfile.params['shasum'] = self.dbu.getDigestCache().digest(self.diskfile.infile)
         self.diskfile.params['product_id'] = self.product
         if self.diskfile.params['data_level'] is not None:
             DBlogging.dblogger.info("Inspector {0}:  set level to {1}, this is ignored and set by the product definition".format(self.code_name, self.diskfile.params['data_level']))
             warnings.warn("Inspector {0}:  set level to {1}, this is ignored and set by the product definition".format(self.code_name, self.diskfile.params['data_level']))
-        self.diskfile.params['data_level'] = self.dbu.getEntry('Product', self.product).level
+        self.diskfile.params['data_level'] = self.dbu.getEntry('Product', self.product, cached=True).level
 
 
     def __call__(self):
@@ -1,21 +1,33 @@
 from __future__ import print_function
 from __future__ import absolute_import
 
+import collections
 from collections import namedtuple
 import datetime
+import errno
+import fcntl
 import glob
+import heapq
 from operator import itemgetter, attrgetter
 import os
 import pdb
+import select
 import shutil
+import signal
 import subprocess
 import tempfile
+import threading
 import time
 import traceback
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
 
 from . import DBlogging
 from . import DBstrings
 from . import DButils
+from .Diskfile import DigestCache
 from .inspector import extract_Version
 from . import Utils
 from .Utils import dateForPrinting as DFP
@@ -28,16 +40,32 @@ used in _start_a_run() and runner() to hold the runme object that is running,
 the time it started, and the probfile pointer
 """
 
+FSYNC_BATCH = 50
+"""number of outputs runner() puts in the db between each fsync, if it fsyncs"""
+
+CASCADE_DEPTH = 10
+"""
+number of times runner() plans the children of outputs it made in the same
+run, the outputs past this are left on the processqueue for the next run
+"""
+
 class ProcessException(Exception):
     """Class for errors in running processes"""
     pass
 
 
-def mk_tempdir(suffix='_dbprocessing'):
+def mk_tempdir(suffix='_dbprocessing', dir=None):
     """
-    Create a secure temp directory
+    Create a secure temp directory, in dir if given (it is made if needed)
+    otherwise in the system temp directory
     """
-    tempdir = tempfile.mkdtemp(suffix=suffix)
+    if dir is not None and not os.path.isdir(dir):
+        try:
+            os.makedirs(dir)
+        except OSError: # someone else made it first
+            if not os.path.isdir(dir):
+                raise
+    tempdir = tempfile.mkdtemp(suffix=suffix, dir=dir)
     DBlogging.dblogger.debug("Created temp directory: {0}".format(tempdir))
     return tempdir
 
@@ -131,35 +159,444 @@ def _start_a_run(runme):
             raise(RuntimeError("Should not have gotten here"))
 
 
-def runner(runme_list, dbu, MAX_PROC=2, rundir=None):
+class _JobGraph(object):
     """
-    Go through a list of runMe objects and run them
+    Dependency graph between the runMe objects handed to runner()
+
+    A runMe depends on another one in the graph if the other one makes a file
+    of a product, on a date, that falls inside its input window (the
+    productprocesslink of its process with yesterday/tomorrow). A runMe only
+    becomes ready once everything it depends on has finished, ready runMes
+    come out in (data_level, filename) order.
+    """
+    BACKFILL = 50
+    """number of ready runMes pop() looks at for one that fits"""
+    MAX_PASSED = 10
+    """times the first ready runMe can be passed over for smaller ones"""
+
+    def __init__(self, dbu):
+        self.dbu = dbu
+        self.jobs = {} # index -> runMe
+        self.index = {} # id(runMe) -> index
+        self.producers = {} # (product_id, utc_file_date) -> [index]
+        self.waiting = {} # index -> number of predecessors not yet done
+        self.children = {} # index -> [index]
+        self.ready = [] # heap of (data_level, filename, index)
+        self.done_jobs = set()
+        self.passed = {} # index -> times it was passed over while first in ready
+        self.outputs = set() # output filenames of all the runMe's ever added
+        self._windows = {} # process_id -> [(product_id, yesterday, tomorrow)]
+        self._count = 0
+
+    def __len__(self):
+        """number of runMe objects not yet handed out"""
+        return len(self.ready) + len(self.waiting)
+
+    def _inputKeys(self, runme):
+        """
+        All the (product_id, utc_file_date) a runMe can read from
+        """
+        if runme.process_id not in self._windows:
+            self._windows[runme.process_id] = [(v[0], v[2], v[3])
+                for v in self.dbu.getInputProductID(runme.process_id, True)]
+        keys = set()
+        for prod, yesterday, tomorrow in self._windows[runme.process_id]:
+            for d in range(-(yesterday or 0), (tomorrow or 0) + 1):
+                keys.add((prod, runme.utc_file_date + datetime.timedelta(days=d)))
+        return keys
+
+    def add(self, runme_list):
+        """
+        Add runMe objects to the graph, they can depend on anything already
+        in the graph that is not done yet
+        """
+        new = []
+        for runme in sorted(runme_list, key=lambda x: (x.data_level, x.filename)):
+            idx = self._count
+            self._count += 1
+            self.jobs[idx] = runme
+            self.index[id(runme)] = idx
+            self.outputs.add(os.path.basename(runme.filename))
+            self.children[idx] = []
+            if runme.data_level != 5000: # RUN timebase makes nothing
+                self.producers.setdefault((runme.out_prod, runme.utc_file_date), []).append(idx)
+            new.append(idx)
+        for idx in new:
+            runme = self.jobs[idx]
+            parents = set()
+            for key in self._inputKeys(runme):
+                parents.update(self.producers.get(key, []))
+            parents.discard(idx)
+            parents.difference_update(self.done_jobs)
+            for parent in parents:
+                self.children[parent].append(idx)
+            if parents:
+                self.waiting[idx] = len(parents)
+                DBlogging.dblogger.debug("{0} waits on {1}".format(runme.filename,
+                    [self.jobs[v].filename for v in parents]))
+            else:
+                self._setReady(idx)
+
+    def busy(self, runme):
+        """
+        True if a runMe in the graph that is not done yet makes a file that
+        runme could read, runme would then be planned without that input
+        """
+        for key in self._inputKeys(runme):
+            for idx in self.producers.get(key, []):
+                if idx not in self.done_jobs:
+                    return True
+        return False
+
+    def _setReady(self, idx):
+        runme = self.jobs[idx]
+        heapq.heappush(self.ready, (runme.data_level, runme.filename, idx))
+
+    def pop(self, force=False, fits=None):
+        """
+        Return the next ready runMe or None if there are none
+
+        :param force: if nothing is ready take the first waiting runMe anyway,
+                      used when nothing is running so a cycle cannot hang the run
+        :param fits: callable taking a runMe, if given return the first ready
+                     runMe it is True for, so smaller runMes backfill around
+                     one that does not fit right now. Only the first
+                     :attr:`BACKFILL` ready runMes are looked at and once the
+                     first one has been passed over :attr:`MAX_PASSED` times
+                     nothing else is started until it fits, so it cannot be
+                     starved by smaller ones.
+        """
+        if not self.ready and force and self.waiting:
+            idx = min(self.waiting, key=lambda x: (self.jobs[x].data_level, self.jobs[x].filename))
+            DBlogging.dblogger.warning("Dependency cycle, starting {0} anyway".format(self.jobs[idx].filename))
+            del self.waiting[idx]
+            self._setReady(idx)
+        if not self.ready:
+            return None
+        head = self.ready[0][-1]
+        if fits is None or fits(self.jobs[head]):
+            heapq.heappop(self.ready)
+            self.passed.pop(head, None)
+            return self.jobs[head]
+        if self.passed.get(head, 0) >= self.MAX_PASSED:
+            DBlogging.dblogger.debug("{0} was passed over {1} times, waiting for room".format(
+                self.jobs[head].filename, self.MAX_PASSED))
+            return None
+        skipped = [heapq.heappop(self.ready)]
+        runme = None
+        while self.ready and len(skipped) < self.BACKFILL:
+            item = heapq.heappop(self.ready)
+            if fits(self.jobs[item[-1]]):
+                runme = self.jobs[item[-1]]
+                self.passed[head] = self.passed.get(head, 0) + 1
+                break
+            skipped.append(item)
+        for item in skipped:
+            heapq.heappush(self.ready, item)
+        return runme
+
+    def done(self, runme):
+        """
+        Mark a runMe as finished (good or bad) and release the runMes waiting on it
+        """
+        idx = self.index[id(runme)]
+        self.done_jobs.add(idx)
+        for child in self.children.pop(idx):
+            if child not in self.waiting:
+                continue
+            self.waiting[child] -= 1
+            if not self.waiting[child]:
+                del self.waiting[child]
+                self._setReady(child)
+
+
+def _reap_children(processes):
+    """
+    Return the Popen objects of the running processes that have exited,
+    without waiting for any
+
+    Only the pids of processes are waited on, never any child (a SIGCHLD
+    can be from another child of this process, e.g. a multiprocessing pool
+    worker, that has to be left for its owner to reap).
+    """
+    return [p for p in processes if p.poll() is not None]
+
+
+class _Waker(object):
+    """
+    Self-pipe runner() sleeps on, it is woken by SIGCHLD (a process exited)
+    and by the completion thread (a task is done)
+
+    Outside of the main thread there is no signal handler so it polls.
+    """
+    POLL = 0.1
+
+    def __init__(self):
+        self.rfd, self.wfd = os.pipe()
+        for fd in (self.rfd, self.wfd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.timeout = None
+        try:
+            self._old_fd = signal.set_wakeup_fd(self.wfd)
+        except ValueError: # not the main thread
+            self._installed = False
+            self.timeout = self.POLL
+        else:
+            self._installed = True
+            self._old_handler = signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+            signal.siginterrupt(signal.SIGCHLD, False)
+
+    def wake(self):
+        try:
+            os.write(self.wfd, b'.')
+        except OSError: # the pipe is full, that will wake it too
+            pass
+
+    def wait(self):
+        """
+        Sleep until woken (or the poll time) and empty the pipe
+        """
+        try:
+            select.select([self.rfd], [], [], self.timeout)
+        except select.error as err:
+            if err.args[0] != errno.EINTR:
+                raise
+        try:
+            while os.read(self.rfd, 4096):
+                pass
+        except OSError as err:
+            if err.errno != errno.EAGAIN:
+                raise
+
+    def close(self):
+        if self._installed:
+            signal.signal(signal.SIGCHLD,
+                          signal.SIG_DFL if self._old_handler is None else self._old_handler)
+            signal.set_wakeup_fd(self._old_fd)
+        os.close(self.rfd)
+        os.close(self.wfd)
+
+
+class _Completion(threading.Thread):
+    """
+    Thread for the file work after a process finishes that does not need
+    the db, so runner() can start the next process right away. The
+    inspection of the output and putting it in the db stay in the main
+    thread, they use the db session (and so can inspectors). Tasks are
+    (stage, runMe) and are done in the order they are put, the stages are:
+
+    - hash: hash the output into the digest cache, the inspection of the
+      output in runner() then finds it there
+    - clean: remove the temp directory
+
+    A hashed runMe goes on :attr:`done` as (runMe, None), or (runMe, error)
+    if its output could not be hashed, and the waker is woken. A clean that
+    fails is only logged. :attr:`depth` is the number of tasks of each
+    stage not finished.
+    """
+    STAGES = ('hash', 'clean')
+
+    def __init__(self, digest_file, waker):
+        super(_Completion, self).__init__(name='dbprocessing-completion')
+        self.daemon = True
+        self.digest_file = digest_file
+        self.waker = waker
+        self.todo = Queue.Queue()
+        self.done = collections.deque()
+        self.depth = dict.fromkeys(self.STAGES, 0)
+        self._lock = threading.Lock()
+
+    def put(self, stage, runme):
+        with self._lock:
+            self.depth[stage] += 1
+        self.todo.put((stage, runme))
+
+    def run(self):
+        cache = None
+        while True:
+            task = self.todo.get()
+            if task is None:
+                break
+            stage, runme = task
+            error = None
+            try:
+                if stage == 'hash':
+                    if cache is None: # sqlite connections stay in their thread
+                        cache = DigestCache(self.digest_file)
+                    cache.digest(os.path.join(runme.tempdir, runme.filename))
+                else:
+                    rm_tempdir(runme.tempdir)
+            except Exception as msg:
+                error = msg
+                DBlogging.dblogger.warning("{0} of {1} failed: {2}".format(stage, runme.filename, msg))
+            if stage == 'hash': # on done before it is off depth so it is always counted
+                self.done.append((runme, error))
+            with self._lock:
+                self.depth[stage] -= 1
+            if stage == 'hash':
+                self.waker.wake()
+        if cache is not None:
+            cache.close()
+
+    def stop(self):
+        """
+        Finish the tasks already put and end the thread
+        """
+        self.todo.put(None)
+        self.join()
+
+
+def _fits(runme, running, max_cpu=None, max_ram=None):
+    """
+    True if runme can start next to the running runMe's and stay inside
+    max_cpu and max_ram (None for no limit), with nothing running anything fits
+    """
+    if not running: # always run something, even if it is bigger than the node
+        return True
+    if max_cpu is not None and sum(v.cpu for v in running) + runme.cpu > max_cpu:
+        return False
+    if max_ram is not None and sum(v.ram for v in running) + runme.ram > max_ram:
+        return False
+    return True
+
+
+def _registerOutputs(runmes):
+    """
+    Put the outputs of runmes in the db, the ones that inspect as what the
+    runMe made (:meth:`runMe._inspectOutput`) all go in with one transaction
+    and are moved to their product directory, the others go through incoming
+    """
+    found = []
+    for rm in runmes:
+        df = rm._inspectOutput(rm.cmdline)
+        if df is None:
+            rm.moveToIncoming(os.path.join(rm.tempdir, rm.filename))
+            rm._add_links(rm.cmdline)
+        else:
+            found.append((rm, df))
+    if found:
+        # the files, their filecodelinks and a filefilelink for each input file go in together
+        f_ids = found[0][0].pq.diskfilesToDB([df for rm, df in found],
+                                              links=[(rm.code_id, rm.input_files) for rm, df in found])
+        for (rm, df), f_id in zip(found, f_ids):
+            rm.output_file_id = f_id
+
+
+def _fsyncOutputs(dbu, file_ids):
+    """
+    fsync the files of file_ids and their directories and empty file_ids
+    """
+    if file_ids:
+        Utils.fsyncFiles(dbu.getFileFullPaths(file_ids).values())
+        DBlogging.dblogger.debug("fsync'd {0} output files".format(len(file_ids)))
+        del file_ids[:]
+
+
+def _cascade(graph, dbu, cascade, to_cascade, rundir=None):
+    """
+    Plan the children of files made in this run and add them to graph
+
+    The children of a file wait (stay in to_cascade) while some runMe in the
+    graph that is not done could still make an input for them, once planned
+    the file is taken off the processqueue.
 
-    .. todo:: This function can be made a smart as one wants, for now it is not made to be smart, but flexible
+    :param cascade: callable taking file_ids and returning the runMe's for
+                    their children
+    :param dict to_cascade: file_id -> depth of the runMe's made from it
+    """
+    runmes = cascade(sorted(to_cascade))
+    waiting = set()
+    for runme in runmes:
+        if graph.busy(runme):
+            waiting.update(f for f in runme.input_files if f in to_cascade)
+    new = []
+    for runme in runmes:
+        made_from = [f for f in runme.input_files if f in to_cascade]
+        if waiting.intersection(made_from) or os.path.basename(runme.filename) in graph.outputs:
+            continue
+        runme.depth = max(to_cascade[f] for f in made_from) if made_from else 1
+        new.append(runme)
+    planned = [f for f in to_cascade if f not in waiting]
+    if planned:
+        dbu.Processqueue.remove(planned)
+        for f in planned:
+            del to_cascade[f]
+    if new:
+        paths = dbu.getFileFullPaths(set(i_fid for runme in new for i_fid in runme.input_files))
+        for runme in new:
+            runme.make_command_line(force=rundir is not None, rundir=rundir, paths=paths)
+        graph.add(new)
+    DBlogging.dblogger.debug("Cascade planned {0} files into {1} runs, {2} files wait".format(
+        len(planned), len(new), len(to_cascade)))
+
+
+def runner(runme_list, dbu, MAX_PROC=2, rundir=None, MAX_CPU=None, MAX_RAM=None,
+           fsync=False, cascade=None, max_depth=CASCADE_DEPTH):
+    """
+    Go through a list of runMe objects and run them
 
-    :param runme_list: List of runMe objects that need to be run
+    The runMe objects are put in a dependency graph (see :class:`_JobGraph`)
+    so that a process only waits on the processes that make its inputs and not
+    on everything of a lower level. The loop sleeps until a child exits
+    (SIGCHLD) and then starts whatever became ready. The hashing of outputs
+    and removal of temp directories are done in a thread (:class:`_Completion`)
+    so they do not hold up starting processes. The hashed outputs are
+    inspected and put in the db in batches by this loop, an output that could
+    not be hashed is a failed process. The number of runMe's in each stage is
+    logged.
+
+    Each runMe uses the cpu and ram of its code (the code table), when
+    MAX_CPU or MAX_RAM are given processes are only started while the sum
+    over the running ones stays inside them; a process that does not fit is
+    passed over for the next one that does, but only so many times (see
+    :meth:`_JobGraph.pop`). A process bigger than the whole budget runs once
+    nothing else is running.
+
+    :param runme_list: List of runMe objects that need to be run, it is emptied
     :type runme_list: list
 
     :param rundir: Directory to run in, if None then use a temp directory
     :type rundir: str
 
+    :param MAX_CPU: Total number of cpus the running processes can use, None for no limit
+    :type MAX_CPU: int
+
+    :param MAX_RAM: Total ram (GB) the running processes can use, None for no limit
+    :type MAX_RAM: float
+
+    :param fsync: fsync the outputs put in the db (and their directories),
+                  FSYNC_BATCH of them at a time and the rest at the end
+    :type fsync: bool
+
+    :param cascade: callable taking file_ids and returning the runMe's of
+                    their children (:meth:`.ProcessQueue.planChildren`), if
+                    given the outputs put in the db are planned in this run
+                    (see :func:`_cascade`) and not left for the next one
+    :param max_depth: outputs of runMe's this many cascades down are not
+                      planned, they stay on the processqueue
+    :type max_depth: int
+
     :return: number of processes that successfully completed, number of processes that failed
     :rtype: tuple(int, int)
     """
     ############################################################
     # 1) build up the command line and store in a commands list
-    # 2) loop over the commands
-    #  a) start up to MAX_PROC processes with subprocess.Popen
-    #  b) poll that they are done or not and if they finish successfully
+    # 2) put the commands in a graph on their inputs and outputs
+    # 3) loop over the commands
+    #  a) start up to MAX_PROC processes that are ready with subprocess.Popen
+    #  b) wait for one to finish and if they finish successfully
     #     i) True: add data to db
     #     ii) False: add errror messages
+    #  c) release the processes that were waiting on it
     ############################################################
 
     ## 11111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111
     # in make_command_line a tempdir gets created (self.tempdir) it will need to be cleaned
+    # the paths of all the input files are found at once
+    paths = dbu.getFileFullPaths(set(i_fid for runme in runme_list for i_fid in runme.input_files))
     for runme in runme_list:
         force = rundir is not None
-        runme.make_command_line(force = force, rundir=rundir)
+        runme.make_command_line(force = force, rundir=rundir, paths=paths)
 
     # sort the runme_list on level and filename (which is like date and product and s/c together)
     runme_list.sort(key = lambda x: (x.data_level, x.filename))
@@ -174,18 +611,21 @@ def runner(runme_list, dbu, MAX_PROC=2, rundir=None):
     # 6) if there are any inputs in the outputs drop those processes
     #########################################
     print("{0} len(runme_list)={1}".format(DFP(), len(runme_list)))
-    # 1
-    outfiles = [os.path.basename(v.filename) for v in runme_list]
-    # 2
-    #Delete IF not blank AND it's already in seen (if not seen, add it to seen,
-    #but don't delete)
+    # 1-3 in one pass, keep the first runMe of each (not blank) output file
     seen = set()
-    delvals = [i for i in range(len(outfiles)) if outfiles[i] != '' and
-               (outfiles[i] in seen or seen.add(outfiles[i]))]
-    for i in delvals[::-1]:
-        del runme_list[i]
+    kept = []
+    for runme in runme_list:
+        outfile = os.path.basename(runme.filename)
+        if outfile != '' and outfile in seen:
+            continue
+        seen.add(outfile)
+        kept.append(runme)
+    runme_list[:] = kept
     print("{0} len(runme_list)={1}".format(DFP(), len(runme_list)))
 
+    graph = _JobGraph(dbu)
+    graph.add(runme_list)
+    del runme_list[:] # the graph has them all now
 
     # TODO For a future revision think on adding a timeout ability to the subprocess
     #    see: http://stackoverflow.com/questions/1191374/subprocess-with-timeout
@@ -194,88 +634,153 @@ def runner(runme_list, dbu, MAX_PROC=2, rundir=None):
 
     n_good = 0 # number of processes successfully completed
     n_bad = 0 # number of processes failed
+    to_sync = [] # file_ids of outputs in the db not yet fsync'd
+    to_cascade = {} # file_id -> depth, outputs whose children are not planned yet
 
-    #    while runme_list or processes:
-    while runme_list or processes:
-        while (len(processes) < MAX_PROC) and runme_list:
-            runme = runme_list.pop(0) # pop from the list, it is sorted!!
-            if runme.data_level == 5000: #RUN timebase
-                runme.cmdline.pop(-1) #Chop the fake "output" file
+    def fits(runme):
+        """is there room on the node to start runme now"""
+        return _fits(runme, [v[0] for v in processes.values()], MAX_CPU, MAX_RAM)
 
-            DBlogging.dblogger.info("Command: {0} starting".format(os.path.basename(' '.join(runme.cmdline))))
+    waker = _Waker()
+    completion = _Completion(dbu.getDigestCache().filename if rundir is None else None, waker)
+    completion.start()
 
-            """
-            when we go to run a process capture all the stdout and stderr into a file in the running temp directory
-            if the process is successful then it just gets removed with the directory, otherwise move it to the error
-            directory
-            """
+    def unregistered():
+        """number of outputs not in the db yet, whatever reads them has to wait"""
+        return completion.depth['hash'] + len(completion.done)
 
-            print("{0} Process starting ({2}): {1}".format(DFP(), ' '.join(runme.cmdline), len(runme_list)))
-            if rundir is None:
-                prob_name = os.path.join(runme.tempdir, runme.filename + '.prob')
-            else:
-                prob_name = os.path.join(rundir, runme.filename + '.prob')
-            try:
-                fp = open(prob_name, 'w')
-                fp.write(' '.join(runme.cmdline))
-                fp.write('\n\n')
-                fp.write('-'*80)
-                fp.write('\n\n')
-                fp.flush()
-            except IOError:
-                DBlogging.dblogger.error("Could not create the prob file, so skipped {0}"
-                                            .format(os.path.basename(' '.join(runme.cmdline))))
-                #raise(IOError("Could not create the prob file, so died {0}".format(os.path.basename(' '.join(runme.cmdline)))))
-                try:
-                    rm_tempdir(runme.tempdir) # delete the tempdir
-                except OSError:
-                    pass
-                continue # move to next process
+    def depths():
+        """number of runMe's in each stage"""
+        return ', '.join('{0}={1}'.format(*v) for v in (
+            ('waiting', len(graph.waiting)), ('ready', len(graph.ready)), ('running', len(processes)),
+            ('hash', completion.depth['hash']), ('register', len(completion.done)),
+            ('clean', completion.depth['clean'])))
 
-            _start_a_run(runme)
-            processes[subprocess.Popen(runme.cmdline, stdout=fp, stderr=fp)] = (runme, time.time(), fp )
-            time.sleep(0.5)
+    try:
+        while graph or processes or unregistered():
+            while len(processes) < MAX_PROC:
+                # if nothing is running or on its way into the db there is a cycle, just go
+                runme = graph.pop(force=not processes and not unregistered(), fits=fits)
+                if runme is None:
+                    break
+                if runme.data_level == 5000: #RUN timebase
+                    runme.cmdline.pop(-1) #Chop the fake "output" file
 
-        for p in list(processes.keys()):
-            if p.poll() is None: # still running
-                continue
-            # OK process done, get the info from the dict
-            rm, t, fp = processes[p] # unpack the tuple
+                DBlogging.dblogger.info("Command: {0} starting".format(os.path.basename(' '.join(runme.cmdline))))
 
-            fp.close()
-            if p.returncode != 0: # non zero return code FAILED
-                DBlogging.dblogger.error("Command returned a non-zero return code ({1}): {0}"
-                                         .format(' '.join(rm.cmdline), p.returncode))
-                print("{0} Command returned a non-zero return code: {1}\n\t{2}".format(DFP(), ' '.join(rm.cmdline), p.returncode))
+                """
+                when we go to run a process capture all the stdout and stderr into a file in the running temp directory
+                if the process is successful then it just gets removed with the directory, otherwise move it to the error
+                directory
+                """
 
+                print("{0} Process starting ({2}): {1}".format(DFP(), ' '.join(runme.cmdline), len(graph)))
                 if rundir is None:
-                    rm.moveToError(fp.name)
-                    # assume the file is bad and move it to error
-                    rm.moveToError(os.path.join(rm.tempdir, rm.filename))
-                    rm_tempdir(rm.tempdir) # delete the temp directory
-
+                    prob_name = os.path.join(runme.tempdir, runme.filename + '.prob')
+                else:
+                    prob_name = os.path.join(rundir, runme.filename + '.prob')
+                try:
+                    fp = open(prob_name, 'w')
+                    fp.write(' '.join(runme.cmdline))
+                    fp.write('\n\n')
+                    fp.write('-'*80)
+                    fp.write('\n\n')
+                    fp.flush()
+                except IOError:
+                    DBlogging.dblogger.error("Could not create the prob file, so skipped {0}"
+                                                .format(os.path.basename(' '.join(runme.cmdline))))
+                    #raise(IOError("Could not create the prob file, so died {0}".format(os.path.basename(' '.join(runme.cmdline)))))
+                    completion.put('clean', runme) # delete the tempdir
+                    graph.done(runme)
+                    continue # move to next process
+
+                _start_a_run(runme)
+                processes[subprocess.Popen(runme.cmdline, stdout=fp, stderr=fp)] = (runme, time.time(), fp )
+
+            # sleep until a child exits or the completion thread has something
+            if processes or unregistered():
+                waker.wait()
+
+            finished = []
+            for p in _reap_children(processes):
+                # OK process done, get the info from the dict
+                rm, t, fp = processes.pop(p) # unpack the tuple
+
+                fp.close()
+                if p.returncode != 0: # non zero return code FAILED
+                    DBlogging.dblogger.error("Command returned a non-zero return code ({1}): {0}"
+                                             .format(' '.join(rm.cmdline), p.returncode))
+                    print("{0} Command returned a non-zero return code: {1}\n\t{2}".format(DFP(), ' '.join(rm.cmdline), p.returncode))
+
+                    if rundir is None:
+                        rm.moveToError(fp.name)
+                        # assume the file is bad and move it to error
+                        rm.moveToError(os.path.join(rm.tempdir, rm.filename))
+                        completion.put('clean', rm) # delete the temp directory
+
+                    n_bad += 1
+                    finished.append(rm)
+
+                else: # p.returncode == 0  SUCCESS
+                    DBlogging.dblogger.info("Command: {0} took {1} seconds".format(os.path.basename(rm.cmdline[0]), time.time()-t))
+                    print("{0} Command: {1} took {2} seconds".format(DFP(), os.path.basename(rm.cmdline[0]), time.time()-t))
+
+                    if rundir is None and rm.data_level != 5000: # RUN timebases are allowed to not have files
+                        completion.put('hash', rm) # it is finished once it is in the db
+                        continue
+                    if rundir is None: # if rundir then this is a test
+                        completion.put('clean', rm) # delete the temp directory
+                    print("{0} Process {1} FINISHED".format(DFP(), ' '.join(rm.cmdline)))
+                    n_good += 1
+                    finished.append(rm)
+
+            # the outputs the completion thread hashed go in the db together
+            registering = []
+            while completion.done:
+                rm, error = completion.done.popleft()
+                if error is None:
+                    registering.append(rm)
+                    continue
+                # the process said it worked but its output cannot be read
+                DBlogging.dblogger.error("Command did not make a readable output ({1}): {0}"
+                                         .format(' '.join(rm.cmdline), error))
+                print("{0} Command did not make a readable output: {1}\n\t{2}".format(DFP(), ' '.join(rm.cmdline), error))
+                for fname in (rm.filename + '.prob', rm.filename):
+                    if os.path.exists(os.path.join(rm.tempdir, fname)):
+                        rm.moveToError(os.path.join(rm.tempdir, fname))
+                completion.put('clean', rm) # delete the temp directory
                 n_bad += 1
-
-            elif p.returncode == 0: # p.returncode == 0  SUCCESS
-                # this is not a perfect time since all the adding occurs before the next poll
-                DBlogging.dblogger.info("Command: {0} took {1} seconds".format(os.path.basename(rm.cmdline[0]), time.time()-t))
-                print("{0} Command: {1} took {2} seconds".format(DFP(), os.path.basename(rm.cmdline[0]), time.time()-t))
-
-                if rundir is None: # if rundir then this is a test
-                    if rm.data_level != 5000: # RUN timebases are allowed to not have files
-                        rm.moveToIncoming(os.path.join(rm.tempdir, rm.filename))
-                        rm._add_links(rm.cmdline)
-                    rm_tempdir(rm.tempdir) # delete the temp directory
-
-                print("{0} Process {1} FINISHED".format(DFP(), ' '.join(rm.cmdline)))
-                n_good += 1
-            else:
-                raise(ValueError("Should not have gotten here"))
-
-            # execution gets here if the process finished
-            del processes[p]
-        time.sleep(0.5)
-
+                finished.append(rm)
+            if registering:
+                _registerOutputs(registering)
+                for rm in registering:
+                    if fsync and rm.output_file_id is not None:
+                        to_sync.append(rm.output_file_id)
+                    completion.put('clean', rm) # delete the temp directory
+                    print("{0} Process {1} FINISHED".format(DFP(), ' '.join(rm.cmdline)))
+                    n_good += 1
+                    finished.append(rm)
+                if len(to_sync) >= FSYNC_BATCH:
+                    _fsyncOutputs(dbu, to_sync)
+
+            for rm in finished:
+                # anything waiting on this one can go now, the inputs it has are all it will get
+                graph.done(rm)
+                if cascade is not None and rm.output_file_id is not None:
+                    if rm.depth < max_depth:
+                        to_cascade[rm.output_file_id] = rm.depth + 1
+                    else:
+                        DBlogging.dblogger.warning("Cascade depth {0} reached, {1} left on the processqueue".format(
+                            max_depth, rm.filename))
+            if finished and to_cascade:
+                _cascade(graph, dbu, cascade, to_cascade, rundir)
+            DBlogging.dblogger.debug("runner stages: {0}".format(depths()))
+    finally:
+        completion.stop()
+        waker.close()
+
+    if fsync:
+        _fsyncOutputs(dbu, to_sync)
     return n_good, n_bad
 
 
@@ -294,6 +799,8 @@ class runMe(object):
             utc_file_date = utc_file_date.date()
 
         self.filename = '' # initialize it empty
+        self.output_file_id = None # file_id of the output once it is in the db
+        self.depth = 0 # how many cascades of runner() down this runMe is
         self.ableToRun = False
         self.extra_params = []
         self.args = []
@@ -303,6 +810,8 @@ class runMe(object):
         self.process_id = process_id
         self.input_files = input_files
         self.version_bump = version_bump
+        self.cpu = 1 # resources the code needs, from the code table
+        self.ram = 0
         # since we have a process do we have a code that does it?
         self.code_id = self.dbu.getCodeFromProcess(process_id, utc_file_date)
         if self.code_id is None: # there is no code to actually run we are done
@@ -322,9 +831,13 @@ class runMe(object):
         DBlogging.dblogger.debug("Going to run code: {0}:{1}".format(self.code_id, self.codepath))
         self.codedir = os.path.dirname(self.codepath)
 
-        process_entry = self.dbu.getEntry('Process', self.process_id)
-        code_entry = self.dbu.getEntry('Code', self.code_id)
+        process_entry = self.dbu.getEntry('Process', self.process_id, cached=True)
+        code_entry = self.dbu.getEntry('Code', self.code_id, cached=True)
         output_interface_version = code_entry.output_interface_version
+        if code_entry.cpu is not None:
+            self.cpu = code_entry.cpu
+        if code_entry.ram is not None:
+            self.ram = code_entry.ram
 
         # set the default version for the output file
         self.output_version = Version.Version(output_interface_version, 0, 0)
@@ -351,12 +864,11 @@ class runMe(object):
             ## we have a filename, now we need to increment versions as needed/appropriate to
             ## come up with a unique one
 
-            fmtr = DBstrings.DBformatter()
+            tmpl = DBstrings.template(format_str)
             # in this loop see if the file can be created i.e. ges not already exist in the db
             while True:
                 # make the filename in the loop as output_version is manipulated below
-                self.filename = fmtr.format(
-                    format_str,
+                self.filename = tmpl.format(
                     SATELLITE=ptb['satellite'].satellite_name,
                     PRODUCT=ptb['product'].product_name,
                     VERSION=str(self.output_version),
@@ -425,40 +937,49 @@ class runMe(object):
 
     __repr__ = __str__
 
+    @property
+    def key(self):
+        """
+        What the runMe does, two runMe with the same key run the same process
+        on the same inputs to make the same file: (process_id, utc_file_date,
+        sorted input_files, output filename, output version)
+        """
+        version = getattr(self, 'output_version', None)
+        if version is not None:
+            version = (version.interface, version.quality, version.revision)
+        return (self.process_id, self.utc_file_date, tuple(sorted(self.input_files)),
+                os.path.basename(self.filename), version)
+
     def __eq__(self, other):
         """
-        define what equals means for 2 runme objects
+        define what equals means for 2 runme objects, the same key
         """
-        attrs = ['ableToRun', 'code_id', 'extra_params', 'input_files', 'out_prod', 'pq',
-                 'args', 'codepath', 'filename', 'output_version', 'process_id', 'utc_file_date']
         if not isinstance(other, runMe):
-            raise(TypeError("Cannot compare runMe with {0}".format(type(other))))
-        for a in attrs:
-            if getattr(self, a) != getattr(other, a):
-                return False
-        return True # made it though them all
-
-##     def __hash__(self):
-##         """
-##         implement a custom hash so that in will work and ignore the temp directory that is always different
-##         """
-##         attrs = ['ableToRun', 'code_id', 'data_level', 'extra_params', 'input_files', 'out_prod', 'pq',
-##                  'args', 'codepath', 'filename', 'output_version', 'process_id', 'utc_file_date']
-##         return hash(tuple([getattr(self, a) for a in attrs]))
+            return NotImplemented
+        return self.key == other.key
+
+    def __ne__(self, other):
+        ans = self.__eq__(other)
+        return ans if ans is NotImplemented else not ans
+
+    def __hash__(self):
+        """
+        hash the key so runMe can go in sets and dicts (ignores the temp
+        directory that is always different)
+        """
+        return hash(self.key)
 
     def _fileInDB(self):
         """
         check the filename we created and see if it is in the, if it is we will
         not process with that name
         """
-        try:
-            DBlogging.dblogger.debug("Filename: {0} check in db".format(self.filename))
-            f_id_db = self.dbu.getFileID(self.filename)
-            DBlogging.dblogger.info("Filename: {0} is in the DB, have to make different version".format(self.filename))
-            return f_id_db
-        except (DButils.DBError, DButils.DBNoData):
-            #DBlogging.dblogger.info("Filename: {0} is not in the DB, can process".format(self.filename))
+        DBlogging.dblogger.debug("Filename: {0} check in db".format(self.filename))
+        f_id_db = self.dbu.fileInDB(self.filename)
+        if f_id_db is None:
             return False
+        DBlogging.dblogger.info("Filename: {0} is in the DB, have to make different version".format(self.filename))
+        return f_id_db
 
     def _codeVerChange(self, f_id_db):
         """
@@ -534,25 +1055,30 @@ class runMe(object):
             self._incVersion([0,1,0])
             return True
 
+        # the newest file for the same date and product as each parent, all in one go
+        windows = {}
+        for parent in parents:
+            windows.setdefault(parent.product_id, []).append(parent.utc_file_date)
+        newest = self.dbu.getNewestFiles(windows)
+
         quality_diff = False
         revision_diff = False
         for parent in parents:
-            # get all the files for the same date and product as the parent to make sure
-            #  this is the newest
-            parents_all = self.dbu.getFilesByProductDate(parent.product_id, [parent.utc_file_date]*2)
-            parent_max = max(parents_all, key=lambda x: self.dbu.getFileVersion(x))
+            parent_max = newest.get((parent.product_id, parent.utc_file_date), parent)
+            parent_version = self.dbu.getFileVersion(parent)
+            max_version = self.dbu.getFileVersion(parent_max)
 
             DBlogging.dblogger.debug("parent: {0} version: {1} parent_max {2} version {3}".format(
-                parent.file_id, self.dbu.getFileVersion(parent), parent_max.file_id, self.dbu.getFileVersion(parent_max)))
+                parent.file_id, parent_version, parent_max.file_id, max_version))
 
 
             # if a parent is no longer newest we need to inc
-            if self.dbu.getFileVersion(parent) != self.dbu.getFileVersion(parent_max):
+            if parent_version != max_version:
                 # we have a parent file for a certain date,
                 #   get all the files for that date and see if the parent is the newest
                 #   if it is then that parent has not changed, do not run
                 #   if there is a newer parent then we do need to run
-                df = self.dbu.getFileVersion(parent_max) - self.dbu.getFileVersion(parent)
+                df = max_version - parent_version
                 DBlogging.dblogger.debug("Found a difference between files {0} and {1} -- {2}".format(
                     parent.file_id, parent_max.file_id, df))
 
@@ -627,18 +1153,48 @@ class runMe(object):
             self.moveToError(current_file)
             return
         df.params['verbose_provenance'] = ' '.join(cmdline)
-        f_id = self.pq.diskfileToDB(df)
-        ## here the file is in the DB so we can add the filefilelink an filecodelinks
-        if f_id is not None: # None comes back if the file goes to error
-            self.dbu.addFilecodelink(f_id, self.code_id)
-            for val in self.input_files: # add a link for each input file
-                self.dbu.addFilefilelink(f_id, val)
+        # the file, its filecodelink and a filefilelink for each input file go in together
+        self.pq.diskfileToDB(df, links=(self.code_id, self.input_files))
 
-    def make_command_line(self, force=False, rundir=None):
+    def _inspectOutput(self, cmdline):
+        """
+        Inspect the output file so it can go straight into the db and its
+        product directory, only the inspectors of the output product look at
+        it and what they find has to be what this runMe made (product, date
+        and version)
+
+        :return: diskfile of the output, None if the file was not claimed as
+                 expected, it then has to go through incoming
+        :rtype: Diskfile
+        """
+        current_file = os.path.join(self.tempdir, self.filename)
+        inspectors = [v for v in self.pq.getInspectors() if v.product_id == self.out_prod]
+        if not inspectors:
+            return None
+        df = self.pq.figureProduct(current_file, inspectors=inspectors)
+        if df is None:
+            DBlogging.dblogger.info("{0} was not claimed by the inspector of product {1}".format(
+                self.filename, self.out_prod))
+            return None
+        utc_file_date = df.params['utc_file_date']
+        if isinstance(utc_file_date, datetime.datetime):
+            utc_file_date = utc_file_date.date()
+        found = (df.params['product_id'], utc_file_date, df.params['version'], df.params['filename'])
+        if found != (self.out_prod, self.utc_file_date, self.output_version, self.filename):
+            DBlogging.dblogger.info("{0} inspected as {1}, not what was made".format(self.filename, found))
+            return None
+        df.params['verbose_provenance'] = ' '.join(cmdline)
+        return df
+
+    def make_command_line(self, force=False, rundir=None, paths=None):
         """
         make a command line for actually doing this running
 
         NOTE: creates a temp directory that needs to be cleaned!!
+
+        :keyword paths: full path of the input files keyed by file_id (see
+                        :meth:`.DButils.getFileFullPaths`), looked up if None
+        :type paths: dict
         """
         # build the command line we are to run
         cmdline = [self.codepath]
@@ -648,11 +1204,15 @@ class runMe(object):
         # figure out how to put the arguments together
         cmdline.extend(self.args)
         # put all the input files on the command line (order is not set)
+        if paths is None:
+            paths = self.dbu.getFileFullPaths(self.input_files)
         for i_fid in self.input_files:
-            cmdline.append(self.dbu.getFileFullPath(i_fid))
+            cmdline.append(paths[i_fid])
         # the putname goes last
         if rundir is None:
-            self.tempdir = mk_tempdir(suffix='_{0}_runMe'.format(self.filename))
+            # in the staging dir, if there is one, an output is put in place by a rename
+            self.tempdir = mk_tempdir(suffix='_{0}_runMe'.format(self.filename),
+                                      dir=self.dbu.getStagingPath())
             cmdline.append(os.path.join(self.tempdir, self.filename))
         else:
             cmdline.append(os.path.join(rundir, self.filename))
@@ -57,7 +57,8 @@ class dbprocessing_db(object):
                                   schema.Column('incoming_dir', types.String(50), nullable=False, ),
                                   schema.Column('codedir', types.String(50), nullable=True, ),
                                   schema.Column('inspectordir', types.String(50), nullable=True, ),
-                                  schema.Column('errordir', types.String(50), nullable=True, )
+                                  schema.Column('errordir', types.String(50), nullable=True, ),
+                                  schema.Column('stagingdir', types.String(50), nullable=True, )
                                   )
 
         data_table = schema.Table('satellite', metadata,
@@ -137,6 +138,8 @@ class dbprocessing_db(object):
                                   schema.Column('interface_version', types.SmallInteger, nullable=False),
                                   schema.Column('quality_version', types.SmallInteger, nullable=False),
                                   schema.Column('revision_version', types.SmallInteger, nullable=False),
+                                  # Version.toKey() of the three above, filled in by DButils
+                                  schema.Column('version_key', types.BigInteger, nullable=True),
                                   schema.Column('verbose_provenance', types.Text, nullable=True),
                                   schema.Column('check_date', types.DateTime, nullable=True),
                                   schema.Column('quality_comment', types.Text, nullable=True),
@@ -175,6 +178,9 @@ class dbprocessing_db(object):
                                   # TODO this is supposed to be more general than !=
                                   )
 
+        # newest version file of each product and date
+        data_table = DButils.newestFileTable(metadata)
+
         data_table = schema.Table('code', metadata,
                                   schema.Column('code_id', types.Integer, autoincrement=True, primary_key=True,
                                                 nullable=False, index=True),
@@ -188,6 +194,7 @@ class dbprocessing_db(object):
                                   schema.Column('interface_version', types.SmallInteger, nullable=False),
                                   schema.Column('quality_version', types.SmallInteger, nullable=False),
                                   schema.Column('revision_version', types.SmallInteger, nullable=False),
+                                  schema.Column('version_key', types.BigInteger, nullable=True),
                                   schema.Column('output_interface_version', types.SmallInteger, nullable=False),
                                   schema.Column('active_code', types.Boolean, nullable=False, default=False),
                                   schema.Column('date_written', types.Date, nullable=False),
@@ -276,6 +283,10 @@ class dbprocessing_db(object):
                                   schema.CheckConstraint('output_interface_version >= 1'),
                                   )
 
+        # composite indexes for the common queries
+        for name, table, columns in DButils.DButils.INDEXES:
+            schema.Index(name, *[metadata.tables[table].columns[v] for v in columns])
+
         # TODO move this out so that the user chooses the db type
         engine = create_engine('sqlite:///' + self.filename, echo=False)
         metadata.bind = engine
@@ -93,7 +93,6 @@ if __name__ == "__main__":
             if not files:
                 print("No process to run for {0}".format(d.isoformat()))
                 continue
-            #files, input_prods = pq._getRequiredProducts(inproc, files[0].filename, d)
         if not input_files:
             print("No files to run for process ({0}) {1} on {2}".format(inproc,
                                                                       pq.dbu.getEntry('Process', inproc).process_name,
@@ -2,12 +2,15 @@
 from __future__ import print_function
 
 import datetime
+import functools
 import os
 import operator
 from optparse import OptionParser
 import pdb
+import signal
 import traceback
 import subprocess
+import time
 
 from dbprocessing import DBlogging, dbprocessing
 from dbprocessing.runMe import ProcessException
@@ -18,12 +21,178 @@ from dbprocessing.Utils import dateForPrinting as DFP
 from dbprocessing import __version__
 
 
+def ingest(pq, options):
+    """
+    Import the files in incoming into the db
+
+    :return: number of entries added to the processqueue
+    :rtype: int
+    """
+    start_len = pq.dbu.Processqueue.len()
+    print("{0} Currently {1} entries in process queue".format(DFP(), start_len))
+    pq.checkIncoming(glb=options.glob)
+    if not options.dryrun:
+        while len(pq.queue) != 0:
+            pq.importFromIncoming(workers=options.ingestworkers)
+    else:
+        pq.importFromIncoming()
+    return pq.dbu.Processqueue.len() - start_len
+
+
+def process(pq, options):
+    """
+    Run the processes for the entries on the processqueue when it starts
+
+    This is one pass over the queue, the children of the files that are made
+    are planned and run right away down to options.cascadedepth levels, the
+    outputs below that stay on the queue for the next run.
+
+    :return: number of processes that were successful, number that failed
+    :rtype: tuple(int, int)
+    """
+    DBlogging.dblogger.debug("pq.dbu.Processqueue.len(): {0}".format(pq.dbu.Processqueue.len()))
+    if options.cascadedepth > 0:
+        cascade = functools.partial(pq.planChildren, skip_run=options.s, run_procs=options.o)
+    else:
+        cascade = None
+    # the clean is one DELETE in the db, so the superseded entries are
+    #   dropped before buildChildrenBatch() has to look them up
+    print('{0} Cleaning Processes queue'.format(DFP()))
+    pq.dbu.Processqueue.clean(options.dryrun)
+    if not pq.dbu.Processqueue.len():
+        print("{0} Process queue is empty".format(DFP()))
+        return 0, 0
+
+    print('{0} Building commands for {1} items in the queue'.format(DFP(), pq.dbu.Processqueue.len()))
+
+    # make the command lines for all the files in the processqueue, the
+    #   queue is drained in large chunks and each chunk is planned at
+    #   once so the inputs are found in a few queries. This is all done
+    #   before anything runs, so only the entries there now are taken
+    n_entries = 0
+    for entries in pq.dbu.Processqueue.drain():
+        pq.buildChildrenBatch(entries, skip_run=options.s,
+                              run_procs=options.o)
+        n_entries += len(entries)
+    DBlogging.dblogger.debug("Built {0} commands from {1} queue entries".format(len(pq.runme_list), n_entries))
+
+    # pass the whole runme list off to the runMe module function
+    #  it will go through and decide what can be run in parrallel
+    n_good, n_bad = runMe.runner(pq.runme_list, pq.dbu, options.numproc,
+                                 MAX_CPU=options.maxcpu, MAX_RAM=options.maxram,
+                                 fsync=options.fsync, cascade=cascade,
+                                 max_depth=options.cascadedepth)
+    print("{0} {1} of {2} processes were successful".format(DFP(), n_good, n_bad+n_good))
+    DBlogging.dblogger.info("{0} of {1} processes were successful".format(n_good, n_good+n_bad))
+    DBlogging.dblogger.debug("{0} entries left in the processqueue".format(pq.dbu.Processqueue.len()))
+    return n_good, n_bad
+
+
+class Daemon(object):
+    """
+    Run ingest and process cycles, every options.poll seconds, until SIGTERM
+
+    The db session, the inspectors and the caches are kept from one cycle to
+    the next. On SIGHUP they are read again before the next cycle (for when
+    the db was changed by something else). SIGTERM lets the cycle that is
+    running finish and then stops. An exception in a cycle is logged, the
+    transaction is rolled back and everything is read again for the next
+    cycle; only KeyboardInterrupt (and the like) ends :meth:`run`.
+    """
+    def __init__(self, pq, options):
+        self.pq = pq
+        self.options = options
+        self.do_i = options.i or not options.p
+        self.do_p = options.p or not options.i
+        self.stop = False # finish the cycle and stop
+        self.reload = False # read the db again before the next cycle (SIGHUP)
+        self.stale = False # read the db again before the next cycle (the last one failed)
+        self.cycles = 0
+        self.errors = 0 # cycles that ended in an exception
+
+    def onTerm(self, signum, frame):
+        DBlogging.dblogger.info("SIGTERM, stopping after this cycle")
+        self.stop = True
+
+    def onHup(self, signum, frame):
+        DBlogging.dblogger.info("SIGHUP, reading the db again before the next cycle")
+        self.reload = True
+
+    def install(self):
+        """
+        Handle SIGTERM and SIGHUP
+        """
+        signal.signal(signal.SIGTERM, self.onTerm)
+        signal.signal(signal.SIGHUP, self.onHup)
+
+    def ingest(self):
+        """the ingest of a cycle, see :func:`ingest`"""
+        return ingest(self.pq, self.options)
+
+    def process(self):
+        """the processing of a cycle, see :func:`process`"""
+        return process(self.pq, self.options)
+
+    def cycle(self):
+        """
+        Run one ingest and process cycle
+
+        :return: False if the cycle ended in an exception
+        :rtype: bool
+        """
+        if self.reload or self.stale:
+            self.reload = self.stale = False
+            self.pq.dbu.clearCache()
+            self.pq.dbu.resetFilenameIndex()
+            self.pq.resetInspectors()
+        self.cycles += 1
+        T0 = time.time()
+        try:
+            n_added = self.ingest() if self.do_i else 0
+            n_good, n_bad = (0, 0)
+            if self.do_p and not self.stop:
+                n_good, n_bad = self.process()
+            self.pq.dbu.commitDB() # end the transaction so the db is not locked while sleeping
+        except Exception:
+            self.errors += 1
+            tbstring = traceback.format_exc()
+            print('{0} Error in cycle {1}, trying again next cycle:\n{2}'.format(DFP(), self.cycles, tbstring))
+            DBlogging.dblogger.critical("Cycle {0} failed:\n{1}".format(self.cycles, tbstring))
+            self.pq.dbu.session.rollback()
+            del self.pq.runme_list[:]
+            self.pq.queue.clear()
+            self.stale = True
+            return False
+        DBlogging.dblogger.info("Cycle {0}: {1} files added, {2} of {3} processes were successful, {4:.1f}s".format(
+            self.cycles, n_added, n_good, n_good + n_bad, time.time() - T0))
+        return True
+
+    def sleep(self):
+        """
+        Wait options.poll seconds, in short steps so a signal is seen soon
+        """
+        wake = time.time() + self.options.poll
+        while not self.stop and not self.reload and time.time() < wake:
+            time.sleep(max(0, min(1.0, wake - time.time())))
+
+    def run(self):
+        """
+        Run cycles until stopped
+        """
+        while not self.stop:
+            self.cycle()
+            self.sleep()
+        print("{0} Daemon stopped after {1} cycles, {2} failed".format(DFP(), self.cycles, self.errors))
+
+
 if __name__ == "__main__":
     usage = \
     """
-    Usage: %prog [-i|-p [-d] [-s] [-o process[,process...]]] -m database
+    Usage: %prog [-i|-p [-d] [-s] [-o process[,process...]]] [--daemon [--poll seconds]] -m database
         -i -> import
         -p -> process
+        --daemon -> keep running, import and process every --poll seconds
+                    (both unless -i or -p is given), stop with SIGTERM
         -m -> selects mission
         -d -> dryrun
         -s -> skip run timebase
@@ -48,8 +217,22 @@ if __name__ == "__main__":
                       help="Set the logging level", default="debug")
     parser.add_option("-n", "--num-proc", dest="numproc", type='int',
                       help="Number of processes to run in parallel", default=2)
+    parser.add_option("", "--max-cpu", dest="maxcpu", type='int',
+                      help="Total cpus (code cpu column) running processes can use", default=None)
+    parser.add_option("", "--max-ram", dest="maxram", type='float',
+                      help="Total ram in GB (code ram column) running processes can use", default=None)
+    parser.add_option("", "--fsync", dest="fsync", action="store_true",
+                      help="fsync the outputs of the processes once they are in the db", default=False)
+    parser.add_option("", "--cascade-depth", dest="cascadedepth", type='int',
+                      help="Levels of children of new files to make in the same run, 0 for none", default=runMe.CASCADE_DEPTH)
+    parser.add_option("", "--ingest-workers", dest="ingestworkers", type='int',
+                      help="Number of processes to inspect incoming files with", default=1)
     parser.add_option("", "--echo", dest="echo", action="store_true",
                       help="Start sqlalchemy with echo in place for debugging", default=False)
+    parser.add_option("", "--daemon", dest="daemon", action="store_true",
+                      help="Keep running, import and process every --poll seconds", default=False)
+    parser.add_option("", "--poll", dest="poll", type='float',
+                      help="Seconds between the cycles of --daemon", default=60.)
     parser.add_option("", "--glb", dest="glob", type="string",
                       help='Glob to use when reading files from incoming: default "*"', default="*")
 
@@ -64,8 +247,10 @@ if __name__ == "__main__":
         parser.error("options -i and -s are mutually exclusive")
     if options.i and options.o:
         parser.error("options -i and -o are mutually exclusive")
-    if not options.i and not options.p:
+    if not options.i and not options.p and not options.daemon:
         parser.error("either -i or -p must be specified")
+    if options.daemon and options.dryrun:
+        parser.error("options --daemon and -d are mutually exclusive")
 
     logname = os.path.basename(options.mission).replace('.', '_')
     DBlogging.change_logfile(logname)
@@ -95,16 +280,38 @@ if __name__ == "__main__":
     pq.dbu.startLogging()
 
 
-    if options.i: # import selected
+    if options.daemon: # keep running
+        exit_msg = 'Abnormal exit on exception'
+        try:
+            d = Daemon(pq, options)
+            d.install()
+            d.run()
+        except Exception:
+            #Generic top-level error handler, because otherwise people freak if
+            #they see an exception thrown.
+            print('{0} Error in running processing chain; debugging details follow:'.format(DFP()))
+            tbstring = traceback.format_exc()
+            print(tbstring)
+            print('This probably indicates a programming error. Please pass '
+                  'this debugging\ninformation to the developer, along with '
+                  'any information on what was\nhappening at the time.')
+            DBlogging.dblogger.critical(tbstring)
+        except KeyboardInterrupt:
+            print('Shutting down processing chain')
+            DBlogging.dblogger.error('Ctrl-C issued, quiting')
+            exit_msg = 'Ctrl-C Exit'
+        else:
+            exit_msg = 'Nominal Exit'
+        finally:
+            # however it ends the processing flag has to come down
+            pq.dbu.session.rollback()
+            pq.dbu.stopLogging(exit_msg)
+            pq.dbu.closeDB()
+
+    elif options.i: # import selected
+        n_added = 0
         try:
-            start_len = pq.dbu.Processqueue.len()
-            print("{0} Currently {1} entries in process queue".format(DFP(), start_len))
-            pq.checkIncoming(glb=options.glob) 
-            if not options.dryrun:
-                while len(pq.queue) != 0:
-                    pq.importFromIncoming()
-            else:
-                pq.importFromIncoming()
+            n_added = ingest(pq, options)
 
         except RuntimeError:
             #Generic top-level error handler, because otherwise people freak if
@@ -125,63 +332,13 @@ if __name__ == "__main__":
         else:
             pq.dbu.stopLogging('Nominal Exit')
         pq.dbu.closeDB()
-        print("{0} Import finished: {1} files added".format(DFP(), pq.dbu.Processqueue.len()-start_len))
+        print("{0} Import finished: {1} files added".format(DFP(), n_added))
 
-    if options.p: # process selected
+    elif options.p: # process selected
         number_proc = 0
 
         try:
-            DBlogging.dblogger.debug("pq.dbu.Processqueue.len(): {0}".format(pq.dbu.Processqueue.len()))
-            # this loop does everything, both make the runMe objects and then
-            #   do all the actuall running
-            while pq.dbu.Processqueue.len() > 0:
-                # BAL 30 Mar 2017, no need to clean here as buildChildren() will clean
-                # print('{0} Cleaning Processes queue'.format(DFP()))
-                # # clean the queue
-                # pq.dbu.Processqueue.clean(options.dryrun)  # get rid of duplicates and sort
-                # if not pq.dbu.Processqueue.len():
-                #     print("{0} Process queue is empty".format(DFP()))
-                #     break
-
-                # this loop makes all the runMe objects for all the files in the processqueue
-                run_num = 0
-                n_good  = 0
-                n_bad   = 0
-                
-                print('{0} Building commands for {1} items in the queue'.format(DFP(), pq.dbu.Processqueue.len()))
-         
-                # make the cpommand lines for all the files in tehj processqueue
-                totalsize = pq.dbu.Processqueue.len()
-                tmp_ind = 0
-                Utils.progressbar(tmp_ind, 1, totalsize, text='Command Build Progress:')
-                while pq.dbu.Processqueue.len() > 0:
-                    # do smarter pop that sorts at the db level
-                    #f = (pq.dbu.session.query(pq.dbu.Processqueue.file_id)
-                    #     .join((pq.dbu.File, pq.dbu.Processqueue.file_id==pq.dbu.File.file_id))
-                    #     .order_by(pq.dbu.File.data_level, pq.dbu.File.utc_file_date).first())
-                    #if hasattr(f, '__iter__') and len(f) == 1:
-                    #    f = f[0]
-                    #pq.dbu.Processqueue.remove(f) # remove by file_id
-                    f = pq.dbu.Processqueue.pop()
-                    DBlogging.dblogger.debug("popped {0} from pq.dbu.Processqueue.get(), {1} left".format(f, pq.dbu.Processqueue.len()))
-                    #                    f = pq.dbu.Processqueue.pop() # this is empty queue safe, gives None
-                    #if f is None:
-                    #    continue
-                    pq.buildChildren(f, skip_run=options.s,
-                                     run_procs=options.o)
-                    tmp_ind += 1
-                    Utils.progressbar(tmp_ind, 1, totalsize, text='Command Build Progress: {0}:{1}'.format(tmp_ind, totalsize))
-
-                    #pq.runme_list.extend(sorted([v for v in pq.runme_list if v.ableToRun], key=lambda x: x.utc_file_date))
-                    
-                # pass the whole runme list off to the runMe module function
-                #  it will go through and decide what can be run in parrallel
-                
-                n_good_t, n_bad_t = runMe.runner(pq.runme_list, pq.dbu, options.numproc)
-                n_good += n_good_t
-                n_bad  += n_bad_t
-                print("{0} {1} of {2} processes were successful".format(DFP(), n_good, n_bad+n_good))
-                DBlogging.dblogger.info("{0} of {1} processes were successful".format(n_good, n_good+n_bad))
+            process(pq, options)
 
         except RuntimeError:
             #Generic top-level error handler, because otherwise people freak if
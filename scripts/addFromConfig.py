@@ -34,6 +34,9 @@ expected_keyword = { }
 expected_keyword['mission'] = ['incoming_dir', 'mission_name', 'rootdir',
                                'codedir', 'inspectordir', 'errordir']
 expected_keyword['satellite'] = ['satellite_name']
+# keys that are used if they are there but do not have to be
+optional_keyword = { }
+optional_keyword['mission'] = ['stagingdir']
 expected_keyword['instrument'] = ['instrument_name']
 expected_keyword['product'] = ['product_name', 'relative_path',
                                'level', 'format', 'product_description',
@@ -127,7 +130,7 @@ def _keysRemoveExtra(conf, section):
         if k.startswith('required_input') or k.startswith('optional_input'):
             continue
         else:
-            if k not in expected_keyword[section_ex]:
+            if k not in expected_keyword[section_ex] + optional_keyword.get(section_ex, []):
                 print('Removed keyword {0}[{1}][{2}]={3}'.format('conf', section, k, conf[section][k]))
                 del conf[section][k]
     return conf[section]
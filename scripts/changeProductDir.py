@@ -28,14 +28,16 @@ class ProductMoveApp(object):
         self.dbu = dbprocessing.DButils.DButils(self.mission)
         pid = self.dbu.getProductID(self.product)
         #First get all the OLD file locations
-        oldfiles = [(f.file_id, self.dbu.getFileFullPath(f.file_id))
-                     for f in self.dbu.getFiles(product=pid)
-                    if f.exists_on_disk]
+        fileids = [f.file_id for f in self.dbu.getFiles(product=pid)
+                   if f.exists_on_disk]
+        oldfiles = self.dbu.getFileFullPaths(fileids)
         product = self.dbu.getEntry('Product', pid)
         product.relative_path = self.newdir
         self.dbu.session.commit()
-        for fileid, oldpath in oldfiles:
-            newpath = self.dbu.getFileFullPath(fileid)
+        newfiles = self.dbu.getFileFullPaths(fileids)
+        for fileid in fileids:
+            oldpath = oldfiles[fileid]
+            newpath = newfiles[fileid]
             newdir = os.path.dirname(newpath)
             if not os.path.isdir(newdir):
                 os.makedirs(newdir)
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+
+"""
+check the files in the database against the disk, print the files that
+are missing or whose shasum no longer matches
+"""
+from optparse import OptionParser
+
+from dbprocessing import DButils
+
+if __name__ == '__main__':
+    usage = "usage: %prog -m mission"
+    parser = OptionParser(usage=usage)
+    parser.add_option("-m", "--mission", dest="mission",
+                      help="selected mission database", default=None)
+    parser.add_option("-l", "--limit", dest="limit", type='int',
+                      help="Only check this many files", default=None)
+    parser.add_option("-t", "--threads", dest="threads", type='int',
+                      help="Number of files to hash at once", default=4)
+    parser.add_option("", "--verify", dest="verify", action='store_true',
+                      help="Hash every file, do not use the digest cache", default=False)
+
+    (options, args) = parser.parse_args()
+    if len(args) != 0:
+        parser.error("incorrect number of arguments")
+    if options.mission is None:
+        parser.error("A mission database must be specified")
+
+    dbu = DButils.DButils(options.mission)
+    reasons = {1: 'bad shasum', 2: 'not found'}
+    for filename, reason in dbu.checkFiles(limit=options.limit, threads=options.threads,
+                                           verify=options.verify):
+        print('{0}: {1}'.format(filename, reasons[reason]))
+    dbu.closeDB()
@@ -198,8 +198,9 @@ if __name__ == "__main__":
     ## TODO maybe add a sort by level in here
     prods_tmp = dbu.getAllProducts()
     prods = []
+    tbs = dbu.getTracebacks('Product', [p.product_id for p in prods_tmp])
     for p in prods_tmp:
-        tmp = dbu.getTraceback('Product', p.product_id)
+        tmp = tbs[p.product_id]
         # if this is not our sallite continue
         if tmp['satellite'].satellite_name != options.satellite:
             continue
@@ -227,8 +228,9 @@ if __name__ == "__main__":
     # get process
     procs_tmp = dbu.getAllProcesses()
     procs = []
+    tbs = dbu.getTracebacks('Process', [p.process_id for p in procs_tmp])
     for p in procs_tmp:
-        tmp = dbu.getTraceback('Process', p.process_id)
+        tmp = tbs[p.process_id]
         # if this is not our satellite continue
         if tmp['satellite'].satellite_name != options.satellite:
             continue
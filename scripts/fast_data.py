@@ -100,11 +100,13 @@ def reap(dbu, graph, participants, dofiles=False, dorecords=False, verbose=False
     nodes.sort(key=lambda file: (
         file['product_id'], file['utc_file_date'], file['version']))
 
+    if dofiles:
+        paths = dbu.getFileFullPaths([node['file_id'] for node in nodes[:-1]])
     for node in reversed(nodes[:-1]):
         if verbose:
             print(node['filename'])
         if dofiles:
-            os.remove(dbu.getFileFullPath(node['file_id']))
+            os.remove(paths[node['file_id']])
             # This is slow, and we(I.E. not me) can fix it later if its too slow. - Myles 6/5/2018
             dbu.getEntry('File', node['file_id']).exists_on_disk = False
         if dorecords:
@@ -59,24 +59,13 @@ def cull_to_newest(files, options=None):
 
     match everything in front of v\d\d?\.\d\d?\.\d\d?\.
     """
-    ans = []
-    # make a set of all the file bases
-    tmp = [getBaseVersion(f) for f in files]
-    bases = zip(*tmp)[0]
-    versions = zip(*tmp)[1]
-    uniq_bases = list(set(bases))
-    while uniq_bases:
-        val = uniq_bases.pop(0)
-        tmp = [f for f in files if val in f ]
-        if len(tmp) > 1:
-            inds = [i for i in range(len(files)) if bases[i] == val]
-            vers = [versions[i] for i in inds]
-            maxver = max(vers)
-            maxfile = [files[i] for i in inds if versions[i] == maxver][0]
-            ans.append(maxfile)
-        else:
-            ans.append(tmp[0])
-    return ans
+    newest = {}  # base: (version key, file)
+    for f in files:
+        base, version = getBaseVersion(f)
+        key = version.toKey() if version is not None else -1
+        if base not in newest or key > newest[base][0]:
+            newest[base] = (key, f)
+    return [v[1] for v in newest.values()]
 
 def cull_to_dates(files, startdate, enddate, nodate=False, options=None):
     """
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+"""
+bring an existing database up to date with what CreateDB makes now and
+check that the common queries do not read whole tables
+"""
+from __future__ import print_function
+
+import sys
+from optparse import OptionParser
+
+from dbprocessing import DButils
+
+if __name__ == '__main__':
+    usage = "usage: %prog -m mission"
+    parser = OptionParser(usage=usage)
+    parser.add_option("-m", "--mission", dest="mission",
+                      help="selected mission database", default=None)
+    parser.add_option("-c", "--check", dest="check", action='store_true',
+                      help="Do not change the database, only check the query plans", default=False)
+    parser.add_option("-a", "--analyze", dest="analyze", action='store_true',
+                      help="Run ANALYZE after adding indexes", default=False)
+    parser.add_option("-v", "--verbose", dest="verbose", action='store_true',
+                      help="Print the SQL and plan of every query", default=False)
+    parser.add_option("-n", "--newest", dest="newest", action='store_true',
+                      help="Check the newest_file table against the files (and fix it)", default=False)
+    parser.add_option("", "--rebuild-newest", dest="rebuild_newest", action='store_true',
+                      help="Rebuild the newest_file table from the files", default=False)
+    parser.add_option("-s", "--stagingdir", dest="stagingdir",
+                      help="Set the mission stagingdir (where processes write their output)", default=None)
+
+    (options, args) = parser.parse_args()
+    if len(args) != 0:
+        parser.error("incorrect number of arguments")
+    if options.mission is None:
+        parser.error("A mission database must be specified")
+    if options.check and options.stagingdir is not None:
+        parser.error("options -c and -s are mutually exclusive")
+
+    dbu = DButils.DButils(options.mission)
+    if not options.check:
+        tables = dbu.addVersionKeys()
+        if tables:
+            print('Added version_key to {0}'.format(', '.join(tables)))
+        if dbu.addStagingDir(options.stagingdir):
+            print('Added stagingdir to mission')
+        if options.stagingdir is not None:
+            print('Set stagingdir to {0}'.format(options.stagingdir))
+        if tables or options.stagingdir is not None:
+            # the new columns are only used once it is opened again
+            dbu.closeDB()
+            dbu = DButils.DButils(options.mission)
+        for name in dbu.addIndexes(analyze=options.analyze):
+            print('Added index {0}'.format(name))
+        if options.rebuild_newest or 'newest_file' not in dbu.metadata.tables:
+            print('newest_file has {0} entries'.format(dbu.rebuildNewestFiles()))
+
+    if options.newest:
+        for product_id, utc_file_date, has, should in dbu.verifyNewestFiles(fix=not options.check):
+            print('newest_file product {0} {1}: is {2} should be {3}'.format(
+                product_id, utc_file_date, has, should))
+
+    bad = 0
+    for name, statement, plan, problems in dbu.explainQueries():
+        if options.verbose:
+            print('{0}:\n{1}'.format(name, statement))
+            for line in plan:
+                print('    {0}'.format(line))
+        for line in problems:
+            print('{0}: {1}'.format(name, line))
+        bad += len(problems)
+    dbu.closeDB()
+    if bad:
+        print('{0} full scans/sorts found'.format(bad))
+        sys.exit(1)
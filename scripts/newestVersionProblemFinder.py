@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 
 """
-Run both the old and new methods of finding newestVersion and report differences
+Run both the old and new methods of finding newestVersion and report differences,
+new is the newest_file table (when the db has one)
 """
 
 from optparse import OptionParser
@@ -116,6 +117,8 @@ if __name__ == "__main__":
                       old and new implementations of newest_version")
     parser.add_option("--errortest", dest="errortest", default=True, action="store_true",
                       help="Check if any file has a newer file_create_date but lower version number")
+    parser.add_option("--tabletest", dest="tabletest", default=True, action="store_true",
+                      help="Check the newest_file table against the versions in the file table")
 
     (options, args) = parser.parse_args()
     if len(args) != 0:
@@ -148,6 +151,14 @@ if __name__ == "__main__":
         for y in old2 - new:
             print("{0} in getFilesByProduct but not new".format(y))
 
+    if options.tabletest:
+        try:
+            for product_id, utc_file_date, has, should in dbu.verifyNewestFiles():
+                print("newest_file for product {0} {1} is {2}, should be {3}".format(
+                    product_id, utc_file_date, has, should))
+        except DButils.DBError:
+            print("No newest_file table, getFilesByProductDate is the same as new")
+
     if options.errortest:
         files = dbu.getFiles(newest_version=True)
         for f in files:
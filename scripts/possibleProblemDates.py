@@ -34,7 +34,7 @@ def suspiciousDateRanges(dbu, fix=False):
     check all the files makeing sure that the date ranges look reasonable, they should be
     something like, 1 day, 1 week, 1 month, or 1 year
     """
-    files = dbu.session.query(dbu.File).filter_by(newest_version=1).all()
+    files = dbu.getFiles(newest_version=True)
     t_range = [(v.file_id, v.filename, _timedelta2days(v.utc_stop_time - v.utc_start_time)) for v in files]
     for fid, f, tr in t_range:
         if tr < (1/24):  # 1 hour  1/3600
@@ -48,78 +48,42 @@ def suspiciousDateRanges(dbu, fix=False):
         elif tr > 368: # more than 1 year
             print("File: {0}:{1} has odd year duration {2} days".format(fid, f, tr))
 
-def wrongNewestVersion(dbu, fix=False):
+def _newestProblems(dbu, fix=False):
     """
-    loop over products and dates and make sure the correct version is marked latest
-
-    do this by:
-    1) get all products
-    2) get all dates
-    3) loop over all products and dates (itertools.product)
-    4) get the versions for the files
-    5) find the largest
-    6) make sure it is marked newest and others are not
+    the entries of the newest_file table that are wrong, see DButils.verifyNewestFiles
     """
-    #firstDate = dbu.session.query(func.min(dbu.File.utc_file_date)).first()[0]
-    #lastDate  = dbu.session.query(func.max(dbu.File.utc_file_date)).first()[0]
-    #dates = Utils.expandDates(firstDate, lastDate)
-    prods = dbu.getAllProducts()
-
-    for p in prods:
-        files = dbu.getFilesByProduct(p.product_id, newest_version=False)
-        dates = sorted(list(set([v.utc_file_date for v in files])))
-
-        for date in dates:
-            ftmp = [v for v in files if v.utc_file_date == date]
-            versions = [dbu.getFileVersion(v) for v in ftmp]
-            mx = max(versions)
-            commit = False
-            for f in ftmp:
-                if dbu.getFileVersion(f) != mx and f.newest_version:
-                    print('File {0}:{1} is marked newest, it should not be'.format(f.file_id, f.filename))
-                    if fix:
-                        f.newest_version = False
-                        dbu.session.add(f)
-                        commit = True
-                if dbu.getFileVersion(f) == mx and not f.newest_version:
-                    print('File {0}:{1} is not marked newest, it should be'.format(f.file_id, f.filename))
-                    if fix:
-                        f.newest_version = True
-                        dbu.session.add(f)
-                        commit = True
-            if commit:
-                dbu.commitDB()
-
+    try:
+        return dbu.verifyNewestFiles(fix=fix)
+    except DButils.DBError:
+        print('The database has no newest_file table, run migrateDB.py')
+        return []
 
+def wrongNewestVersion(dbu, fix=False):
+    """
+    make sure the newest_file table points at the largest version file for
+    each product and date
+    """
+    for product_id, utc_file_date, has, should in _newestProblems(dbu, fix):
+        if has is None:
+            continue # noNewestVersion()
+        if should is None:
+            print('{0}, product {1}, file {2} is marked newest, there are no files'.format(utc_file_date, product_id, has))
+        else:
+            print('{0}, product {1}, file {2} is marked newest, it should be {3}'.format(utc_file_date, product_id, has, should))
+        if fix:
+            print(' ** Changed {0} to be newest version'.format(should))
 
 def noNewestVersion(dbu, fix=False):
     """
     print out a list of dates and files where there are files but there is not newest version
     this should be sorted by product
     """
-    products = dbu.getAllProducts()
-    prod_ids = [v.product_id for v in products]
-    for prod_id in prod_ids:
-        files_all = dbu.getFilesByProduct(prod_id, newest_version=False)
-        files_newest = dbu.getFilesByProduct(prod_id, newest_version=True)
-        dates_all = set([v.utc_file_date for v in files_all])
-        dates_newest = set([v.utc_file_date for v in files_newest])
-        dates_missing =  dates_all.difference(dates_newest)
-        if dates_missing:
-            dates_missing = sorted(list(dates_missing))
-            fixes = []
-            for f in dates_missing:
-                print('{0}, product {1}, no files are newest version'.format(f, prod_id))
-                if fix:
-                    tmp = dbu.getFiles_product_utc_file_date(prod_id, f)
-                    try:
-                        fixes.append(dbu.getEntry('File', max(tmp, key=lambda x: x[1])[0]))
-                    except ValueError:
-                        continue
-                    fixes[-1].newest_version = 1
-                    print(' ** Changed {0} to be newest version'.format(fixes[-1].filename))
-                    dbu.session.add(fixes[-1])
-            dbu.commitDB() # commit for each product
+    for product_id, utc_file_date, has, should in _newestProblems(dbu, fix):
+        if has is not None:
+            continue # wrongNewestVersion()
+        print('{0}, product {1}, no files are newest version'.format(utc_file_date, product_id))
+        if fix:
+            print(' ** Changed {0} to be newest version'.format(should))
 
 
 
@@ -73,8 +73,8 @@ if __name__ == '__main__':
                 prod_name = 'N/A'
                 prod = -1 #Not actually used below anyhow....
             else:
-                prod_name = dbu.getEntry('Product', prod_id).product_name
-                prod = dbu.getEntry('Product', prod_id)
+                prod_name = dbu.getEntry('Product', prod_id, cached=True).product_name
+                prod = dbu.getEntry('Product', prod_id, cached=True)
             print("{0:4} {1:40} {2:10} {3:45}".format(p.process_id,
                                                       p.process_name,
                                                       p.output_timebase,
@@ -85,11 +85,11 @@ if __name__ == '__main__':
             for pp, opt in products:
                 opt_print = "optional" if opt else ""
                 print("\t\t{0:10} ({1:3}) {2:45}".format(opt_print,
-                                                         pp, dbu.getEntry('Product', pp).product_name))
+                                                         pp, dbu.getEntry('Product', pp, cached=True).product_name))
             codes = dbu.getAllCodesFromProcess(p.process_id)
             for c, sd, ed in codes:
                 print("\t\t{0:10}c({1:3}) {2:45} {3}->{4}".format("", c,
-                                                          dbu.getEntry('Code', c).filename,
+                                                          dbu.getEntry('Code', c, cached=True).filename,
                                                           sd.isoformat(),
                                                           ed.isoformat()))
     elif field == 'Code':
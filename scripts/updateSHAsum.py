@@ -4,39 +4,47 @@ import os
 from optparse import OptionParser
 
 from dbprocessing import DButils
+from dbprocessing import Diskfile
 
 """
-go into the database and update the shasum entry for a file that is changed after ingestion
+go into the database and update the shasum entry for files that are changed after ingestion
 """
 
-def updateSHA(dbu, filename):
+def updateSHA(dbu, filenames, threads=4):
     """
-    update the shasum in the db
+    update the shasum in the db, the files are hashed threads at a time
     """
-    file = dbu.getEntry('File', dbu.getFileID(os.path.basename(filename)))
-    file.shasum = DButils.calcDigest(filename)
+    if not hasattr(filenames, '__iter__'):
+        filenames = [filenames]
+    digests = Diskfile.calcDigests(filenames, threads=threads)
+    for filename in filenames:
+        file = dbu.getEntry('File', dbu.getFileID(os.path.basename(filename)))
+        file.shasum = digests[filename]
     dbu.session.commit()
     
 if __name__ == '__main__':
-    usage = "usage: %prog infile"
+    usage = "usage: %prog infile [infile ...]"
     parser = OptionParser(usage=usage)
     parser.add_option("-m", "--mission", dest="mission",
                       help="selected mission database", default=None)
+    parser.add_option("-t", "--threads", dest="threads", type='int',
+                      help="Number of files to hash at once", default=4)
 
     (options, args) = parser.parse_args()
 
-    if len(args) != 1:
+    if len(args) < 1:
         parser.error("incorrect number of arguments")
 
-    infile = os.path.expanduser(os.path.expandvars(args[0]))
-    if not os.path.isfile(infile):
-        parser.error("Input file {0} did not exist".format(infile))
+    infiles = [os.path.expanduser(os.path.expandvars(v)) for v in args]
+    for infile in infiles:
+        if not os.path.isfile(infile):
+            parser.error("Input file {0} did not exist".format(infile))
 
     if not os.path.isfile(options.mission):
         parser.error("Mission database {0} did not exist".format(options.mission))
 
     dbu = DButils.DButils(options.mission)
-    updateSHA(dbu, infile)
+    updateSHA(dbu, infiles, options.threads)
 
     dbu.closeDB()
         
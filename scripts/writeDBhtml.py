@@ -59,9 +59,8 @@ def makeHTML(mission, filename):
 def _writeProducts(dbu, output):
     prods = dbu.getAllProducts()
 
-    traceback = []
-    for prod in prods:
-        traceback.append(dbu.getTraceback('Product', prod.product_id))
+    tbs = dbu.getTracebacks('Product', [prod.product_id for prod in prods])
+    traceback = [tbs[prod.product_id] for prod in prods]
 
     data = {}
 
@@ -125,9 +124,8 @@ def _writeProducts(dbu, output):
 def _writeProcesses(dbu, output):
     procs = dbu.getAllProcesses()
 
-    traceback = []
-    for proc in procs:
-        traceback.append(dbu.getTraceback('Process', proc.process_id))
+    tbs = dbu.getTracebacks('Process', [proc.process_id for proc in procs])
+    traceback = [tbs[proc.process_id] for proc in procs]
 
     data = {}
 
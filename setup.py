@@ -28,7 +28,8 @@ scripts = ('scripts/addFromConfig.py', 'scripts/missingFilesByProduct.py',
            'scripts/magephem-pre-CoverageHTML.py', 'scripts/writeProductsConf.py',
            'scripts/makeLatestSymlinks.py', 'scripts/testInspector.py',
            'scripts/replaceArgsWithRootdir.py', 'scripts/printRequired.py',
-           'scripts/changeProductDir.py')
+           'scripts/changeProductDir.py', 'scripts/checkFiles.py',
+           'scripts/migrateDB.py')
 
 setup(name='dbprocessing',
       version='0.0',
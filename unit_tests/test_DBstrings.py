@@ -6,6 +6,7 @@ from __future__ import print_function
 __author__ = 'Jonathan Niehof <jniehof@lanl.gov>'
 
 import datetime
+import re
 import unittest
 
 from dbprocessing import DBstrings
@@ -58,6 +59,17 @@ class DBFormatterTests(unittest.TestCase):
         self.assertEqual('stuff(\d{3})([0-3]\d\d)89',
                          self.fmtr.re('stuff{MILLI}{j:03d}{d:2d}', d=89))
 
+    def testMatchRe(self):
+        """Regex that matches anything a format string can make"""
+        regex = self.fmtr.match_re('testDB_{Y}.cat{foo}') + '$'
+        self.assertTrue(re.match(regex, 'testDB_2010.cat'))
+        self.assertTrue(re.match(regex, 'testDB_2010.catanything'))
+        self.assertFalse(re.match(regex, 'testDB_2010xcat'))
+        self.assertFalse(re.match(regex, 'testDB_1810.cat'))
+        regex = self.fmtr.match_re('a+b_{datetime}_v{VERSION}.{b:02d}') + '$'
+        self.assertTrue(re.match(regex, 'a+b_20100101_v1.2.3.x'))
+        self.assertFalse(re.match(regex, 'aab_20100101_v1.2.3.x'))
+
     def testExpandDatetime(self):
         """Expand a single datetime object to a set of keywords"""
         dt = datetime.datetime(2010, 1, 2, 3, 44, 59, 123456)
@@ -149,6 +161,67 @@ class DBFormatterTests(unittest.TestCase):
         for i, o in zip(inputs, outputs):
             self.assertEqual(o, self.fmtr.format(i[0], **i[1]))
 
+    def testExpandFormatKept(self):
+        """Expanding the same format again gives the same answer"""
+        first = self.fmtr.expand_format('{Y}{m}_{nnn}', {'Y': 2012})
+        self.assertEqual('{Y:04d}((0\d|1[0-2]))_(\d\d\d)', first)
+        self.assertEqual(first, self.fmtr.expand_format(
+            '{Y}{m}_{nnn}', {'Y': 2013, 'foo': 'bar'}))
+        self.assertEqual('{Y:04d}{m:02d}_{nnn}',
+                         self.fmtr.expand_format('{Y}{m}_{nnn}'))
+
+
+class DBTemplateTests(unittest.TestCase):
+    """Tests of the precompiled format strings"""
+
+    def testTemplateKept(self):
+        """Same format string gives the same template"""
+        tmpl = DBstrings.template('foo_{Y}{m}{d}_v{VERSION}.cdf')
+        self.assertTrue(tmpl is DBstrings.template('foo_{Y}{m}{d}_v{VERSION}.cdf'))
+        self.assertFalse(tmpl is DBstrings.template(u'foo_{Y}{m}{d}_v{VERSION}.cdf'))
+        self.assertEqual('foo_', tmpl.prefix)
+        self.assertEqual(frozenset(['Y', 'm', 'd', 'VERSION']), tmpl.fields)
+
+    def testFormat(self):
+        """Templates format the same as the formatter"""
+        fmtr = DBstrings.DBformatter()
+        for fmt, kwargs in [
+                ('rbspa_ect-hope-hk-L1_{DATE}_v{VERSION}.cdf',
+                 {'VERSION': '2.0.0', 'datetime': datetime.date(2012, 10, 3)}),
+                ('{SATELLITE}_{Y}{j}T{H}{M}{S}.{MILLI}_v{VERSION}.cdf',
+                 {'SATELLITE': u'rbspa', 'VERSION': '1.2.3',
+                  'datetime': datetime.datetime(2012, 2, 3, 4, 5, 6, 7000)}),
+                ('{Y:02d} {b} {a!r:>8}', {'Y': 5, 'b': 'Jan', 'a': 'x'}),
+                ('{a:{w}}|', {'a': 'x', 'w': 4}),
+        ]:
+            self.assertEqual(fmtr.format(fmt, **kwargs),
+                             DBstrings.template(fmt).format(**kwargs))
+        self.assertEqual('hi there', DBstrings.template('hi {0}').format('there'))
+        self.assertRaises(KeyError, DBstrings.template('{hi} {there}').format, hi='hi')
+
+    def testRe(self):
+        """Templates make the same regex as the formatter"""
+        fmtr = DBstrings.DBformatter()
+        fmt = 'foo_{Y}{m}{d}_v{VERSION}.cdf'
+        tmpl = DBstrings.template(fmt)
+        self.assertEqual(fmtr.re(fmt), tmpl.re())
+        self.assertEqual(fmtr.re(fmt, VERSION='1.0.0'), tmpl.re(VERSION='1.0.0'))
+        self.assertEqual(fmtr.re(fmt, datetime=datetime.date(2012, 1, 2)),
+                         tmpl.re(datetime=datetime.date(2012, 1, 2)))
+        self.assertEqual(fmtr.re(fmt), tmpl.re())
+
+    def testMatch(self):
+        """Match a string against a template"""
+        tmpl = DBstrings.template('{SATELLITE}_{Y}{m}{d}_{??}_{Y}_v{VERSION}.cdf')
+        self.assertEqual(
+            {'SATELLITE': 'rbspa', 'Y': '2012', 'm': '04', 'd': '12',
+             'VERSION': '1.2.3'},
+            tmpl.match('rbspa_20120412_xx_2012_v1.2.3.cdf'))
+        self.assertEqual(None, tmpl.match('rbspa_20121312_xx_2012_v1.2.3.cdf'))
+        self.assertEqual(None, tmpl.match('rbspa_20120412_xx_2012_v1.2.3.cdf.bak'))
+        self.assertTrue(re.match(DBstrings.DBformatter().match_re(tmpl.format_string) + '$',
+                                 'rbspa_20120412_xx_2012_v1.2.3.cdf'))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -11,6 +11,8 @@ import tempfile
 import unittest
 from distutils.dir_util import copy_tree, remove_tree
 
+import sqlalchemy
+
 try:  # new version changed this annoyingly
     from sqlalchemy.exceptions import IntegrityError
     from sqlalchemy.exceptions import ArgumentError
@@ -1079,12 +1081,16 @@ class TestWithtestDB(unittest.TestCase):
 
     def test_checkFiles(self):
         """Checks if checkFiles will detect both missing files and bad checksums"""
+        self.assertEqual([], self.dbu.checkFiles())
         with open(self.tempD + '/L0/testDB_001_000.raw', 'w') as fp:
             fp.write('I am some text that will change the SHA\n')
         os.remove(self.tempD + '/L0/testDB_000_000.raw')
 
         ans = [('testDB_001_000.raw', 1), ('testDB_000_000.raw', 2)]
         self.assertEqual(ans, self.dbu.checkFiles())
+        # the missing file is not kept in the digest cache
+        self.assertEqual([], self.dbu.getDigestCache().conn.execute(
+            'SELECT path FROM digest WHERE path LIKE ?', ('%testDB_000_000.raw',)).fetchall())
 
     def addGenericCode(self, processID=1):
         """Adds a dummy code."""
@@ -1166,6 +1172,267 @@ class TestWithtestDB(unittest.TestCase):
         self.assertFalse(self.dbu.fileIsNewest(fID1))
         self.assertTrue(self.dbu.fileIsNewest(fID4))
 
+    def test_fileIsNewest_noDate(self):
+        """A file without a utc_file_date is newest, with or without newest_file"""
+        fID = self.addGenericFile(1, version=(1, 0, 0))
+        self.dbu.getEntry('File', fID).utc_file_date = None
+        self.dbu.commitDB()
+        self.assertTrue(self.dbu.fileIsNewest(fID))
+        self.dbu.rebuildNewestFiles()
+        self.assertTrue(self.dbu.fileIsNewest(fID))
+
+    def test_addVersionKeys(self):
+        """addVersionKeys adds and fills version_key, new rows get it too"""
+        self.assertEqual(['file', 'code'], self.dbu.addVersionKeys())
+        self.assertEqual([], self.dbu.addVersionKeys())
+        self.dbu.closeDB()
+        self.dbu = DButils.DButils(self.tempD + '/testDB.sqlite')
+        self.assertEqual(Version.Version(1, 0, 0).toKey(), self.dbu.getEntry('File', 1).version_key)
+        self.assertEqual(self.dbu.getCodeVersion(1).toKey(), self.dbu.getEntry('Code', 1).version_key)
+        fID = self.addGenericFile(1, version=(1, 3, 0))
+        self.assertEqual(Version.Version(1, 3, 0).toKey(), self.dbu.getEntry('File', fID).version_key)
+        self.addGenericFile(1, version=(1, 2, 7))
+        self.assertEqual([fID], [f.file_id for f in self.dbu.getFilesByProductDate(
+            1, [datetime.date(2010, 1, 1)] * 2, newest_version=True)])
+        self.dbu.rebuildNewestFiles()
+        self.assertTrue(self.dbu.fileIsNewest(fID))
+        self.assertTrue('ix_file_product_date_version_key' in self.dbu.addIndexes())
+        self.assertEqual([], [v for v in self.dbu.explainQueries() if v[3]])
+
+    def test_newestFileTable(self):
+        """newest_file is built and kept up to date as files come and go"""
+        before = sorted(f.file_id for f in self.dbu.getFiles(newest_version=True))
+        self.assertEqual(16, self.dbu.rebuildNewestFiles())
+        self.assertEqual([], self.dbu.verifyNewestFiles())
+        self.assertEqual(before, sorted(f.file_id for f in self.dbu.getFiles(newest_version=True)))
+        self.assertEqual([7], [f.file_id for f in self.dbu.getFilesByProductDate(
+            1, [datetime.date(2016, 1, 1)] * 2, newest_version=True)])
+        fID1 = self.addGenericFile(1, version=(1, 1, 0))
+        fID2 = self.addGenericFile(1, version=(1, 3, 0))
+        fID3 = self.dbu.addFiles([dict(filename='testing_file_1.2.0.file', data_level=0,
+                                       version=Version.Version(1, 2, 0),
+                                       file_create_date=datetime.date(2010, 1, 1),
+                                       exists_on_disk=1, utc_file_date=datetime.date(2010, 1, 1),
+                                       utc_start_time=datetime.datetime(2010, 1, 1),
+                                       utc_stop_time=datetime.datetime(2010, 1, 2),
+                                       product_id=1)])[0]
+        self.assertTrue(self.dbu.fileIsNewest(fID2))
+        self.assertFalse(self.dbu.fileIsNewest(fID3))
+        self.assertEqual([], self.dbu.verifyNewestFiles())
+        self.dbu._purgeFileFromDB(fID2, trust_id=True)
+        self.assertTrue(self.dbu.fileIsNewest(fID3))
+        self.assertEqual([fID3], [f.file_id for f in self.dbu.getFilesByProductDate(
+            1, [datetime.date(2010, 1, 1)] * 2, newest_version=True)])
+        self.dbu._purgeFileFromDB([fID1, fID3], trust_id=True)
+        self.assertEqual([], self.dbu.verifyNewestFiles())
+        self.assertEqual(before, sorted(f.file_id for f in self.dbu.getFiles(newest_version=True)))
+        # break it, verify finds it and fixes it
+        self.dbu.session.execute(self.dbu.metadata.tables['newest_file'].delete().where(
+            self.dbu.metadata.tables['newest_file'].c.file_id == 7))
+        self.assertEqual([(1, datetime.date(2016, 1, 1), None, 7)],
+                         self.dbu.verifyNewestFiles(fix=True))
+        self.assertEqual([], self.dbu.verifyNewestFiles())
+
+    def test_getNewestFiles(self):
+        """getNewestFiles gives the newest version for each product and date"""
+        self.addGenericFile(1, version=(1, 0, 0))
+        fID = self.addGenericFile(1, version=(1, 3, 0))
+        self.addGenericFile(1, version=(1, 1, 0))
+        ans = self.dbu.getNewestFiles({1: [datetime.date(2010, 1, 1), datetime.date(2010, 1, 2)]})
+        self.assertEqual([(1, datetime.date(2010, 1, 1))], list(ans.keys()))
+        self.assertEqual(fID, ans[(1, datetime.date(2010, 1, 1))].file_id)
+        self.assertEqual({}, self.dbu.getNewestFiles({1: [datetime.date(2009, 1, 1)]}))
+
+    def test_addFiles(self):
+        """addFiles adds many files in one go, leaving out the bad ones"""
+        fID = self.addGenericFile(1, version=(1, 0, 0))
+        self.dbu.Processqueue.flush()
+        cID = self.addGenericCode()
+        files = [dict(filename="testing_file_{0}.file".format(v),
+                      data_level=0,
+                      version=Version.Version.fromString(v),
+                      file_create_date=datetime.date(2010, 1, 1),
+                      exists_on_disk=1,
+                      utc_file_date=datetime.date(2010, 1, 1),
+                      utc_start_time=datetime.datetime(2010, 1, 1, 0, 0, 0),
+                      utc_stop_time=datetime.datetime(2010, 1, 2, 0, 0, 0),
+                      product_id=1,
+                      shasum='0')
+                 for v in ('1.1.0', '1.0.0', '1.2.0')]
+        ans = self.dbu.addFiles(files, processqueue=True,
+                                links=[(cID, [fID]), (cID, [fID]), None])
+        self.assertEqual(None, ans[1])
+        self.assertEqual(['testing_file_1.1.0.file', 'testing_file_1.2.0.file'],
+                         [self.dbu.getEntry('File', v).filename for v in (ans[0], ans[2])])
+        self.assertEqual(sorted([ans[0], ans[2]]), sorted(self.dbu.Processqueue.getAll()))
+        self.assertEqual(cID, self.dbu.getFilecodelink_byfile(ans[0]))
+        self.assertEqual(None, self.dbu.getFilecodelink_byfile(ans[2]))
+        self.assertEqual([], self.dbu.addFiles([]))
+
+    def test_pq_popBatch(self):
+        """popBatch and drain take many entries off the queue at once"""
+        self.dbu.Processqueue.flush()
+        fIDs = [self.addGenericFile(1, version=(1, v, 0)) for v in range(5)]
+        self.assertEqual(5, self.dbu.Processqueue.rawadd(fIDs))
+        self.assertEqual(0, self.dbu.Processqueue.rawadd(fIDs[:2]))
+        self.assertEqual([(fIDs[0], None), (fIDs[1], None)], self.dbu.Processqueue.popBatch(2))
+        self.assertEqual(3, self.dbu.Processqueue.len())
+        self.assertEqual([[(fIDs[2], None), (fIDs[3], None)], [(fIDs[4], None)]],
+                         list(self.dbu.Processqueue.drain(2)))
+        self.assertEqual(0, self.dbu.Processqueue.len())
+        self.assertEqual([], self.dbu.Processqueue.popBatch())
+        # a chunk is only taken off once the caller is done with it
+        self.dbu.Processqueue.rawadd(fIDs)
+        drain = self.dbu.Processqueue.drain(2)
+        self.assertEqual([(fIDs[0], None), (fIDs[1], None)], next(drain))
+        self.assertEqual(5, self.dbu.Processqueue.len())
+        self.assertEqual([(fIDs[2], None), (fIDs[3], None)], next(drain))
+        self.assertEqual(3, self.dbu.Processqueue.len())
+        try:
+            for entries in self.dbu.Processqueue.drain(2):
+                raise ValueError('failed planning {0}'.format(entries))
+        except ValueError:
+            pass
+        self.assertEqual(3, self.dbu.Processqueue.len())
+        self.dbu.Processqueue.flush()
+        self.assertEqual(sorted(fIDs[:2]), sorted(self.dbu.Processqueue.push(fIDs[:2] + [fIDs[0], 10000])))
+        self.assertEqual([], self.dbu.Processqueue.push(fIDs[:2]))
+        self.dbu.Processqueue.remove([fIDs[0], 'testing_file_1.1.0.file'])
+        self.assertEqual(0, self.dbu.Processqueue.len())
+
+    def test_metadataCache(self):
+        """Cached lookups see changes made to the static tables"""
+        prod = self.dbu.getEntry('Product', 1, cached=True)
+        self.assertTrue(prod is self.dbu.getEntry('Product', 1, cached=True))
+        name = prod.product_name
+        self.assertEqual(1, self.dbu.getProductID(name))
+        self.assertEqual(name, self.dbu.getTraceback('Product', 1)['product'].product_name)
+        self.dbu.session.commit()  # expires the session, not the cache
+        self.assertEqual(name, prod.product_name)
+        self.dbu.getEntry('Product', 1).product_name = 'changed'
+        self.dbu.commitDB()
+        self.assertEqual('changed', self.dbu.getEntry('Product', 1, cached=True).product_name)
+        self.assertEqual('changed', self.dbu.getTraceback('Product', 1)['product'].product_name)
+        self.assertEqual(1, self.dbu.getProductID('changed'))
+        self.assertRaises(DButils.DBNoData, self.dbu.getProductID, name)
+        self.assertEqual(None, self.dbu.getCodeFromProcess(1, datetime.date(2100, 1, 1)))
+        self.assertTrue(self.dbu.getCodeFromProcess(1, datetime.datetime(2012, 1, 1, 12)))
+        self.addGenericCode()  # now two codes for the same day
+        self.assertRaises(DButils.DBError, self.dbu.getCodeFromProcess, 1, datetime.date(2012, 1, 1))
+
+    def test_getTracebacks(self):
+        """getTracebacks gives the same answer as getTraceback for many ids"""
+        def keys(tb):
+            return dict((k, sqlalchemy.orm.class_mapper(type(v)).primary_key_from_instance(v))
+                        for k, v in tb.items())
+        self.addGenericFile(1)
+        for table, cls in (('File', 'File'), ('Product', 'Product'), ('Code', 'Code'),
+                           ('Inspector', 'Inspector'), ('Instrument', 'Instrument'),
+                           ('Satellite', 'Satellite'), ('Mission', 'Mission')):
+            mapper = sqlalchemy.orm.class_mapper(getattr(self.dbu, cls))
+            ids = [mapper.primary_key_from_instance(v)[0]
+                   for v in self.dbu.session.query(getattr(self.dbu, cls))]
+            ans = self.dbu.getTracebacks(table, ids)
+            self.assertEqual(sorted(ids), sorted(ans))
+            for v in ids:
+                self.assertEqual(keys(self.dbu.getTraceback(table, v)), keys(ans[v]))
+        self.assertEqual({}, self.dbu.getTracebacks('Product', []))
+        self.assertRaises(DButils.DBError, self.dbu.getTracebacks, 'Product', [1, 10000])
+
+    def test_getFileFullPaths(self):
+        """getFileFullPaths resolves many paths, with substitutions"""
+        fID1 = self.addGenericFile(1, version=(1, 0, 0))
+        fID2 = self.addGenericFile(1, version=(1, 1, 0))
+        prod = self.dbu.getEntry('Product', 1)
+        prod.relative_path = 'L0/{PRODUCT}/{Y}/v{VERSION}'
+        self.dbu.commitDB()
+        base = os.path.join(self.dbu.MissionDirectory, 'L0', prod.product_name, '2010')
+        ans = self.dbu.getFileFullPaths([fID1, fID2])
+        self.assertEqual({fID1: os.path.join(base, 'v1.0.0', 'testing_file_1.0.0.file'),
+                          fID2: os.path.join(base, 'v1.1.0', 'testing_file_1.1.0.file')}, ans)
+        self.assertEqual(ans[fID1], self.dbu.getFileFullPath('testing_file_1.0.0.file'))
+        self.assertEqual(ans, dict((k, v) for k, v in self.dbu.iterFileFullPaths()
+                                   if k in (fID1, fID2)))
+        self.assertRaises(DButils.DBNoData, self.dbu.getFileFullPaths, [fID1, 10000])
+
+    def test_pq_cleanSQL(self):
+        """clean removes superseded entries in the db, popBatch pops in file order"""
+        self.dbu.Processqueue.flush()
+        fIDs = [self.addGenericFile(1, version=(1, v, 0)) for v in range(3)]
+        self.dbu.Processqueue.rawadd(fIDs[0], version_bump=1)
+        self.dbu.Processqueue.rawadd(fIDs + [1, 10000])
+        self.dbu.Processqueue.clean(dryrun=True)
+        self.assertEqual(5, self.dbu.Processqueue.len())
+        self.dbu.Processqueue.clean()
+        self.assertEqual(sorted([fIDs[0], fIDs[2], 1]), sorted(self.dbu.Processqueue.getAll()))
+        self.assertEqual((fIDs[0], 1), self.dbu.Processqueue.get(0))
+        self.dbu.rebuildNewestFiles()
+        self.dbu.Processqueue.rawadd([fIDs[1], 10000])
+        self.dbu.Processqueue.clean()
+        self.assertEqual(sorted([fIDs[0], fIDs[2], 1]), sorted(self.dbu.Processqueue.getAll()))
+        self.dbu.Processqueue.rawadd(10000)
+        order = sorted([fIDs[0], fIDs[2], 1], key=lambda f: (
+            self.dbu.getEntry('File', f).data_level, self.dbu.getEntry('File', f).utc_file_date,
+            self.dbu.getEntry('File', f).product_id, f))
+        self.assertEqual(order + [10000], [v[0] for v in self.dbu.Processqueue.popBatch(2)
+                                           + self.dbu.Processqueue.popBatch()])
+
+    def test_pq_clean_noDate(self):
+        """clean keeps the entry of a file with no utc_file_date, with or without newest_file"""
+        self.dbu.Processqueue.flush()
+        fID = self.addGenericFile(1, version=(1, 0, 0))
+        self.dbu.getEntry('File', fID).utc_file_date = None
+        self.dbu.commitDB()
+        self.dbu.Processqueue.rawadd(fID)
+        self.dbu.Processqueue.clean()
+        self.assertEqual([fID], self.dbu.Processqueue.getAll())
+        self.dbu.rebuildNewestFiles()
+        self.dbu.Processqueue.clean()
+        self.assertEqual([fID], self.dbu.Processqueue.getAll())
+
+    def test_fileInDB(self):
+        """fileInDB checks names against the filename index"""
+        name = self.dbu.getEntry('File', 1).filename
+        self.assertEqual(1, self.dbu.fileInDB(name))
+        self.assertEqual(None, self.dbu.fileInDB('not_a_file.cdf'))
+        hashes, new = self.dbu._filenames
+        self.assertEqual(16, len(hashes))
+        fID = self.addGenericFile(1)
+        self.assertEqual(1, len(new))
+        self.assertEqual(fID, self.dbu.fileInDB('testing_file_1.2.3.file'))
+        # a hash that matches is checked in the db
+        new.add(DButils._filenameHash('not_a_file.cdf'))
+        self.assertEqual(None, self.dbu.fileInDB('not_a_file.cdf'))
+        self.dbu.resetFilenameIndex()
+        self.assertEqual(fID, self.dbu.fileInDB(u'testing_file_1.2.3.file'))
+        self.assertEqual(17, len(self.dbu._filenames[0]))
+
+    def test_getStagingPath(self):
+        """getStagingPath is None unless the mission has a stagingdir"""
+        self.assertEqual(None, self.dbu.getStagingPath())
+        self.assertTrue(self.dbu.addStagingDir())
+        self.assertFalse(self.dbu.addStagingDir())
+        self.dbu.closeDB()
+        self.dbu = DButils.DButils(self.tempD + '/testDB.sqlite')
+        self.assertEqual(None, self.dbu.getStagingPath())
+        self.dbu.getEntry('Mission', 1).stagingdir = 'staging'
+        self.dbu.commitDB()
+        self.assertEqual(os.path.join(self.tempD, 'staging'), self.dbu.getStagingPath())
+        self.assertFalse(self.dbu.addStagingDir('/data/staging'))
+        self.assertEqual('/data/staging', self.dbu.getStagingPath())
+
+    def test_addIndexes(self):
+        """addIndexes adds the missing indexes and the hot queries then use them"""
+        before = [v for v in self.dbu.explainQueries() if v[3]]
+        self.assertTrue(before)
+        # testDB has no version_key
+        self.assertEqual([v[0] for v in DButils.DButils.INDEXES if 'version_key' not in v[2]],
+                         self.dbu.addIndexes())
+        self.assertEqual([], self.dbu.addIndexes())
+        ans = self.dbu.explainQueries()
+        self.assertEqual([], [v for v in ans if v[3]])
+        self.assertTrue('getFilesByProductDate' in [v[0] for v in ans])
+
     def test_addCode(self):
         """Tests if addCode is succesful"""
         cID = self.addGenericCode()
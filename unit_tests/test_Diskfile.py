@@ -6,6 +6,7 @@ import datetime
 import os
 import shutil
 import stat
+import tempfile
 import unittest
 
 from dbprocessing import DButils
@@ -51,6 +52,87 @@ class DiskfileStaticTests(unittest.TestCase):
         f.close()
         os.remove('IamAfileThatExists.file')
 
+    def test_calcDigest_bufsize(self):
+        """calcDigest gives the same answer whatever the buffer size"""
+        with open('IamAfileThatExists.file', 'wb') as f:
+            f.write('I am some text in a file')
+        real_ans = 'aa42c02f50c92203be933747670bdd512848385e'
+        for bufsize in (1, 5, 24, 1000):
+            self.assertEqual(real_ans, Diskfile.calcDigest('IamAfileThatExists.file', bufsize))
+        os.remove('IamAfileThatExists.file')
+
+    def test_calcDigests(self):
+        """calcDigests hashes many files, None for missing ones"""
+        with open('IamAfileThatExists.file', 'wb') as f:
+            f.write('I am some text in a file')
+        ans = Diskfile.calcDigests(['IamAfileThatExists.file', 'idontexist.file'], threads=2)
+        self.assertEqual({'IamAfileThatExists.file': 'aa42c02f50c92203be933747670bdd512848385e',
+                          'idontexist.file': None}, ans)
+        os.remove('IamAfileThatExists.file')
+
+
+class DigestCacheTests(unittest.TestCase):
+    """Tests for the DigestCache class"""
+    def setUp(self):
+        super(DigestCacheTests, self).setUp()
+        self.td = tempfile.mkdtemp()
+        self.infile = os.path.join(self.td, 'IamAfileThatExists.file')
+        with open(self.infile, 'wb') as f:
+            f.write('I am some text in a file')
+        self.cache = Diskfile.DigestCache(os.path.join(self.td, 'digest.sqlite'))
+
+    def tearDown(self):
+        super(DigestCacheTests, self).tearDown()
+        self.cache.close()
+        shutil.rmtree(self.td)
+
+    def test_digest(self):
+        """digest is calculated once then taken from the cache"""
+        self.assertEqual('aa42c02f50c92203be933747670bdd512848385e', self.cache.digest(self.infile))
+        # change the stored value, an unchanged file is not hashed again
+        self.cache.conn.execute('UPDATE digest SET shasum = ?', ('cached',))
+        self.assertEqual('cached', self.cache.digest(self.infile))
+        self.assertEqual('aa42c02f50c92203be933747670bdd512848385e', self.cache.digest(self.infile, verify=True))
+        self.assertRaises(Diskfile.DigestError, self.cache.digest, os.path.join(self.td, 'idontexist.file'))
+
+    def test_digest_changed(self):
+        """a file that changed is hashed again"""
+        self.cache.digest(self.infile)
+        self.cache.conn.execute('UPDATE digest SET shasum = ?', ('cached',))
+        with open(self.infile, 'wb') as f:
+            f.write('I am some other text in a file')
+        self.assertEqual('7dd28ec71052fd879af8cb167053c9cd53947291', self.cache.digest(self.infile))
+
+    def test_digests(self):
+        """digests only hashes the files not in the cache"""
+        missing = os.path.join(self.td, 'idontexist.file')
+        self.assertEqual({self.infile: 'aa42c02f50c92203be933747670bdd512848385e', missing: None},
+                         self.cache.digests([self.infile, missing], threads=2))
+        self.cache.conn.execute('UPDATE digest SET shasum = ?', ('cached',))
+        self.assertEqual({self.infile: 'cached'}, self.cache.digests([self.infile]))
+        self.assertEqual({self.infile: 'aa42c02f50c92203be933747670bdd512848385e'},
+                         self.cache.digests([self.infile], verify=True))
+
+    def test_noCache(self):
+        """a cache file that cannot be opened hashes everything"""
+        cache = Diskfile.DigestCache(os.path.join(self.td, 'idontexist', 'digest.sqlite'))
+        self.assertEqual(None, cache.conn)
+        self.assertEqual('aa42c02f50c92203be933747670bdd512848385e', cache.digest(self.infile))
+        self.assertEqual({self.infile: 'aa42c02f50c92203be933747670bdd512848385e'},
+                         cache.digests([self.infile]))
+        self.assertEqual(0, cache.prune())
+        cache.close()
+
+    def test_prune(self):
+        """prune drops the files that are gone"""
+        other = os.path.join(self.td, 'other.file')
+        shutil.copy(self.infile, other)
+        self.cache.digests([self.infile, other])
+        os.remove(other)
+        self.assertEqual(1, self.cache.prune())
+        self.assertEqual([(self.infile,)], self.cache.conn.execute('SELECT path FROM digest').fetchall())
+        self.assertEqual(0, self.cache.prune())
+
 
 class DiskfileTests(TestSetup):
     """Tests for Diskfile class"""
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+from distutils.dir_util import copy_tree, remove_tree
+import imp
+import optparse
+import os
+import signal
+import sys
+import tempfile
+import unittest
+
+from dbprocessing import dbprocessing
+from dbprocessing import DButils
+
+ProcessQueue = imp.load_source('ProcessQueue', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'scripts', 'ProcessQueue.py'))
+
+
+class _Daemon(ProcessQueue.Daemon):
+    """Daemon whose cycles run the callables in steps, one per cycle"""
+
+    def __init__(self, pq, options, steps):
+        super(_Daemon, self).__init__(pq, options)
+        self.steps = list(steps)
+        self.slept = 0
+
+    def ingest(self):
+        self.steps.pop(0)(self)
+        return 0
+
+    def process(self):
+        return (1, 0)
+
+    def sleep(self):
+        self.slept += 1
+        super(_Daemon, self).sleep()
+
+
+class DaemonTests(unittest.TestCase):
+    """Tests for the --daemon loop of ProcessQueue.py"""
+
+    def setUp(self):
+        super(DaemonTests, self).setUp()
+        self.tempD = tempfile.mkdtemp()
+        copy_tree(os.path.dirname(os.path.abspath(__file__)) + '/../functional_test/', self.tempD)
+        self.pq = dbprocessing.ProcessQueue(self.tempD + '/testDB.sqlite')
+        self.options = optparse.Values(dict(i=False, p=False, poll=0.))
+        self.handlers = [signal.getsignal(v) for v in (signal.SIGTERM, signal.SIGHUP)]
+
+    def tearDown(self):
+        super(DaemonTests, self).tearDown()
+        signal.signal(signal.SIGTERM, self.handlers[0])
+        signal.signal(signal.SIGHUP, self.handlers[1])
+        self.pq.dbu.closeDB()
+        del self.pq
+        remove_tree(self.tempD)
+
+    def test_stop(self):
+        """SIGTERM lets the cycle finish and then stops"""
+        d = _Daemon(self.pq, self.options, [lambda d: None, lambda d: os.kill(os.getpid(), signal.SIGTERM)])
+        d.install()
+        d.run()
+        self.assertEqual(2, d.cycles)
+        self.assertEqual(0, d.errors)
+        self.assertEqual([], d.steps)
+
+    def test_noProcessAfterStop(self):
+        """A stop during the ingest skips the processing"""
+        d = _Daemon(self.pq, self.options, [lambda d: d.onTerm(signal.SIGTERM, None)])
+        d.process = lambda: self.fail('processed after the stop')
+        d.run()
+        self.assertEqual(1, d.cycles)
+
+    def test_reload(self):
+        """SIGHUP cuts the sleep short and the next cycle reads the db again"""
+        self.options.poll = 60.
+        self.pq.getInspectors()
+        def check(d):
+            self.assertFalse(d.reload)
+            self.assertEqual(None, d.pq.inspectors)
+            d.onTerm(signal.SIGTERM, None)
+        d = _Daemon(self.pq, self.options, [lambda d: os.kill(os.getpid(), signal.SIGHUP), check])
+        d.install()
+        d.run()
+        self.assertEqual(2, d.cycles)
+        self.assertEqual(2, d.slept)
+
+    def test_error(self):
+        """An exception ends the cycle, not the daemon, and the db is read again"""
+        self.pq.getInspectors()
+        def fail(d):
+            d.pq.runme_list.append('planned')
+            raise DButils.DBError('database is locked')
+        def check(d):
+            self.assertEqual(None, d.pq.inspectors)
+            self.assertEqual([], d.pq.runme_list)
+            d.onTerm(signal.SIGTERM, None)
+        d = _Daemon(self.pq, self.options, [fail, check])
+        self.assertFalse(d.cycle())
+        self.assertTrue(d.stale)
+        self.assertTrue(d.cycle())
+        self.assertEqual((2, 1), (d.cycles, d.errors))
+
+
+class ProcessTests(unittest.TestCase):
+    """Tests for process() of ProcessQueue.py, on a copy of the functional test db"""
+
+    def setUp(self):
+        super(ProcessTests, self).setUp()
+        self.tempD = tempfile.mkdtemp()
+        copy_tree(os.path.dirname(os.path.abspath(__file__)) + '/../functional_test/', self.tempD)
+        dbu = DButils.DButils(self.tempD + '/testDB.sqlite')
+        dbu.getEntry('Mission', 1).rootdir = self.tempD  # Set the mission's dir to the tmp so we can work with it
+        dbu.commitDB()
+        dbu.closeDB()
+        self.pq = dbprocessing.ProcessQueue(self.tempD + '/testDB.sqlite')
+        self.dbu = self.pq.dbu
+        self.options = optparse.Values(dict(s=False, o=None, dryrun=False, numproc=2, maxcpu=None,
+                                            maxram=None, fsync=False, cascadedepth=0))
+        # the codes are run with the python running the tests
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = os.path.dirname(sys.executable) + os.pathsep + self.path
+        # and where they are started, the plots write out.txt there
+        self.cwd = os.getcwd()
+        os.chdir(self.tempD)
+
+    def tearDown(self):
+        super(ProcessTests, self).tearDown()
+        os.chdir(self.cwd)
+        os.environ['PATH'] = self.path
+        self.dbu.closeDB()
+        del self.pq
+        remove_tree(self.tempD)
+
+    def test_cascadeDepth(self):
+        """process() is one pass, the outputs below the cascade depth stay queued"""
+        self.dbu._purgeFileFromDB(['testDB_2016-01-0{0}.cat'.format(d) for d in range(1, 6)], recursive=True)
+        self.dbu.Processqueue.flush()
+        self.dbu.Processqueue.push([3, 4, 5, 6])
+        # no cascade, L0 -> L1 and the L1 files wait
+        self.assertEqual((5, 0), ProcessQueue.process(self.pq, self.options))
+        l1 = sorted(self.dbu.fileInDB('testDB_2016-01-0{0}.cat'.format(d)) for d in range(1, 6))
+        self.assertFalse(None in l1)
+        self.assertEqual(l1, sorted(self.dbu.Processqueue.getAll()))
+        # L1 -> L2, again only one level
+        self.assertEqual((5, 0), ProcessQueue.process(self.pq, self.options))
+        l2 = sorted(self.dbu.fileInDB('testDB_2016-01-0{0}.rot'.format(d)) for d in range(1, 6))
+        self.assertFalse(None in l2)
+        self.assertEqual(l2, sorted(self.dbu.Processqueue.getAll()))
+        # L2 -> plots, they make no files so nothing is left
+        self.options.cascadedepth = 1
+        self.assertEqual((5, 0), ProcessQueue.process(self.pq, self.options))
+        self.assertEqual(0, self.dbu.Processqueue.len())
+        self.assertEqual((0, 0), ProcessQueue.process(self.pq, self.options))
+
+
+if __name__ == "__main__":
+    unittest.main()
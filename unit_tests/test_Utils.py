@@ -73,6 +73,9 @@ class UtilsTests(unittest.TestCase):
         # Verify that unknown values are ignored
         path = '{xxx}'
         self.assertEqual('{xxx}', Utils.dirSubs(path, filename, utc_file_date, utc_start_time, version, dbu=self.dbu))
+        path = 'a/{PRODUCT}/{Y}/{xxx}/{Y:04d}/{Y}{m}'
+        self.assertEqual('a/testDB_rot13_L0_first/2012/{xxx}/{Y:04d}/201204',
+                         Utils.dirSubs(path, filename, utc_file_date, utc_start_time, version, dbu=self.dbu))
 
     def test_chunker(self):
         """chunker()"""
@@ -190,6 +193,14 @@ class UtilsTests(unittest.TestCase):
         self.assertEqual(result, "\rDownload Progress ...0%")
         sys.stdout = realstdout
 
+    def test_fsyncFiles(self):
+        """fsyncFiles syncs the files and their directories"""
+        Utils.fsyncFiles([os.path.join(self.tempD, 'testDB.sqlite'),
+                          os.path.join(self.tempD, 'L0', 'testDB_001_001.raw'),
+                          os.path.join(self.tempD, 'L0', 'testDB_001_000.raw')])
+        Utils.fsyncFiles([])
+        self.assertRaises(OSError, Utils.fsyncFiles, [os.path.join(self.tempD, 'nofile')])
+
     def test_readconfig(self):
         """test readconfig"""
         self.assertEqual({'section2': {'sect2a': 'sect2_value1'}, 'section1': {'sect1a': 'sect1_value1', 'sect1b': 'sect1_value2'}}, Utils.readconfig(os.path.dirname(__file__) + '/testconfig.txt'))
@@ -113,6 +113,17 @@ class VersionTests(unittest.TestCase):
         """fromString"""
         self.assertEqual(Version.Version(1,0,1), Version.Version.fromString('1.0.1'))
 
+    def test_key(self):
+        """toKey/fromKey round trip and keys sort like the versions"""
+        vers = [Version.Version(1, 0, 0), Version.Version(1, 0, 99), Version.Version(1, 2, 0),
+                Version.Version(4, 2, 1), Version.Version(5, 0, 0), Version.Version(5, 3, 65535)]
+        for v in vers:
+            self.assertEqual(v, Version.Version.fromKey(v.toKey()))
+        self.assertEqual(vers, sorted(vers, key=lambda v: v.toKey(), reverse=True)[::-1])
+        self.assertEqual((4 << 32) + (2 << 16) + 1, Version.Version(4, 2, 1).toKey())
+        self.assertEqual(Version.Version(4, 2, 1).toKey(), Version.Version.makeKey(4, 2, 1))
+        self.assertRaises(Version.VersionError, Version.Version.makeKey, 1, 65536, 0)
+
 
 if __name__ == "__main__":
     unittest.main()
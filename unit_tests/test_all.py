@@ -10,6 +10,9 @@ from test_Version import *
 from test_DBstrings import *
 from test_Utils import *
 from test_Inspector import *
+from test_runMe import *
+from test_dbprocessing import *
+from test_ProcessQueue import *
 
 
 if __name__ == "__main__":
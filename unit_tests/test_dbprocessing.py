@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+from distutils.dir_util import copy_tree, remove_tree
+import os
+import shutil
+import tempfile
+import unittest
+
+from dbprocessing import dbprocessing
+from dbprocessing import DButils
+
+
+class ProcessQueueTests(unittest.TestCase):
+    """Tests for ProcessQueue, on a copy of the functional test db"""
+
+    def setUp(self):
+        super(ProcessQueueTests, self).setUp()
+        self.tempD = tempfile.mkdtemp()
+        copy_tree(os.path.dirname(__file__) + '/../functional_test/', self.tempD)
+        dbu = DButils.DButils(self.tempD + '/testDB.sqlite')
+        dbu.getEntry('Mission', 1).rootdir = self.tempD  # Set the mission's dir to the tmp so we can work with it
+        dbu.commitDB()
+        dbu.closeDB()
+        self.pq = dbprocessing.ProcessQueue(self.tempD + '/testDB.sqlite')
+        self.dbu = self.pq.dbu
+
+    def tearDown(self):
+        super(ProcessQueueTests, self).tearDown()
+        self.dbu.closeDB()
+        del self.pq
+        remove_tree(self.tempD)
+
+    def test_candidateInspectors(self):
+        """The inspectors of the products whose format matches go first"""
+        self.assertEqual([], self.pq._prefixLengths)
+        self.assertEqual([4], [v.product_id for v in self.pq.candidateInspectors('testDB_000_001.raw')])
+        self.assertEqual([1], [v.product_id for v in self.pq.candidateInspectors('/a/testDB_20160101.cat')])
+        # nothing matches, they all get a look
+        self.assertEqual(self.pq.getInspectors(), self.pq.candidateInspectors('other_000_001.raw'))
+
+    def test_figureProduct(self):
+        """A file is claimed by the inspector of its format"""
+        df = self.pq.figureProduct(os.path.join(self.tempD, 'L0', 'testDB_000_001.raw'))
+        self.assertEqual(4, df.params['product_id'])
+        self.assertEqual(None, self.pq.figureProduct(os.path.join(self.tempD, 'L0', 'testDB_000_001.raw'),
+                                                     inspectors=self.pq.candidateInspectors('testDB_20160101.cat')))
+
+    def test_figureProductDeclined(self):
+        """A file declined by the inspectors its format matches goes to the others"""
+        # product 1 (the .cat) now has the format of the L0 files and 4 has none that match
+        self.dbu.getEntry('Product', 1).format = 'testDB_000_{nnn}.raw'
+        self.dbu.getEntry('Product', 4).format = 'testDB_{nnn}.first'
+        self.dbu.commitDB()
+        self.assertEqual([1], [v.product_id for v in self.pq.candidateInspectors('testDB_000_001.raw')])
+        df = self.pq.figureProduct(os.path.join(self.tempD, 'L0', 'testDB_000_001.raw'))
+        self.assertEqual(4, df.params['product_id'])
+        shutil.copy(os.path.join(self.tempD, 'L0', 'testDB_000_001.raw'),
+                    os.path.join(self.tempD, 'L0', 'testDB_002_001.raw'))
+        self.assertEqual(None, self.pq.figureProduct(os.path.join(self.tempD, 'L0', 'testDB_002_001.raw')))
+
+    def test_buildChildrenDedup(self):
+        """A runMe already in runme_list is not added again, even after it was replaced"""
+        self.dbu._purgeFileFromDB(['testDB_2016-01-0{0}.cat'.format(d) for d in range(1, 6)], recursive=True)
+        self.pq.buildChildrenBatch([(6, None)])
+        self.assertEqual(['testDB_2016-01-01.cat', 'testDB_2016-01-02.cat'],
+                         sorted(v.filename for v in self.pq.runme_list))
+        self.pq.buildChildrenBatch([(6, None), (5, None)])
+        self.assertEqual(['testDB_2016-01-01.cat', 'testDB_2016-01-02.cat', 'testDB_2016-01-03.cat'],
+                         sorted(v.filename for v in self.pq.runme_list))
+        # the same length list of other runMe's, all of 6 have to go in again
+        self.pq.runme_list = self.pq.planChildren([3, 4])
+        self.assertEqual(3, len(self.pq.runme_list))
+        self.pq.buildChildrenBatch([(6, None)])
+        self.assertEqual(['testDB_2016-01-01.cat', 'testDB_2016-01-02.cat', 'testDB_2016-01-03.cat',
+                          'testDB_2016-01-04.cat', 'testDB_2016-01-05.cat'],
+                         sorted(v.filename for v in self.pq.runme_list))
+        del self.pq.runme_list[:]
+        self.pq.buildChildrenBatch([(6, None)])
+        self.assertEqual(2, len(self.pq.runme_list))
+
+    def test_buildChildrenNoDate(self):
+        """A file with no utc_file_date is newest, it is kept by clean and its children are built"""
+        self.dbu._purgeFileFromDB(['testDB_2016-01-0{0}.cat'.format(d) for d in range(1, 6)], recursive=True)
+        self.dbu.getEntry('File', 6).utc_file_date = None
+        self.dbu.commitDB()
+        self.dbu.Processqueue.rawadd(6)
+        self.dbu.Processqueue.clean()
+        entries = [e for v in self.dbu.Processqueue.drain() for e in v]
+        self.assertEqual([(6, None)], entries)
+        self.pq.buildChildrenBatch(entries)
+        self.assertEqual(['testDB_2016-01-01.cat', 'testDB_2016-01-02.cat'],
+                         sorted(v.filename for v in self.pq.runme_list))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,454 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+import datetime
+from distutils.dir_util import copy_tree, remove_tree
+import os
+import select
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from dbprocessing import dbprocessing
+from dbprocessing import Diskfile
+from dbprocessing import DButils
+from dbprocessing import runMe
+from dbprocessing import Version
+
+
+class _Inputs(object):
+    """Stands in for DButils in _JobGraph, process_id -> [(product_id, optional, yesterday, tomorrow)]"""
+
+    def __init__(self, inputs):
+        self.inputs = inputs
+
+    def getInputProductID(self, process_id, range=False):
+        return self.inputs.get(process_id, [])
+
+
+class _Job(object):
+    """The parts of a runMe that _JobGraph and runner() look at"""
+
+    def __init__(self, filename, data_level, process_id, out_prod, utc_file_date, cpu=1, ram=0):
+        self.filename = filename
+        self.data_level = data_level
+        self.process_id = process_id
+        self.out_prod = out_prod
+        self.utc_file_date = utc_file_date
+        self.cpu = cpu
+        self.ram = ram
+
+    def __repr__(self):
+        return self.filename
+
+
+class JobGraphTests(unittest.TestCase):
+    """Tests for the dependency graph runner() schedules on"""
+
+    def setUp(self):
+        super(JobGraphTests, self).setUp()
+        self.d = datetime.date(2016, 1, 1)
+        # process 1 makes product 1 from product 4, process 3 makes product 3
+        #   from product 1 of the day before to the day after
+        self.graph = runMe._JobGraph(_Inputs({1: [(4, False, 0, 0)],
+                                              3: [(1, False, 1, 1)]}))
+
+    def day(self, n):
+        return self.d + datetime.timedelta(days=n)
+
+    def test_order(self):
+        """A runMe is ready once the runMe's making its inputs are done"""
+        l1 = _Job('b_L1', 1, 1, 1, self.day(0))
+        l2 = _Job('a_L2', 2, 3, 3, self.day(1))
+        other = _Job('c_L2', 2, 3, 3, self.day(5))
+        self.graph.add([l2, other, l1])
+        self.assertEqual(3, len(self.graph))
+        self.assertTrue(self.graph.busy(l2))
+        self.assertFalse(self.graph.busy(other))
+        self.assertTrue(self.graph.pop() is l1)
+        self.assertTrue(self.graph.pop() is other)
+        self.assertEqual(None, self.graph.pop())
+        self.graph.done(l1)
+        self.assertFalse(self.graph.busy(l2))
+        self.assertTrue(self.graph.pop() is l2)
+        self.assertEqual(0, len(self.graph))
+
+    def test_doneAllParents(self):
+        """done() only releases a runMe when all it waits on are done"""
+        first = _Job('L1_1', 1, 1, 1, self.day(0))
+        second = _Job('L1_2', 1, 1, 1, self.day(2))
+        l2 = _Job('L2', 2, 3, 3, self.day(1))
+        self.graph.add([first, second, l2])
+        self.assertEqual({2: 2}, self.graph.waiting)
+        self.graph.pop()
+        self.graph.pop()
+        self.graph.done(second)
+        self.assertEqual(None, self.graph.pop())
+        self.graph.done(first)
+        self.assertTrue(self.graph.pop() is l2)
+
+    def test_addLater(self):
+        """runMe's added later wait on the ones not done, not the ones done"""
+        l1 = _Job('L1_1', 1, 1, 1, self.day(0))
+        done = _Job('L1_2', 1, 1, 1, self.day(2))
+        self.graph.add([l1, done])
+        self.graph.pop()
+        self.graph.pop()
+        self.graph.done(done)
+        l2 = _Job('L2', 2, 3, 3, self.day(1))
+        self.graph.add([l2])
+        self.assertEqual(None, self.graph.pop())
+        self.graph.done(l1)
+        self.assertTrue(self.graph.pop() is l2)
+
+    def test_cycle(self):
+        """pop(force=True) breaks a cycle by starting the first waiting runMe"""
+        graph = runMe._JobGraph(_Inputs({5: [(6, False, 0, 0)], 6: [(7, False, 0, 0)]}))
+        a = _Job('a', 1, 5, 7, self.d)
+        b = _Job('b', 1, 6, 6, self.d)
+        graph.add([b, a])
+        self.assertEqual(None, graph.pop())
+        self.assertEqual(2, len(graph))
+        self.assertTrue(graph.pop(force=True) is a)
+        graph.done(a)
+        self.assertTrue(graph.pop() is b)
+
+    def test_runTimebase(self):
+        """RUN timebase runMe's make nothing for others to wait on"""
+        run = _Job('RUN_1', 5000, 1, 1, self.day(0))
+        l2 = _Job('L2', 2, 3, 3, self.day(0))
+        self.graph.add([run, l2])
+        self.assertTrue(self.graph.pop() is l2)
+
+
+class PackingTests(unittest.TestCase):
+    """Tests for starting runMe's inside a cpu/ram budget"""
+
+    def setUp(self):
+        super(PackingTests, self).setUp()
+        self.graph = runMe._JobGraph(_Inputs({}))
+        self.running = []
+
+    def fits(self, runme):
+        return runMe._fits(runme, self.running, max_cpu=4, max_ram=8)
+
+    def start(self):
+        """pop what fits next and run it"""
+        runme = self.graph.pop(fits=self.fits)
+        if runme is not None:
+            self.running.append(runme)
+        return runme
+
+    def finish(self, runme):
+        self.running.remove(runme)
+        self.graph.done(runme)
+
+    def test_fits(self):
+        """Nothing running fits anything, otherwise the sums have to fit"""
+        big = _Job('big', 1, 1, 1, None, cpu=8, ram=16)
+        self.assertTrue(self.fits(big))
+        self.running.append(_Job('a', 1, 1, 1, None, cpu=2, ram=2))
+        self.assertFalse(self.fits(big))
+        self.assertTrue(self.fits(_Job('b', 1, 1, 1, None, cpu=2, ram=6)))
+        self.assertFalse(self.fits(_Job('c', 1, 1, 1, None, cpu=3, ram=1)))
+        self.assertFalse(self.fits(_Job('d', 1, 1, 1, None, cpu=1, ram=7)))
+        self.assertTrue(runMe._fits(big, self.running))
+
+    def test_packing(self):
+        """A runMe that does not fit is passed over for ones that do"""
+        jobs = [_Job('a', 1, 1, 1, None, cpu=3), _Job('b', 1, 1, 1, None, cpu=2),
+                _Job('c', 1, 1, 1, None, cpu=1), _Job('d', 1, 1, 1, None, cpu=1)]
+        self.graph.add(jobs)
+        self.assertTrue(self.start() is jobs[0])
+        self.assertTrue(self.start() is jobs[2])
+        self.assertEqual(None, self.start())
+        self.assertEqual(2, len(self.graph))
+        self.finish(jobs[0])
+        self.assertTrue(self.start() is jobs[1])
+        self.assertTrue(self.start() is jobs[3])
+        self.assertEqual(0, len(self.graph))
+
+    def test_backfill(self):
+        """Only BACKFILL ready runMe's are looked at"""
+        self.graph.BACKFILL = 3
+        self.graph.add([_Job('a', 1, 1, 1, None, cpu=4)])
+        self.start()
+        self.graph.add([_Job('b{0}'.format(ii), 1, 1, 1, None, cpu=4) for ii in range(3)])
+        self.graph.add([_Job('c', 1, 1, 1, None, cpu=0)])
+        self.assertEqual(None, self.start())
+        self.graph.BACKFILL = 4
+        self.assertEqual('c', self.start().filename)
+        self.assertEqual(['b0', 'b1', 'b2'], sorted(v[1] for v in self.graph.ready))
+
+    def test_starvation(self):
+        """The first ready runMe is not passed over for ever"""
+        self.graph.MAX_PASSED = 3
+        small = [_Job('s{0:02}'.format(ii), 1, 1, 1, None, cpu=1) for ii in range(10)]
+        self.graph.add(small[:2])
+        self.start()
+        self.start()
+        big = _Job('big', 1, 1, 1, None, cpu=4)
+        self.graph.add([big] + small[2:])
+        # small ones keep finishing and backfilling around big, up to MAX_PASSED times
+        for ii in range(3):
+            self.finish(self.running[0])
+            self.assertTrue(self.start().filename.startswith('s'))
+        self.finish(self.running[0])
+        self.assertEqual(None, self.start())
+        self.finish(self.running[0])
+        self.assertTrue(self.start() is big)
+        self.assertEqual({}, self.graph.passed)
+        self.assertEqual(None, self.start())
+        self.finish(big)
+        self.assertTrue(self.start().filename.startswith('s'))
+
+
+class WakerTests(unittest.TestCase):
+    """Tests for the self-pipe runner() sleeps on"""
+
+    def setUp(self):
+        super(WakerTests, self).setUp()
+        self.handler = signal.getsignal(signal.SIGCHLD)
+        self.waker = runMe._Waker()
+
+    def tearDown(self):
+        super(WakerTests, self).tearDown()
+        self.waker.close()
+        self.assertEqual(self.handler, signal.getsignal(signal.SIGCHLD))
+
+    def test_wake(self):
+        """wake() ends a wait() and wait() empties the pipe"""
+        self.waker.wake()
+        self.waker.wake()
+        self.waker.wait()
+        self.assertEqual([], select.select([self.waker.rfd], [], [], 0)[0])
+
+    def test_sigchld(self):
+        """A child exiting ends a wait()"""
+        self.assertEqual(None, self.waker.timeout)
+        self.waker.timeout = 10 # so a missed signal fails and does not hang
+        t0 = time.time()
+        p = subprocess.Popen(['true'])
+        self.waker.wait()
+        self.assertTrue(time.time() - t0 < 5)
+        self.assertEqual(0, p.wait())
+
+    def test_thread(self):
+        """Outside the main thread the waker polls"""
+        ans = []
+        def make():
+            waker = runMe._Waker()
+            ans.append(waker.timeout)
+            waker.wait()
+            waker.close()
+        t = threading.Thread(target=make)
+        t.start()
+        t.join()
+        self.assertEqual([runMe._Waker.POLL], ans)
+
+
+class ReapTests(unittest.TestCase):
+    """Tests for _reap_children"""
+
+    def test_onlyKnown(self):
+        """Only the processes given are reaped"""
+        other = subprocess.Popen(['false'])
+        p = subprocess.Popen(['true'])
+        running = [p]
+        t0 = time.time()
+        while running and time.time() - t0 < 10:
+            done = runMe._reap_children(running)
+            for v in done:
+                running.remove(v)
+            time.sleep(0.01)
+        self.assertEqual([], running)
+        self.assertEqual(0, p.returncode)
+        self.assertEqual(None, other.returncode)
+        # its return code is still there for its owner
+        self.assertEqual(1, other.wait())
+
+
+class _Wakes(object):
+    """Stands in for _Waker, counts the wakes"""
+
+    def __init__(self):
+        self.n = 0
+
+    def wake(self):
+        self.n += 1
+
+
+class CompletionTests(unittest.TestCase):
+    """Tests for the thread that hashes outputs and removes temp directories"""
+
+    def setUp(self):
+        super(CompletionTests, self).setUp()
+        self.tempD = tempfile.mkdtemp()
+        self.waker = _Wakes()
+        self.completion = runMe._Completion(os.path.join(self.tempD, 'digest.sqlite'), self.waker)
+
+    def tearDown(self):
+        super(CompletionTests, self).tearDown()
+        if self.completion.is_alive():
+            self.completion.stop()
+        remove_tree(self.tempD)
+
+    def job(self, name, output=True):
+        """runMe with a temp directory and (if output) an output in it"""
+        job = _Job(name, 1, 1, 1, None)
+        job.tempdir = tempfile.mkdtemp(dir=self.tempD)
+        if output:
+            with open(os.path.join(job.tempdir, name), 'w') as fp:
+                fp.write(name)
+        return job
+
+    def test_order(self):
+        """Tasks are done in the order they are put"""
+        jobs = [self.job('out{0:02}'.format(ii)) for ii in range(20)]
+        self.completion.start()
+        for job in jobs:
+            self.completion.put('hash', job)
+        for job in jobs:
+            self.completion.put('clean', job)
+        self.completion.stop()
+        self.assertEqual([(v, None) for v in jobs], list(self.completion.done))
+        self.assertEqual({'hash': 0, 'clean': 0}, self.completion.depth)
+        self.assertEqual(20, self.waker.n)
+        self.assertFalse(True in [os.path.exists(v.tempdir) for v in jobs])
+
+    def test_hashFailed(self):
+        """An output that cannot be hashed comes back with its error"""
+        good, bad = self.job('good'), self.job('bad', output=False)
+        self.completion.start()
+        self.completion.put('hash', good)
+        self.completion.put('hash', bad)
+        self.completion.put('clean', bad)
+        self.completion.put('clean', bad) # already gone, only logged
+        self.completion.stop()
+        self.assertEqual([(good, None), bad], [self.completion.done[0], self.completion.done[1][0]])
+        self.assertTrue(isinstance(self.completion.done[1][1], Exception))
+        self.assertEqual({'hash': 0, 'clean': 0}, self.completion.depth)
+
+    def test_stopQueued(self):
+        """stop() finishes the tasks already put before the thread ends"""
+        jobs = [self.job('out{0:02}'.format(ii)) for ii in range(50)]
+        for job in jobs: # all queued before the thread even starts
+            self.completion.put('hash', job)
+        self.assertEqual(50, self.completion.depth['hash'])
+        self.completion.start()
+        self.completion.stop()
+        self.assertFalse(self.completion.is_alive())
+        self.assertEqual(50, len(self.completion.done))
+        self.assertEqual(0, self.completion.depth['hash'])
+        cache = Diskfile.DigestCache(self.completion.digest_file)
+        path = os.path.join(jobs[-1].tempdir, jobs[-1].filename)
+        self.assertEqual(cache._lookup(path, cache._stamp(path)), Diskfile.calcDigest(path))
+        cache.close()
+
+
+class RunMeTests(unittest.TestCase):
+    """Tests of runMe and runner() on a copy of the functional test db"""
+
+    def setUp(self):
+        super(RunMeTests, self).setUp()
+        self.tempD = tempfile.mkdtemp()
+        copy_tree(os.path.dirname(__file__) + '/../functional_test/', self.tempD)
+        dbu = DButils.DButils(self.tempD + '/testDB.sqlite')
+        dbu.getEntry('Mission', 1).rootdir = self.tempD  # Set the mission's dir to the tmp so we can work with it
+        dbu.commitDB()
+        dbu.closeDB()
+        self.pq = dbprocessing.ProcessQueue(self.tempD + '/testDB.sqlite')
+        self.dbu = self.pq.dbu
+        self.d = datetime.date(2016, 1, 1)
+
+    def tearDown(self):
+        super(RunMeTests, self).tearDown()
+        self.dbu.closeDB()
+        del self.pq
+        remove_tree(self.tempD)
+
+    def test_key(self):
+        """runMe's are equal, and hash the same, when they make the same file the same way"""
+        self.dbu._purgeFileFromDB('testDB_2016-01-01.cat', recursive=True)
+        rm1 = runMe.runMe(self.dbu, self.d, 1, [6, 5, 4], self.pq)
+        rm2 = runMe.runMe(self.dbu, datetime.datetime(2016, 1, 1, 12), 1, [4, 5, 6], self.pq)
+        rm3 = runMe.runMe(self.dbu, self.d, 1, [6, 5], self.pq)
+        self.assertEqual((1, self.d, (4, 5, 6), 'testDB_2016-01-01.cat', (1, 0, 0)), rm1.key)
+        self.assertTrue(rm1 == rm2)
+        self.assertFalse(rm1 != rm2)
+        self.assertEqual(hash(rm1), hash(rm2))
+        self.assertTrue(rm1 != rm3)
+        self.assertFalse(rm1 == 'testDB_2016-01-01.cat')
+        self.assertTrue(rm1 != 'testDB_2016-01-01.cat')
+        self.assertEqual(2, len(set([rm1, rm2, rm3])))
+        rm2.output_version = Version.Version(1, 1, 0)
+        self.assertNotEqual(rm1, rm2)
+
+    def test_registerOutputs(self):
+        """An output that inspects as what was made goes straight in, otherwise through incoming"""
+        self.dbu._purgeFileFromDB(['testDB_2016-01-01.cat', 'testDB_2016-01-02.cat'], recursive=True)
+        rms = [runMe.runMe(self.dbu, self.d + datetime.timedelta(days=n), 1, [6, 5, 4], self.pq)
+               for n in (0, 1)]
+        for rm in rms:
+            rm.make_command_line()
+            with open(os.path.join(rm.tempdir, rm.filename), 'w') as fp:
+                fp.write('made\n')
+        good, bad = rms
+        bad.output_version = Version.Version(1, 1, 0) # the inspector finds 1.0.0
+        self.assertEqual(1, good._inspectOutput(good.cmdline).params['product_id'])
+        self.assertEqual(None, bad._inspectOutput(bad.cmdline))
+        runMe._registerOutputs(rms)
+        self.assertNotEqual(None, good.output_file_id)
+        self.assertEqual(None, bad.output_file_id)
+        for rm in rms:
+            f_id = self.dbu.fileInDB(rm.filename)
+            self.assertNotEqual(None, f_id)
+            self.assertEqual(1, self.dbu.getFilecodelink_byfile(f_id))
+            self.assertEqual([4, 5, 6], sorted(v.file_id for v in self.dbu.getFileParents(f_id)))
+            self.assertTrue(os.path.isfile(os.path.join(self.tempD, 'L1', rm.filename)))
+            self.assertFalse(os.path.exists(os.path.join(self.tempD, 'incoming', rm.filename)))
+            self.assertFalse(os.path.exists(os.path.join(rm.tempdir, rm.filename)))
+            runMe.rm_tempdir(rm.tempdir)
+        self.assertEqual(good.output_file_id, self.dbu.fileInDB(good.filename))
+
+    def test_cascadeDepth(self):
+        """runner() plans the children of its outputs, max_depth times"""
+        self.dbu._purgeFileFromDB(['testDB_2016-01-0{0}.cat'.format(d) for d in range(1, 6)], recursive=True)
+        self.dbu.Processqueue.flush()
+        self.dbu.Processqueue.push([3, 4, 5, 6])
+        for entries in self.dbu.Processqueue.drain():
+            self.pq.buildChildrenBatch(entries)
+        self.assertEqual(5, len(self.pq.runme_list))
+        # the codes are run with the python running the tests
+        path = os.environ['PATH']
+        os.environ['PATH'] = os.path.dirname(sys.executable) + os.pathsep + path
+        try:
+            ans = runMe.runner(self.pq.runme_list, self.dbu, 2, cascade=self.pq.planChildren, max_depth=1)
+        finally:
+            os.environ['PATH'] = path
+        # L0 -> L1 from the queue, L1 -> L2 one cascade down, the L2 files wait for the next run
+        self.assertEqual((10, 0), ans)
+        l2 = sorted(self.dbu.fileInDB('testDB_2016-01-0{0}.rot'.format(d)) for d in range(1, 6))
+        self.assertFalse(None in l2)
+        self.assertEqual(l2, sorted(self.dbu.Processqueue.getAll()))
+
+    def test_noOutput(self):
+        """A process that exits 0 without making its output failed"""
+        self.dbu._purgeFileFromDB('testDB_2016-01-01.cat', recursive=True)
+        self.dbu.Processqueue.flush()
+        rm = runMe.runMe(self.dbu, self.d, 1, [6, 5, 4], self.pq)
+        rm.codepath = 'true'
+        os.makedirs(self.dbu.getErrorPath())
+        self.assertEqual((0, 1), runMe.runner([rm], self.dbu, cascade=self.pq.planChildren))
+        self.assertEqual(None, self.dbu.fileInDB(rm.filename))
+        self.assertEqual([rm.filename + '.prob'], os.listdir(self.dbu.getErrorPath()))
+        self.assertFalse(os.path.exists(rm.tempdir))
+        self.assertEqual([], self.dbu.Processqueue.getAll())
+
+
+if __name__ == "__main__":
+    unittest.main()